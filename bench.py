@@ -0,0 +1,607 @@
+"""
+Офлайн-бенчмарк конвейера: сбор и публикация на подставных Telegram и LLM.
+
+Запуск:
+    python bench.py                          # стандартный набор сценариев
+    python bench.py -s 1000x100 -s 5000x500 --llm-latency-ms 800 --error-rate 0.05
+
+Сценарий NxM - N новостей в M каналах. Каждый прогон идёт во временном
+каталоге, сеть и учётные данные не нужны. Пиковая память меряется
+отдельным прогоном под tracemalloc, чтобы трассировка не искажала время.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+# Кэш ответов LLM между прогонами исказил бы замеры
+os.environ.setdefault("LLM_CACHE", "0")
+
+import openai
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from telethon.tl.types import InputPeerChannel
+
+import logic
+from censure import CATEGORIES
+from context import AppContext, set_context
+from llm import BoundedAsyncOpenAI, http_transport
+from loader import get_prompt
+from tokens import count_messages, count_tokens
+
+DEFAULT_SCENARIOS = ["10x20", "100x20", "1000x100", "5000x500"]
+# Доля задержки потокового ответа до первого фрагмента
+STREAM_FIRST_CHUNK_SHARE = 1 / 3
+
+# Тематические слова для предварительного отбора; остальной словарь -
+# случайные псевдослова с частотами по закону Ципфа, как в живом языке
+WORDS = (
+    "космос спутник ракета запуск университет студенты олимпиада хакатон "
+    "исследование лаборатория физика математика робот нейросеть модель данные "
+    "стартап инвестиции технологии смартфон процессор чип энергия атом реактор "
+    "конференция грант стипендия программа курс школа наука учёные открытие "
+    "приложение сервис обновление платформа разработчики код безопасность"
+).split()
+VOCABULARY_SIZE = 20000
+LETTERS = "абвгдежзийклмнопрстуфхцчшщыэюя"
+# Доля слов, заменяемых в перепосте с правками (такие пары решает модель)
+REWRITE_SHARE = 0.35
+# Статусы ошибок подставного API: их повторяет регулятор и обходит роутинг
+ERROR_STATUSES = (429, 500, 502, 503)
+
+
+def build_vocabulary(seed: int) -> Tuple[List[str], List[float]]:
+    """Словарь синтетических постов и веса слов по закону Ципфа"""
+    rng = random.Random(seed)
+    words = list(WORDS) + [
+        "".join(rng.choices(LETTERS, k=rng.randint(3, 11)))
+        for _ in range(VOCABULARY_SIZE)
+    ]
+    rng.shuffle(words)
+    return words, [1 / (rank + 1) for rank in range(len(words))]
+
+
+def fake_api_error(stage: str, status: int) -> openai.APIStatusError:
+    """Ошибка провайдера того же типа, что бросает SDK openai"""
+    transport = http_transport()
+    request = transport.Request("POST", "https://bench.invalid/chat/completions")
+    response = transport.Response(status, request=request)
+    error_class = openai.RateLimitError if status == 429 else openai.InternalServerError
+    return error_class(f"fake API error in {stage}", response=response, body=None)
+
+
+@dataclass
+class FakeMessage:
+    """Сообщение Telegram с полями, которые читает конвейер"""
+
+    id: int
+    text: str
+
+
+@dataclass
+class CallLog:
+    """Длительности и число вызовов подставных бэкендов"""
+
+    latencies: Dict[str, List[float]] = field(default_factory=dict)
+    counts: Counter = field(default_factory=Counter)
+    errors: Counter = field(default_factory=Counter)
+
+    def add(self, kind: str, seconds: float) -> None:
+        self.counts[kind] += 1
+        self.latencies.setdefault(kind, []).append(seconds)
+
+
+def _delay(rng: random.Random, latency: float) -> float:
+    """Задержка с логнормальным разбросом вокруг latency"""
+    if latency <= 0:
+        return 0.0
+    return latency * rng.lognormvariate(0, 0.35)
+
+
+def _synthetic_text(
+    rng: random.Random, idx: int, vocabulary: Tuple[List[str], List[float]]
+) -> str:
+    """Синтетический пост из случайных слов"""
+    words = rng.choices(*vocabulary, k=rng.randint(15, 120))
+    return f"Новость {idx}: " + " ".join(words) + "."
+
+
+def _repost(
+    rng: random.Random, text: str, vocabulary: Tuple[List[str], List[float]]
+) -> str:
+    """Перепост: дословный с припиской или пересказ с заменой части слов"""
+    if rng.random() < 0.5:
+        return text + " Подробности в канале."
+    words = text.split()
+    for idx in rng.sample(range(len(words)), int(len(words) * REWRITE_SHARE)):
+        words[idx] = rng.choices(*vocabulary)[0]
+    return " ".join(words)
+
+
+def build_backlog(
+    items: int, channels: int, dup_rate: float, seed: int
+) -> Dict[str, List[FakeMessage]]:
+    """
+    Раскладывает items сообщений по channels каналам. Доля dup_rate -
+    перепосты уже созданных новостей: половина с припиской (их склеивает
+    локальная дедупликация), половина с заменой REWRITE_SHARE слов
+    (неоднозначные пары для модели).
+    """
+    rng = random.Random(seed)
+    vocabulary = build_vocabulary(seed)
+    usernames = [f"@bench_channel_{i}" for i in range(channels)]
+    backlog: Dict[str, List[FakeMessage]] = {name: [] for name in usernames}
+    texts: List[str] = []
+    for idx in range(items):
+        if texts and rng.random() < dup_rate:
+            text = _repost(rng, rng.choice(texts), vocabulary)
+        else:
+            text = _synthetic_text(rng, idx, vocabulary)
+            texts.append(text)
+        channel = backlog[usernames[idx % channels]]
+        channel.append(FakeMessage(id=len(channel) + 1, text=text))
+    return backlog
+
+
+class FakeTelegram:
+    """Подставной Telethon клиент: get_entity, get_messages, iter_messages"""
+
+    def __init__(
+        self,
+        backlog: Dict[str, List[FakeMessage]],
+        latency: float,
+        error_rate: float,
+        log: CallLog,
+        seed: int,
+    ) -> None:
+        self.backlog = backlog
+        self.latency = latency
+        self.error_rate = error_rate
+        self.log = log
+        self.sent: List[str] = []
+        self._rng = random.Random(seed)
+        self._ids = {name: idx + 1 for idx, name in enumerate(backlog)}
+        self._names = {idx: name for name, idx in self._ids.items()}
+
+    async def _call(self, kind: str) -> None:
+        started = time.perf_counter()
+        await asyncio.sleep(_delay(self._rng, self.latency))
+        self.log.add(f"telegram.{kind}", time.perf_counter() - started)
+        if self._rng.random() < self.error_rate:
+            self.log.errors[f"telegram.{kind}"] += 1
+            raise ConnectionError(f"fake telegram error in {kind}")
+
+    async def start(self) -> None:
+        pass
+
+    async def disconnect(self) -> None:
+        pass
+
+    async def get_entity(self, username: str) -> InputPeerChannel:
+        await self._call("get_entity")
+        return InputPeerChannel(self._ids[username], self._ids[username])
+
+    async def get_messages(self, entity: Any, limit: int = 1) -> List[FakeMessage]:
+        await self._call("get_messages")
+        messages = self.backlog[self._names[entity.channel_id]]
+        return list(reversed(messages[-limit:]))
+
+    async def iter_messages(
+        self,
+        entity: Any,
+        min_id: int = 0,
+        reverse: bool = False,
+        limit: Optional[int] = None,
+    ) -> Any:
+        # Telethon отдаёт сообщения страницами по 100 - столько же запросов
+        messages = [
+            msg
+            for msg in self.backlog[self._names[entity.channel_id]]
+            if msg.id > min_id
+        ]
+        if not reverse:
+            messages.reverse()
+        if limit:
+            messages = messages[:limit]
+        for start in range(0, max(1, len(messages)), 100):
+            await self._call("iter_messages")
+            for msg in messages[start : start + 100]:
+                yield msg
+
+    async def send_message(self, entity: Any, message: str, **kwargs: Any) -> None:
+        await self._call("send_message")
+        self.sent.append(message)
+
+
+class FakeCompletions:
+    """
+    Подставной chat.completions: по системному промпту определяет этап
+    и возвращает ответ нужной формы (ChatCompletion с usage).
+    """
+
+    def __init__(
+        self, latency: float, error_rate: float, log: CallLog, seed: int
+    ) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.log = log
+        self._rng = random.Random(seed)
+        self._stages = {
+            get_prompt("RATE_SYSTEM"): "rate",
+            get_prompt("RATE_BATCH_SYSTEM"): "rate_batch",
+            get_prompt("DEDUP_SYSTEM"): "dedup",
+            get_prompt("SUMMARIZE_SYSTEM"): "summarize",
+            get_prompt("FORMAT_SYSTEM"): "format",
+            get_prompt("DIGEST_SYSTEM"): "digest",
+        }
+
+    def _stage(self, request: Dict[str, Any]) -> str:
+        if request.get("tools"):
+            name = request["tools"][0]["function"]["name"]
+            return "moderate_batch" if name.startswith("batch") else "moderate"
+        return self._stages.get(request["messages"][0]["content"], "unknown")
+
+    def _content(self, stage: str, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Тело сообщения ассистента для этапа"""
+        # Запрос с новостями - первое сообщение пользователя (дальше могут быть правки)
+        user = request["messages"][min(1, len(request["messages"]) - 1)]["content"]
+        if stage in ("moderate", "moderate_batch"):
+            arguments = {
+                name: {"score": round(self._rng.uniform(0, 0.3), 2), "flags": []}
+                for name in CATEGORIES
+            }
+            if stage == "moderate_batch":
+                listing = user.split("КАТЕГОРИИ НАРУШЕНИЙ")[0]
+                count = len(re.findall(r"(?:^|\n)\d+\. ", listing))
+                arguments = {
+                    "items": [{"id": i + 1, **arguments} for i in range(count)]
+                }
+            return {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {
+                        "id": "call_0",
+                        "type": "function",
+                        "function": {
+                            "name": request["tools"][0]["function"]["name"],
+                            "arguments": json.dumps(arguments),
+                        },
+                    }
+                ],
+            }
+        if stage == "rate_batch":
+            count = len(re.findall(r"(?:^|\n\n)\d+\. ", user))
+            ratings = [
+                {"score": round(self._rng.random(), 2), "reasoning": "синтетика"}
+                for _ in range(count)
+            ]
+            text = json.dumps(ratings, ensure_ascii=False)
+        elif stage == "rate":
+            text = json.dumps({"score": round(self._rng.random(), 2), "reasoning": "-"})
+        elif stage == "dedup":
+            count = len(re.findall(r"(?:^|\n\n)ID \d+: ", user))
+            groups = [[i, i + 1] for i in range(0, count - 1, 7)]
+            text = json.dumps({"groups": groups})
+        elif stage == "summarize":
+            count = len(re.findall(r"(?:^|\n\n)\d+\. ", user))
+            text = "\n\n".join(
+                f"**Новость {i + 1}.** Кратко о главном. t.me/bench/{i + 1}"
+                for i in range(count)
+            )
+        elif stage == "digest":
+            count = len(re.findall(r"(?:^|\n\n)\d+\. ", user))
+            blocks = [
+                f"**Тема {start // 3 + 1}**\n"
+                + "\n".join(
+                    f"• Новость {i + 1}. Кратко о главном [bench](t.me/bench/{i + 1})"
+                    for i in range(start, min(count, start + 3))
+                )
+                for start in range(0, count, 3)
+            ]
+            text = "\n\n\n".join(["Подводка к дайджесту."] + blocks)
+        else:
+            text = "Подводка к дайджесту.\n\n" + user[-2000:]
+        return {"role": "assistant", "content": text}
+
+    async def create(self, **kwargs: Any) -> Any:
+        stage = self._stage(kwargs)
+        started = time.perf_counter()
+        delay = _delay(self._rng, self.latency)
+        if kwargs.get("stream"):
+            delay *= STREAM_FIRST_CHUNK_SHARE
+        await asyncio.sleep(delay)
+        self.log.add(f"llm.{stage}", time.perf_counter() - started)
+        if self._rng.random() < self.error_rate:
+            self.log.errors[f"llm.{stage}"] += 1
+            raise fake_api_error(stage, self._rng.choice(ERROR_STATUSES))
+
+        message = self._content(stage, kwargs)
+        completion_tokens = count_tokens(
+            message["content"] or json.dumps(message.get("tool_calls"))
+        )
+        usage = {
+            "prompt_tokens": count_messages(kwargs["messages"]),
+            "completion_tokens": completion_tokens,
+            "total_tokens": count_messages(kwargs["messages"]) + completion_tokens,
+        }
+        if kwargs.get("stream"):
+            return self._stream(message["content"], usage, delay)
+        return ChatCompletion.model_validate(
+            {
+                "id": "bench",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": kwargs.get("model") or "bench",
+                "choices": [
+                    {"index": 0, "message": message, "finish_reason": "stop"}
+                ],
+                "usage": usage,
+            }
+        )
+
+    async def _stream(
+        self, text: str, usage: Dict[str, int], delay: float
+    ) -> Any:
+        """Потоковый ответ: текст по строкам, usage в последнем фрагменте"""
+        lines = text.splitlines(keepends=True)
+        pause = delay * (1 / STREAM_FIRST_CHUNK_SHARE - 1) / max(1, len(lines))
+        base = {"id": "bench", "object": "chat.completion.chunk", "model": "bench"}
+        for i, line in enumerate(lines):
+            if i:
+                await asyncio.sleep(pause)
+            yield ChatCompletionChunk.model_validate(
+                {
+                    **base,
+                    "created": int(time.time()),
+                    "choices": [{"index": 0, "delta": {"content": line}}],
+                }
+            )
+        yield ChatCompletionChunk.model_validate(
+            {
+                **base,
+                "created": int(time.time()),
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+        )
+
+
+class FakeAsyncOpenAI:
+    """Подставной AsyncOpenAI с единственным методом chat.completions.create"""
+
+    def __init__(self, completions: FakeCompletions) -> None:
+        self.chat = type("Chat", (), {"completions": completions})()
+
+
+@dataclass
+class ScenarioResult:
+    """Результат одного прогона сценария"""
+
+    items: int
+    channels: int
+    collected: int
+    collect_seconds: float
+    publish_seconds: float
+    published: bool
+    log: CallLog
+    # Заполняется только в прогоне под tracemalloc
+    peak_memory_mb: Optional[float] = None
+
+
+def _parse_scenario(raw: str) -> Tuple[int, int]:
+    items, channels = raw.lower().split("x")
+    return int(items), int(channels)
+
+
+async def _run_pipeline(
+    telegram: FakeTelegram, log: CallLog
+) -> Tuple[int, float, float, bool]:
+    """Прогоняет сбор и публикацию, возвращает собранное и время этапов"""
+    started = time.perf_counter()
+    await logic.collect_news_async()
+    collect_seconds = time.perf_counter() - started
+    collected = sum(1 for _ in logic.iter_news_cache())
+
+    started = time.perf_counter()
+    published = await logic.publish_summary_async()
+    publish_seconds = time.perf_counter() - started
+    return collected, collect_seconds, publish_seconds, published and bool(
+        telegram.sent
+    )
+
+
+def run_scenario(
+    items: int,
+    channels: int,
+    args: argparse.Namespace,
+    seed: int,
+    trace_memory: bool = False,
+) -> ScenarioResult:
+    """
+    Прогоняет сценарий во временном каталоге со свежим состоянием.
+    С trace_memory прогон идёт под tracemalloc: он замедляет выполнение,
+    поэтому время из такого прогона в отчёт не попадает.
+    """
+    backlog = build_backlog(items, channels, args.dup_rate, seed)
+    log = CallLog()
+    telegram = FakeTelegram(
+        backlog, args.tg_latency_ms / 1000, args.tg_error_rate, log, seed
+    )
+    completions = FakeCompletions(
+        args.llm_latency_ms / 1000, args.error_rate, log, seed
+    )
+    ai = BoundedAsyncOpenAI(FakeAsyncOpenAI(completions))
+
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    cwd = os.getcwd()
+    saved_channels = logic.channel_usernames
+    os.chdir(workdir)
+    try:
+        logic.channel_usernames = list(backlog)
+        # Нулевой курсор: весь бэклог канала догружается через iter_messages
+        logic.save_channel_cursors({name: 0 for name in backlog})
+        set_context(
+            AppContext(telegram_factory=lambda: telegram, ai_factory=lambda: ai)
+        )
+
+        peak = None
+        if trace_memory:
+            tracemalloc.start()
+        try:
+            collected, collect_seconds, publish_seconds, published = asyncio.run(
+                _run_pipeline(telegram, log)
+            )
+            if trace_memory:
+                peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+    finally:
+        set_context(None)
+        logic.channel_usernames = saved_channels
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return ScenarioResult(
+        items=items,
+        channels=channels,
+        collected=collected,
+        collect_seconds=collect_seconds,
+        publish_seconds=publish_seconds,
+        published=published,
+        log=log,
+        peak_memory_mb=peak,
+    )
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Перцентиль методом ближайшего ранга"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def format_report(
+    results: List[List[ScenarioResult]], peaks: List[Optional[float]]
+) -> str:
+    """
+    Текстовый отчёт: пропускная способность, перцентили, вызовы и пиковая
+    память из отдельного прогона (peaks - по сценарию, None - не мерялась)
+    """
+    lines = []
+    for repeats, peak in zip(results, peaks):
+        first = repeats[0]
+        collect_median = statistics.median(r.collect_seconds for r in repeats)
+        publish_median = statistics.median(r.publish_seconds for r in repeats)
+        collected = first.collected
+        lines.append(
+            f"== {first.items} новостей / {first.channels} каналов "
+            f"({len(repeats)} прогонов) =="
+        )
+        lines.append(
+            f"сбор:       медиана {collect_median:.3f} с, "
+            f"{collected / max(collect_median, 1e-9):.0f} новостей/с "
+            f"(собрано {collected})"
+        )
+        lines.append(
+            f"публикация: медиана {publish_median:.3f} с, "
+            f"{collected / max(publish_median, 1e-9):.0f} новостей/с, "
+            f"опубликовано {sum(r.published for r in repeats)}/{len(repeats)}"
+        )
+        lines.append(
+            "память:     не измерялась"
+            if peak is None
+            else f"память:     пик {peak:.1f} МБ (отдельный прогон под tracemalloc)"
+        )
+
+        kinds = sorted({kind for r in repeats for kind in r.log.counts})
+        lines.append(
+            f"  {'вызов':<26}{'число':>8}{'ошибок':>8}"
+            f"{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}"
+        )
+        for kind in kinds:
+            latencies = [
+                value for r in repeats for value in r.log.latencies.get(kind, [])
+            ]
+            calls = sum(r.log.counts[kind] for r in repeats) / len(repeats)
+            errors = sum(r.log.errors[kind] for r in repeats) / len(repeats)
+            lines.append(
+                f"  {kind:<26}{calls:>8.0f}{errors:>8.0f}"
+                f"{percentile(latencies, 50) * 1000:>10.1f}"
+                f"{percentile(latencies, 95) * 1000:>10.1f}"
+                f"{percentile(latencies, 99) * 1000:>10.1f}"
+            )
+        lines.append("")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк конвейера")
+    parser.add_argument(
+        "-s",
+        "--scenario",
+        action="append",
+        help="сценарий NxM: N новостей в M каналах (можно несколько)",
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="прогонов на сценарий")
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--tg-latency-ms", type=float, default=50)
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="доля ошибок вызовов модели"
+    )
+    parser.add_argument(
+        "--tg-error-rate", type=float, default=0.0, help="доля ошибок Telegram"
+    )
+    parser.add_argument(
+        "--dup-rate", type=float, default=0.1, help="доля перепостов в бэклоге"
+    )
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="не делать отдельный прогон для замера памяти",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="дописать отчёт в файл (bench_output.txt)")
+    args = parser.parse_args()
+
+    results = []
+    peaks = []
+    for raw in args.scenario or DEFAULT_SCENARIOS:
+        items, channels = _parse_scenario(raw)
+        print(f"Сценарий {items}x{channels}...", file=sys.stderr)
+        results.append(
+            [
+                run_scenario(items, channels, args, args.seed + repeat)
+                for repeat in range(args.repeat)
+            ]
+        )
+        peaks.append(
+            None
+            if args.no_memory
+            else run_scenario(
+                items, channels, args, args.seed, trace_memory=True
+            ).peak_memory_mb
+        )
+
+    report = format_report(results, peaks)
+    print(report)
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
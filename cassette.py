@@ -0,0 +1,463 @@
+"""
+Модуль записи и воспроизведения трафика Telegram и LLM (кассеты).
+
+Режим задаётся CASSETTE_MODE:
+    record - клиенты работают как обычно, а сообщения каналов, ответы
+             модели и опубликованные дайджесты пишутся в CASSETTE_FILE;
+    replay - сеть не используется: сообщения и ответы модели берутся
+             из кассеты.
+
+Прогон по записанной кассете в чистом временном каталоге:
+    python cassette.py cassette.jsonl.gz [--latency] [--live-misses]
+"""
+import argparse
+import asyncio
+import atexit
+import datetime
+import gzip
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from telethon.tl.types import InputPeerChannel
+
+from llm_cache import request_key
+from metrics import record_response
+
+logger = logging.getLogger(__name__)
+
+# === Настройки кассеты ===
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "")
+CASSETTE_FILE = os.getenv("CASSETTE_FILE", "cassette.jsonl.gz")
+# При воспроизведении выдерживать записанное время ответа
+CASSETTE_REPLAY_LATENCY = os.getenv("CASSETTE_REPLAY_LATENCY", "0") != "0"
+
+
+class CassetteMiss(Exception):
+    """В кассете нет ответа на запрос"""
+
+
+class CassetteWriter:
+    """Дописывает записи кассеты в gzip JSONL (один JSON на строку)"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        # Режим "at" добавляет новый gzip-member: прошлые записи сохраняются
+        self._file = gzip.open(path, "at", encoding="utf-8")
+
+    def write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_writer: Optional[CassetteWriter] = None
+
+
+def get_writer() -> CassetteWriter:
+    """Общий писатель кассеты (закрывается при завершении процесса)"""
+    global _writer
+    if _writer is None:
+        _writer = CassetteWriter(CASSETTE_FILE)
+        atexit.register(_writer.close)
+        logger.info(f"Запись трафика в кассету {CASSETTE_FILE}")
+    return _writer
+
+
+@dataclass
+class Cassette:
+    """Содержимое кассеты, разложенное для воспроизведения"""
+
+    messages: Dict[str, Dict[int, Dict[str, Any]]] = field(default_factory=dict)
+    cursors: Dict[str, Optional[int]] = field(default_factory=dict)
+    llm: Dict[str, List[Dict[str, Any]]] = field(default_factory=dict)
+    sent: List[str] = field(default_factory=list)
+
+
+def load_cassette(path: str) -> Cassette:
+    """Читает кассету; повреждённый хвост (оборванная запись) пропускается"""
+    cassette = Cassette()
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                kind = record.get("type")
+                if kind == "messages":
+                    channel = record["channel"]
+                    stored = cassette.messages.setdefault(channel, {})
+                    for msg in record["messages"]:
+                        stored[msg["id"]] = msg
+                    # Курсор, с которого канал читался при записи (None - без курсора)
+                    min_id = record.get("min_id")
+                    if channel not in cassette.cursors:
+                        cassette.cursors[channel] = min_id
+                    elif min_id is None or cassette.cursors[channel] is None:
+                        cassette.cursors[channel] = None
+                    else:
+                        cassette.cursors[channel] = min(
+                            cassette.cursors[channel], min_id
+                        )
+                elif kind == "llm":
+                    cassette.llm.setdefault(record["key"], []).append(record)
+                elif kind == "sent":
+                    cassette.sent.append(record["text"])
+        except EOFError:
+            logger.warning(f"Кассета {path} оборвана, читаю записанное до обрыва")
+    return cassette
+
+
+def _message_record(msg: Any) -> Dict[str, Any]:
+    """Сохраняемые поля сообщения Telegram"""
+    date = getattr(msg, "date", None)
+    return {
+        "id": msg.id,
+        "text": getattr(msg, "text", None),
+        "date": date.isoformat() if date else None,
+    }
+
+
+class RecordedMessage(SimpleNamespace):
+    """Сообщение из кассеты с теми же атрибутами, что читает конвейер"""
+
+
+def _replay_message(record: Dict[str, Any]) -> RecordedMessage:
+    date = record.get("date")
+    return RecordedMessage(
+        id=record["id"],
+        text=record.get("text"),
+        date=datetime.datetime.fromisoformat(date) if date else None,
+    )
+
+
+def _channel_id(entity: Any) -> Optional[int]:
+    """ID канала у Channel (id) или InputPeerChannel (channel_id)"""
+    return getattr(entity, "channel_id", None) or getattr(entity, "id", None)
+
+
+class RecordingTelegram:
+    """Telethon клиент, записывающий сообщения каналов и отправки в кассету"""
+
+    def __init__(self, client: Any, writer: CassetteWriter) -> None:
+        self._client = client
+        self._writer = writer
+        self._usernames: Dict[int, str] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._client, name)
+
+    async def get_entity(self, entity: Any) -> Any:
+        result = await self._client.get_entity(entity)
+        if isinstance(entity, str) and _channel_id(result) is not None:
+            self._usernames[_channel_id(result)] = entity
+        return result
+
+    async def _username(self, entity: Any) -> str:
+        """Имя канала для InputPeer (при попадании в кэш сущностей - запросом)"""
+        channel_id = _channel_id(entity)
+        if channel_id not in self._usernames:
+            full = await self._client.get_entity(entity)
+            username = getattr(full, "username", None)
+            self._usernames[channel_id] = (
+                f"@{username}" if username else str(channel_id)
+            )
+        return self._usernames[channel_id]
+
+    def _record(
+        self, channel: str, min_id: Optional[int], messages: List[Any]
+    ) -> None:
+        self._writer.write(
+            {
+                "type": "messages",
+                "channel": channel,
+                "min_id": min_id,
+                "messages": [_message_record(msg) for msg in messages],
+            }
+        )
+
+    async def get_messages(self, entity: Any, *args: Any, **kwargs: Any) -> Any:
+        messages = await self._client.get_messages(entity, *args, **kwargs)
+        self._record(await self._username(entity), None, list(messages))
+        return messages
+
+    async def iter_messages(self, entity: Any, *args: Any, **kwargs: Any) -> Any:
+        messages = []
+        async for msg in self._client.iter_messages(entity, *args, **kwargs):
+            messages.append(msg)
+            yield msg
+        self._record(await self._username(entity), kwargs.get("min_id"), messages)
+
+    async def send_message(self, entity: Any, message: str, **kwargs: Any) -> Any:
+        result = await self._client.send_message(entity, message, **kwargs)
+        self._writer.write({"type": "sent", "text": message})
+        return result
+
+
+class ReplayTelegram:
+    """Telethon клиент, отдающий сообщения из кассеты без обращения к сети"""
+
+    def __init__(self, cassette: Cassette) -> None:
+        self._cassette = cassette
+        self._ids = {name: idx + 1 for idx, name in enumerate(cassette.messages)}
+        self._names = {idx: name for name, idx in self._ids.items()}
+        self.sent: List[str] = []
+
+    async def start(self) -> None:
+        pass
+
+    async def disconnect(self) -> None:
+        pass
+
+    async def get_entity(self, username: str) -> InputPeerChannel:
+        if username not in self._ids:
+            raise ValueError(f"Канала {username} нет в кассете")
+        return InputPeerChannel(self._ids[username], 0)
+
+    def _messages(self, entity: Any) -> List[Dict[str, Any]]:
+        stored = self._cassette.messages.get(self._names[entity.channel_id], {})
+        return [stored[msg_id] for msg_id in sorted(stored)]
+
+    async def get_messages(self, entity: Any, limit: int = 1, **kwargs: Any) -> list:
+        records = self._messages(entity)[-limit:]
+        return [_replay_message(record) for record in reversed(records)]
+
+    async def iter_messages(
+        self,
+        entity: Any,
+        min_id: int = 0,
+        reverse: bool = False,
+        limit: Optional[int] = None,
+        **kwargs: Any,
+    ) -> Any:
+        records = [
+            record for record in self._messages(entity) if record["id"] > min_id
+        ]
+        if not reverse:
+            records.reverse()
+        for record in records[:limit] if limit else records:
+            yield _replay_message(record)
+
+    async def send_message(self, entity: Any, message: str, **kwargs: Any) -> None:
+        self.sent.append(message)
+        logger.info(f"Воспроизведение: сообщение для {entity} не отправляется")
+
+
+class _RecordingCompletions:
+    """chat.completions, записывающий запросы и ответы в кассету"""
+
+    def __init__(self, completions: Any, writer: CassetteWriter) -> None:
+        self._completions = completions
+        self._writer = writer
+
+    async def create(self, **kwargs: Any) -> Any:
+        started = time.perf_counter()
+        response = await self._completions.create(**kwargs)
+        if kwargs.get("stream"):
+            return self._record_stream(request_key(kwargs), response, started)
+        if hasattr(response, "model_dump"):
+            self._writer.write(
+                {
+                    "type": "llm",
+                    "key": request_key(kwargs),
+                    "elapsed": round(time.perf_counter() - started, 3),
+                    "response": response.model_dump(mode="json"),
+                }
+            )
+        return response
+
+    async def _record_stream(self, key: str, stream: Any, started: float) -> Any:
+        """Пропускает потоковый ответ дальше и записывает его фрагменты"""
+        chunks = []
+        async for chunk in stream:
+            chunks.append(chunk.model_dump(mode="json"))
+            yield chunk
+        self._writer.write(
+            {
+                "type": "llm",
+                "key": key,
+                "elapsed": round(time.perf_counter() - started, 3),
+                "chunks": chunks,
+            }
+        )
+
+
+class _ReplayCompletions:
+    """
+    chat.completions, отвечающий из кассеты по ключу запроса.
+    Повторы одного запроса получают записанные ответы по очереди.
+    """
+
+    def __init__(self, cassette: Cassette, live: Optional[Any] = None) -> None:
+        self._cassette = cassette
+        self._live = live
+        self._served: Dict[str, int] = {}
+        self.misses = 0
+
+    async def create(self, **kwargs: Any) -> Any:
+        key = request_key(kwargs)
+        records = self._cassette.llm.get(key)
+        if not records:
+            self.misses += 1
+            if self._live is not None:
+                return await self._live.chat.completions.create(**kwargs)
+            raise CassetteMiss(f"Нет записанного ответа для запроса {key[:12]}")
+
+        idx = self._served.get(key, 0)
+        self._served[key] = idx + 1
+        record = records[min(idx, len(records) - 1)]
+        if CASSETTE_REPLAY_LATENCY:
+            await asyncio.sleep(record.get("elapsed", 0))
+        if "chunks" in record:
+            # usage потокового ответа учитывает тот, кто читает фрагменты
+            record_response(None)
+            return _replay_stream(record["chunks"])
+        response = ChatCompletion.model_validate(record["response"])
+        record_response(response)
+        return response
+
+
+async def _replay_stream(chunks: List[Dict[str, Any]]) -> Any:
+    """Потоковый ответ из записанных фрагментов"""
+    for chunk in chunks:
+        yield ChatCompletionChunk.model_validate(chunk)
+
+
+class _CompletionsClient:
+    """Клиент с подменённым chat.completions; прочее берётся из исходного"""
+
+    def __init__(self, completions: Any, client: Optional[Any] = None) -> None:
+        self._client = client
+        self.chat = SimpleNamespace(completions=completions)
+
+    def __getattr__(self, name: str) -> Any:
+        if self._client is None:
+            raise AttributeError(name)
+        return getattr(self._client, name)
+
+
+def replay_ai(cassette: Cassette, live: Optional[Any] = None) -> Any:
+    """Асинхронный LLM клиент, отвечающий из кассеты"""
+    return _CompletionsClient(_ReplayCompletions(cassette, live))
+
+
+def cassette_telegram(factory: Callable[[], Any]) -> Any:
+    """Создаёт Telegram клиент с учётом CASSETTE_MODE"""
+    if CASSETTE_MODE == "replay":
+        return ReplayTelegram(load_cassette(CASSETTE_FILE))
+    client = factory()
+    if CASSETTE_MODE == "record":
+        return RecordingTelegram(client, get_writer())
+    return client
+
+
+def cassette_ai(factory: Callable[[], Any]) -> Any:
+    """Создаёт асинхронный LLM клиент с учётом CASSETTE_MODE"""
+    if CASSETTE_MODE == "replay":
+        return replay_ai(load_cassette(CASSETTE_FILE))
+    client = factory()
+    if CASSETTE_MODE == "record":
+        return _CompletionsClient(
+            _RecordingCompletions(client.chat.completions, get_writer()), client
+        )
+    return client
+
+
+def _digest_body(message: str) -> str:
+    """Текст дайджеста без заголовка с датой"""
+    return message.split("\n\n", 1)[-1]
+
+
+async def _replay_run(telegram: ReplayTelegram) -> Dict[str, Any]:
+    """Сбор и публикация на воспроизводимых клиентах"""
+    import logic
+
+    started = time.perf_counter()
+    await logic.collect_news_async()
+    collect_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    published = await logic.publish_summary_async()
+    return {
+        "collect_seconds": round(collect_seconds, 3),
+        "publish_seconds": round(time.perf_counter() - started, 3),
+        "published": published and bool(telegram.sent),
+    }
+
+
+def main() -> None:
+    import logic
+    from context import AppContext, get_context, set_context
+    from llm import get_async_client
+
+    parser = argparse.ArgumentParser(description="Прогон конвейера по кассете")
+    parser.add_argument("path", help="файл кассеты")
+    parser.add_argument(
+        "--latency", action="store_true", help="выдерживать записанное время ответов"
+    )
+    parser.add_argument(
+        "--live-misses",
+        action="store_true",
+        help="отправлять в модель запросы, которых нет в кассете (новые промпты)",
+    )
+    args = parser.parse_args()
+
+    global CASSETTE_REPLAY_LATENCY
+    CASSETTE_REPLAY_LATENCY = args.latency
+    cassette = load_cassette(os.path.abspath(args.path))
+    telegram = ReplayTelegram(cassette)
+    completions = _ReplayCompletions(
+        cassette, get_async_client() if args.live_misses else None
+    )
+
+    workdir = tempfile.mkdtemp(prefix="replay_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        logic.channel_usernames = list(cassette.messages)
+        cursors = {
+            name: cursor
+            for name, cursor in cassette.cursors.items()
+            if cursor is not None
+        }
+        logic.save_channel_cursors(cursors)
+        set_context(
+            AppContext(
+                telegram_factory=lambda: telegram,
+                ai_factory=lambda: _CompletionsClient(completions),
+            )
+        )
+        result = get_context().run(_replay_run(telegram))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result["llm_misses"] = completions.misses
+    result["same_digest"] = bool(cassette.sent and telegram.sent) and (
+        _digest_body(telegram.sent[-1]) == _digest_body(cassette.sent[-1])
+    )
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    main()
@@ -1,22 +1,218 @@
-import os
+import asyncio
 import json
 import logging
-from typing import Dict, Any, Optional
+import os
+from typing import Dict, Any, List, Optional, Tuple
 
 from openai import OpenAI
+from llm import get_async_client, get_client
+from llm_cache import discard
 from loader import get_prompt
+from metrics import record_retry
+from prefilter import is_clean
+from routing import primary_model, route, route_async
+from tokens import (
+    ITEM_MAX_TOKENS,
+    LLM_MAX_OUTPUT_TOKENS,
+    count_messages,
+    count_tokens,
+    input_budget,
+    output_budget,
+    pack,
+    trim_to_tokens,
+)
 
 logger = logging.getLogger(__name__)
 
 
 def _default_client() -> OpenAI:
-    """Создаёт клиент OpenAI по умолчанию"""
-    return OpenAI(
-        base_url=os.getenv("OPENAI_BASE_URL", "https://openrouter.ai/api/v1"),
-        api_key=os.getenv("OPENROUTER_API_KEY"),
+    """Возвращает общий клиент OpenAI (ответы кэшируются)"""
+    return get_client()
+
+
+# Категории нарушений в порядке схемы модерации
+CATEGORIES = (
+    "violence",
+    "hate_speech",
+    "adult_content",
+    "self_harm",
+    "misinformation",
+    "government_content",
+)
+
+CATEGORY_DESCRIPTIONS = {
+    "violence": "Оценка насилия 0-1",
+    "hate_speech": "Оценка разжигания ненависти 0-1",
+    "adult_content": "Оценка взрослого контента 0-1",
+    "self_harm": "Оценка самоповреждения 0-1",
+    "misinformation": "Оценка дезинформации 0-1",
+    "government_content": "Оценка контента о власти 0-1",
+}
+
+# Явно чистый текст (без слов из словаря prefilter) не отправляется в модель
+MODERATION_PREFILTER = os.getenv("MODERATION_PREFILTER", "1") != "0"
+
+# === Настройки пакетной модерации ===
+MODERATION_BATCH_SIZE = int(os.getenv("MODERATION_BATCH_SIZE", "10"))
+# Сколько раз переспрашивать пакетом тексты, пропущенные в ответе модели
+MODERATION_BATCH_RETRIES = 1
+MODERATION_BASE_TOKENS = 50
+# Оценки и цитаты по шести категориям для одного текста
+MODERATION_TOKENS_PER_ITEM = 200
+
+
+def category_schema() -> Dict[str, Any]:
+    """JSON-схема оценок по всем категориям (общая для одиночной и пакетной)"""
+    return {
+        category: {
+            "type": "object",
+            "properties": {
+                "score": {
+                    "type": "number",
+                    "description": CATEGORY_DESCRIPTIONS[category],
+                },
+                "flags": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                },
+            },
+        }
+        for category in CATEGORIES
+    }
+
+
+def _moderation_request(text: str, model: Optional[str]) -> dict:
+    """Собирает запрос модерации с function calling"""
+    return dict(
+        model=model,
+        messages=[
+            dict(
+                role="user",
+                content=get_prompt(
+                    "MODERATE_USER", text=text, guide=get_prompt("MODERATE_GUIDE")
+                ),
+            )
+        ],
+        tools=[
+            {
+                "type": "function",
+                "function": {
+                    "name": "content_moderation",
+                    "description": "Анализ контента на предмет нарушений для социальной сети",
+                    "parameters": {
+                        "type": "object",
+                        "properties": category_schema(),
+                        "required": list(CATEGORIES),
+                    },
+                },
+            }
+        ],
+        tool_choice={
+            "type": "function",
+            "function": {"name": "content_moderation"},
+        },
+        temperature=0.1,
+        max_tokens=1000,
     )
 
 
+def _batch_moderation_request(texts: List[str], model: Optional[str]) -> dict:
+    """Собирает запрос модерации пакета текстов одним вызовом функции"""
+    numbered_items = "\n\n".join(
+        f"{i + 1}. {text}" for i, text in enumerate(texts)
+    )
+    messages = [
+        dict(
+            role="user",
+            content=get_prompt(
+                "MODERATE_BATCH_USER",
+                numbered_items=numbered_items,
+                guide=get_prompt("MODERATE_GUIDE"),
+            ),
+        )
+    ]
+    expected = MODERATION_BASE_TOKENS + MODERATION_TOKENS_PER_ITEM * len(texts)
+    return dict(
+        model=model,
+        messages=messages,
+        tools=[
+            {
+                "type": "function",
+                "function": {
+                    "name": "batch_content_moderation",
+                    "description": "Анализ пакета текстов на предмет нарушений",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "items": {
+                                "type": "array",
+                                "items": {
+                                    "type": "object",
+                                    "properties": {
+                                        "id": {
+                                            "type": "integer",
+                                            "description": "Номер текста в списке",
+                                        },
+                                        **category_schema(),
+                                    },
+                                    "required": ["id", *CATEGORIES],
+                                },
+                            }
+                        },
+                        "required": ["items"],
+                    },
+                },
+            }
+        ],
+        tool_choice={
+            "type": "function",
+            "function": {"name": "batch_content_moderation"},
+        },
+        temperature=0.1,
+        max_tokens=output_budget(model, count_messages(messages, model), expected),
+    )
+
+
+def _prefilter_response(text: str) -> Optional[Dict[str, Any]]:
+    """
+    Результат модерации без вызова модели для явно чистого текста
+    (None - текст нужно проверить моделью)
+    """
+    if not MODERATION_PREFILTER or not is_clean(text):
+        return None
+    return {
+        "categories": {
+            category: {"score": 0.0, "flags": []} for category in CATEGORIES
+        },
+        "prefilter": True,
+    }
+
+
+def _has_scores(result: Any) -> bool:
+    """Во всех категориях есть числовая оценка (её читает should_block_content)"""
+    return isinstance(result, dict) and all(
+        isinstance(result.get(category), dict)
+        and isinstance(result[category].get("score"), (int, float))
+        and not isinstance(result[category]["score"], bool)
+        for category in CATEGORIES
+    )
+
+
+def _parse_moderation(request: dict, completion: Any, text: str) -> Dict[str, Any]:
+    """Извлекает результат из function call"""
+    try:
+        tool_call = completion.choices[0].message.tool_calls[0]
+        result = json.loads(tool_call.function.arguments)
+        if not _has_scores(result):
+            raise ValueError("Invalid moderation response: missing category score")
+    except Exception:
+        discard(request)
+        raise
+
+    logger.info(f"Успешная модерация контента: {text[:50]}...")
+    return {"categories": result}
+
+
 def moderate_content(text: str, client: Optional[OpenAI] = None) -> Dict[str, Any]:
     """
     Модерирует контент с использованием function calling.
@@ -24,162 +220,266 @@ def moderate_content(text: str, client: Optional[OpenAI] = None) -> Dict[str, An
     
     Args:
         text: Текст для модерации
-        client: Экземпляр OpenAI клиента (создаёт новый, если не предоставлен)
+        client: Экземпляр OpenAI клиента (общий клиент, если не предоставлен)
         
     Returns:
         Словарь с категориями модерации и оценками
     """
+    prefiltered = _prefilter_response(text)
+    if prefiltered is not None:
+        logger.info(f"Контент чист по словарю, модель не нужна: {text[:50]}...")
+        return prefiltered
+
     if client is None:
         client = _default_client()
     
-    model = os.getenv("MODEL")
-    
     try:
-        completion = client.chat.completions.create(
-            model=model,
-            messages=[
-                dict(
-                    role="user",
-                    content=get_prompt("MODERATE_USER", text=text),
-                )
-            ],
-            tools=[
-                {
-                    "type": "function",
-                    "function": {
-                        "name": "content_moderation",
-                        "description": "Анализ контента на предмет нарушений для социальной сети",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "violence": {
-                                    "type": "object",
-                                    "properties": {
-                                        "score": {
-                                            "type": "number",
-                                            "description": "Оценка насилия 0-1",
-                                        },
-                                        "flags": {
-                                            "type": "array",
-                                            "items": {"type": "string"},
-                                        },
-                                    },
-                                },
-                                "hate_speech": {
-                                    "type": "object",
-                                    "properties": {
-                                        "score": {
-                                            "type": "number",
-                                            "description": "Оценка разжигания ненависти 0-1",
-                                        },
-                                        "flags": {
-                                            "type": "array",
-                                            "items": {"type": "string"},
-                                        },
-                                    },
-                                },
-                                "adult_content": {
-                                    "type": "object",
-                                    "properties": {
-                                        "score": {
-                                            "type": "number",
-                                            "description": "Оценка взрослого контента 0-1",
-                                        },
-                                        "flags": {
-                                            "type": "array",
-                                            "items": {"type": "string"},
-                                        },
-                                    },
-                                },
-                                "self_harm": {
-                                    "type": "object",
-                                    "properties": {
-                                        "score": {
-                                            "type": "number",
-                                            "description": "Оценка самоповреждения 0-1",
-                                        },
-                                        "flags": {
-                                            "type": "array",
-                                            "items": {"type": "string"},
-                                        },
-                                    },
-                                },
-                                "misinformation": {
-                                    "type": "object",
-                                    "properties": {
-                                        "score": {
-                                            "type": "number",
-                                            "description": "Оценка дезинформации 0-1",
-                                        },
-                                        "flags": {
-                                            "type": "array",
-                                            "items": {"type": "string"},
-                                        },
-                                    },
-                                },
-                                "government_content": {
-                                    "type": "object",
-                                    "properties": {
-                                        "score": {
-                                            "type": "number",
-                                            "description": "Оценка контента о власти 0-1",
-                                        },
-                                        "flags": {
-                                            "type": "array",
-                                            "items": {"type": "string"},
-                                        },
-                                    },
-                                },
-                            },
-                            "required": [
-                                "violence",
-                                "hate_speech",
-                                "adult_content",
-                                "self_harm",
-                                "misinformation",
-                                "government_content",
-                            ],
-                        },
-                    },
-                }
-            ],
-            tool_choice={
-                "type": "function",
-                "function": {"name": "content_moderation"},
-            },
-            temperature=0.1,
-            max_tokens=1000,
+        request, completion = route(
+            "moderate", lambda model: _moderation_request(text, model), client
         )
+        return _parse_moderation(request, completion, text)
 
-        # Извлекаем результат из function call
-        tool_call = completion.choices[0].message.tool_calls[0]
-        result = json.loads(tool_call.function.arguments)
+    except Exception as e:
+        logger.error(f"Ошибка модерации: {str(e)}")
+        return _get_error_response(str(e))
 
-        logger.info(f"Успешная модерация контента: {text[:50]}...")
-        return {"categories": result}
+
+async def moderate_content_async(
+    text: str, client: Optional[Any] = None
+) -> Dict[str, Any]:
+    """Асинхронный вариант moderate_content (общий AsyncOpenAI клиент по умолчанию)"""
+    prefiltered = _prefilter_response(text)
+    if prefiltered is not None:
+        logger.info(f"Контент чист по словарю, модель не нужна: {text[:50]}...")
+        return prefiltered
+
+    if client is None:
+        client = get_async_client()
+
+    try:
+        request, completion = await route_async(
+            "moderate", lambda model: _moderation_request(text, model), client
+        )
+        return _parse_moderation(request, completion, text)
 
     except Exception as e:
         logger.error(f"Ошибка модерации: {str(e)}")
         return _get_error_response(str(e))
 
 
+def _parse_batch(
+    request: dict, completion: Any, count: int
+) -> Dict[int, Dict[str, Any]]:
+    """
+    Извлекает результаты пакетной модерации по номерам текстов.
+    Элементы без номера или без числовой оценки какой-либо категории
+    пропускаются (их переспросят, затем отмодерируют по одному).
+    """
+    try:
+        tool_call = completion.choices[0].message.tool_calls[0]
+        items = json.loads(tool_call.function.arguments)["items"]
+    except Exception:
+        discard(request)
+        raise
+
+    results = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        idx = item.get("id")
+        if not isinstance(idx, int) or not 1 <= idx <= count:
+            continue
+        if _has_scores(item):
+            results[idx - 1] = {
+                "categories": {category: item[category] for category in CATEGORIES}
+            }
+    if not results:
+        discard(request)
+    return results
+
+
+def _moderation_chunks(
+    texts: List[str], chunk_size: Optional[int], model: Optional[str]
+) -> List[Tuple[int, int]]:
+    """
+    Делит тексты на пакеты: не больше chunk_size текстов и не больше, чем
+    помещается в контекст модели вместе с ответом на них.
+    """
+    size = max(1, chunk_size or MODERATION_BATCH_SIZE)
+    size = min(size, max(1, LLM_MAX_OUTPUT_TOKENS // MODERATION_TOKENS_PER_ITEM))
+    overhead = count_tokens(
+        get_prompt(
+            "MODERATE_BATCH_USER",
+            numbered_items="",
+            guide=get_prompt("MODERATE_GUIDE"),
+        ),
+        model,
+    )
+    budget = input_budget(
+        model, MODERATION_BASE_TOKENS + MODERATION_TOKENS_PER_ITEM * size, overhead
+    )
+    # "N. " и пустая строка между текстами
+    costs = [count_tokens(text, model) + 4 for text in texts]
+    return pack(costs, budget, size)
+
+
+def _log_missing(missing: List[int], total: int, attempt: int) -> None:
+    if attempt < MODERATION_BATCH_RETRIES:
+        logger.warning(
+            f"Пакетная модерация: нет результатов для {len(missing)} из {total} "
+            f"текстов, переспрашиваю"
+        )
+        record_retry()
+    else:
+        logger.warning(
+            f"Пакетная модерация: {len(missing)} из {total} текстов "
+            f"модерируются по одному"
+        )
+
+
+def _moderate_chunk(texts: List[str], client: Any) -> List[Dict[str, Any]]:
+    """Модерирует пакет; пропущенные тексты переспрашивает, затем по одному"""
+    results: List[Optional[Dict[str, Any]]] = [None] * len(texts)
+    missing = list(range(len(texts)))
+    for attempt in range(MODERATION_BATCH_RETRIES + 1):
+        subset = [texts[i] for i in missing]
+        try:
+            request, completion = route(
+                "moderate",
+                lambda model: _batch_moderation_request(subset, model),
+                client,
+            )
+            parsed = _parse_batch(request, completion, len(subset))
+        except Exception as e:
+            logger.error(f"Ошибка пакетной модерации: {e}")
+            parsed = {}
+        for local, result in parsed.items():
+            results[missing[local]] = result
+        missing = [i for i in missing if results[i] is None]
+        if not missing:
+            return results
+        _log_missing(missing, len(texts), attempt)
+
+    for i in missing:
+        results[i] = moderate_content(texts[i], client)
+    return results
+
+
+async def _moderate_chunk_async(
+    texts: List[str], client: Any
+) -> List[Dict[str, Any]]:
+    """Асинхронный вариант _moderate_chunk"""
+    results: List[Optional[Dict[str, Any]]] = [None] * len(texts)
+    missing = list(range(len(texts)))
+    for attempt in range(MODERATION_BATCH_RETRIES + 1):
+        subset = [texts[i] for i in missing]
+        try:
+            request, completion = await route_async(
+                "moderate",
+                lambda model: _batch_moderation_request(subset, model),
+                client,
+            )
+            parsed = _parse_batch(request, completion, len(subset))
+        except Exception as e:
+            logger.error(f"Ошибка пакетной модерации: {e}")
+            parsed = {}
+        for local, result in parsed.items():
+            results[missing[local]] = result
+        missing = [i for i in missing if results[i] is None]
+        if not missing:
+            return results
+        _log_missing(missing, len(texts), attempt)
+
+    fallback = await asyncio.gather(
+        *(moderate_content_async(texts[i], client) for i in missing)
+    )
+    for i, result in zip(missing, fallback):
+        results[i] = result
+    return results
+
+
+def _prefilter_all(texts: List[str]) -> Tuple[List[Any], List[int]]:
+    """Результаты для явно чистых текстов и индексы текстов для модели"""
+    results = [_prefilter_response(text) for text in texts]
+    suspicious = [i for i, result in enumerate(results) if result is None]
+    if len(suspicious) < len(texts):
+        logger.info(
+            f"Пакетная модерация: {len(texts) - len(suspicious)} из {len(texts)} "
+            f"текстов чисты по словарю"
+        )
+    return results, suspicious
+
+
+def moderate_batch(
+    texts: List[str],
+    client: Optional[OpenAI] = None,
+    chunk_size: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Модерирует список текстов пакетами по одному вызову функции на пакет.
+
+    Явно чистые тексты (см. prefilter) в модель не отправляются. Тексты,
+    пропущенные в ответе модели, переспрашиваются пакетом
+    (MODERATION_BATCH_RETRIES раз), а затем модерируются по одному.
+
+    Args:
+        texts: Тексты для модерации
+        client: Экземпляр OpenAI клиента (общий клиент, если не предоставлен)
+        chunk_size: Максимальный размер пакета (по умолчанию MODERATION_BATCH_SIZE)
+
+    Returns:
+        Результаты в формате moderate_content() в порядке texts
+    """
+    results, suspicious = _prefilter_all(texts)
+    if not suspicious:
+        return results
+    if client is None:
+        client = _default_client()
+
+    model = primary_model("moderate")
+    pending = [trim_to_tokens(texts[i], ITEM_MAX_TOKENS, model) for i in suspicious]
+    moderated = []
+    for start, end in _moderation_chunks(pending, chunk_size, model):
+        moderated.extend(_moderate_chunk(pending[start:end], client))
+    for i, result in zip(suspicious, moderated):
+        results[i] = result
+    return results
+
+
+async def moderate_batch_async(
+    texts: List[str],
+    client: Optional[Any] = None,
+    chunk_size: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Асинхронный вариант moderate_batch: пакеты выполняются конкурентно"""
+    results, suspicious = _prefilter_all(texts)
+    if not suspicious:
+        return results
+    if client is None:
+        client = get_async_client()
+
+    model = primary_model("moderate")
+    pending = [trim_to_tokens(texts[i], ITEM_MAX_TOKENS, model) for i in suspicious]
+    parts = await asyncio.gather(
+        *(
+            _moderate_chunk_async(pending[start:end], client)
+            for start, end in _moderation_chunks(pending, chunk_size, model)
+        )
+    )
+    moderated = [result for part in parts for result in part]
+    for i, result in zip(suspicious, moderated):
+        results[i] = result
+    return results
+
+
 def _get_error_response(error_message: str) -> Dict[str, Any]:
     """Возвращает ответ при ошибке (все категории 1.0 с флагом ошибки)"""
     error_categories = {}
-    categories_list = [
-        "violence",
-        "hate_speech",
-        "adult_content",
-        "self_harm",
-        "misinformation",
-        "government_content",
-    ]
-
-    for i, category in enumerate(categories_list):
+    for i, category in enumerate(CATEGORIES):
         flags = [error_message] if i == 0 else []
         error_categories[category] = {"score": 1.0, "flags": flags}
 
-    return {"categories": error_categories}
+    return {"categories": error_categories, "error": True}
 
 
 def should_block_content(moderation_result: Dict[str, Any]) -> bool:
@@ -211,6 +511,51 @@ def should_block_content(moderation_result: Dict[str, Any]) -> bool:
     return False
 
 
+def _review_from_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Превращает результат модерации в решение рецензента и правки"""
+    # Очень мягкая логика: одобрять, если нет экстремальных нарушений
+    if not should_block_content(result):
+        # даже при наличии замечаний даём мягкую обратную связь, но одобряем
+        categories = result.get("categories", {})
+        issues = []
+        for name, data in categories.items():
+            score = data.get("score", 0.0)
+            flags = data.get("flags", [])
+            if score >= 0.85:  # мягкий порог для рекомендаций
+                example = f" ('{flags[0]}')" if flags else ""
+                issues.append(f"{name}: смягчить формулировки{example}")
+        feedback = ("Небольшие правки: " + ", ".join(issues)) if issues else ""
+        return {"approved": True, "feedback": feedback}
+
+    # Сформировать краткие рекомендации по категориям с высокими оценками
+    categories = result.get("categories", {})
+    issues = []
+    for name, data in categories.items():
+        score = data.get("score", 0.0)
+        flags = data.get("flags", [])
+        if score >= 0.98:  # блокируем только экстремальные случаи
+            example = f" ('{flags[0]}')" if flags else ""
+            issues.append(
+                f"{name}: удалить или радикально переформулировать проблемные фразы{example}"
+            )
+
+    feedback = (
+        "Обнови сводку, устранив нарушения: " + ", ".join(issues)
+        if issues
+        else "Перепроверь нейтральность формулировок и избегай оценочных суждений."
+    )
+    return {"approved": False, "feedback": feedback}
+
+
+def _review_error(e: Exception) -> Dict[str, Any]:
+    """Решение рецензента, если модерацию провести не удалось"""
+    logger.error(f"Ошибка review_summary: {e}")
+    return {
+        "approved": False,
+        "feedback": "Не удалось провести модерацию. Смягчи формулировки и проверь нейтральность.",
+    }
+
+
 def review_summary(text: str, client: Optional[OpenAI] = None) -> Dict[str, Any]:
     """
     Рецензирует готовый дайджест: возвращает approved (bool) и feedback (str)
@@ -218,51 +563,25 @@ def review_summary(text: str, client: Optional[OpenAI] = None) -> Dict[str, Any]
     
     Args:
         text: Текст дайджеста для рецензии
-        client: Экземпляр OpenAI клиента (создаёт новый, если не предоставлен)
+        client: Экземпляр OpenAI клиента (общий клиент, если не предоставлен)
         
     Returns:
         Словарь с 'approved' (bool) и 'feedback' (str)
     """
     try:
-        result = moderate_content(text, client)
-        # Очень мягкая логика: одобрять, если нет экстремальных нарушений
-        if not should_block_content(result):
-            # даже при наличии замечаний даём мягкую обратную связь, но одобряем
-            categories = result.get("categories", {})
-            issues = []
-            for name, data in categories.items():
-                score = data.get("score", 0.0)
-                flags = data.get("flags", [])
-                if score >= 0.85:  # мягкий порог для рекомендаций
-                    example = f" ('{flags[0]}')" if flags else ""
-                    issues.append(f"{name}: смягчить формулировки{example}")
-            feedback = ("Небольшие правки: " + ", ".join(issues)) if issues else ""
-            return {"approved": True, "feedback": feedback}
-
-        # Сформировать краткие рекомендации по категориям с высокими оценками
-        categories = result.get("categories", {})
-        issues = []
-        for name, data in categories.items():
-            score = data.get("score", 0.0)
-            flags = data.get("flags", [])
-            if score >= 0.98:  # блокируем только экстремальные случаи
-                example = f" ('{flags[0]}')" if flags else ""
-                issues.append(
-                    f"{name}: удалить или радикально переформулировать проблемные фразы{example}"
-                )
-
-        feedback = (
-            "Обнови сводку, устранив нарушения: " + ", ".join(issues)
-            if issues
-            else "Перепроверь нейтральность формулировок и избегай оценочных суждений."
-        )
-        return {"approved": False, "feedback": feedback}
+        return _review_from_result(moderate_content(text, client))
     except Exception as e:
-        logger.error(f"Ошибка review_summary: {e}")
-        return {
-            "approved": False,
-            "feedback": "Не удалось провести модерацию. Смягчи формулировки и проверь нейтральность.",
-        }
+        return _review_error(e)
+
+
+async def review_summary_async(
+    text: str, client: Optional[Any] = None
+) -> Dict[str, Any]:
+    """Асинхронный вариант review_summary"""
+    try:
+        return _review_from_result(await moderate_content_async(text, client))
+    except Exception as e:
+        return _review_error(e)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+
+from entities import INVALIDATING_ERRORS, EntityCache, resolve_entity
+from metrics import record_retry, stage
+
+logger = logging.getLogger(__name__)
+
+# === Настройки сбора ===
+COLLECT_CONCURRENCY = int(os.getenv("COLLECT_CONCURRENCY", "8"))
+FLOOD_WAIT_RETRIES = int(os.getenv("FLOOD_WAIT_RETRIES", "3"))
+FLOOD_WAIT_MAX_SECONDS = int(os.getenv("FLOOD_WAIT_MAX_SECONDS", "300"))
+# Сколько сообщений брать с канала, для которого ещё нет курсора
+MESSAGES_LIMIT = 13
+# Максимум сообщений с канала за один проход (0 - без ограничения);
+# остаток догружается на следующем проходе, курсор не перескакивает
+COLLECT_MAX_PER_CHANNEL = int(os.getenv("COLLECT_MAX_PER_CHANNEL", "500"))
+
+
+@dataclass
+class ChannelFetch:
+    """Результат загрузки сообщений одного канала"""
+
+    username: str
+    messages: List[Any] = field(default_factory=list)
+    cursor: Optional[int] = None
+    error: Optional[Exception] = None
+
+
+def _next_cursor(messages: List[Any], cursor: Optional[int]) -> Optional[int]:
+    """Возвращает новую верхнюю границу ID с учётом загруженных сообщений"""
+    ids = [msg.id for msg in messages]
+    if cursor is not None:
+        ids.append(cursor)
+    return max(ids) if ids else None
+
+
+async def _fetch_messages(
+    client: TelegramClient, entity: Any, cursor: Optional[int]
+) -> List[Any]:
+    """Загружает сообщения новее курсора, постранично и от старых к новым"""
+    if cursor is None:
+        return list(await client.get_messages(entity, limit=MESSAGES_LIMIT))
+
+    messages = []
+    async for msg in client.iter_messages(
+        entity,
+        min_id=cursor,
+        reverse=True,
+        limit=COLLECT_MAX_PER_CHANNEL or None,
+    ):
+        messages.append(msg)
+    return messages
+
+
+async def fetch_channel(
+    client: TelegramClient,
+    username: str,
+    semaphore: asyncio.Semaphore,
+    cursor: Optional[int] = None,
+    entity_cache: Optional[EntityCache] = None,
+) -> ChannelFetch:
+    """
+    Загружает новые сообщения канала (ID > cursor) с учётом FloodWait.
+
+    Слот семафора удерживается только на время запросов: пока канал ждёт
+    окончания FloodWait, остальные каналы продолжают загружаться.
+
+    Args:
+        client: Подключённый Telethon клиент
+        username: Имя канала (например, "@habr_com")
+        semaphore: Общий ограничитель числа одновременных запросов
+        cursor: ID последнего уже загруженного сообщения; без него берутся
+            последние MESSAGES_LIMIT сообщений
+        entity_cache: Кэш разрешённых каналов
+
+    Returns:
+        ChannelFetch с сообщениями, новым курсором или ошибкой
+    """
+    for attempt in range(FLOOD_WAIT_RETRIES + 1):
+        try:
+            async with semaphore:
+                entity = await resolve_entity(client, username, entity_cache)
+                messages = await _fetch_messages(client, entity, cursor)
+            return ChannelFetch(
+                username=username,
+                messages=messages,
+                cursor=_next_cursor(messages, cursor),
+            )
+        except FloodWaitError as e:
+            if attempt >= FLOOD_WAIT_RETRIES or e.seconds > FLOOD_WAIT_MAX_SECONDS:
+                logger.error(f"FloodWait {e.seconds} с для {username}, канал пропущен")
+                return ChannelFetch(username=username, cursor=cursor, error=e)
+            logger.warning(
+                f"FloodWait {e.seconds} с для {username} (попытка {attempt + 1})"
+            )
+            record_retry()
+            await asyncio.sleep(e.seconds + 1)
+        except INVALIDATING_ERRORS as e:
+            if entity_cache is not None:
+                entity_cache.invalidate(username)
+            logger.error(f"Канал {username} недоступен: {e}")
+            return ChannelFetch(username=username, cursor=cursor, error=e)
+        except Exception as e:
+            logger.error(f"Ошибка при получении данных из {username}: {e}")
+            return ChannelFetch(username=username, cursor=cursor, error=e)
+
+    return ChannelFetch(username=username, cursor=cursor)
+
+
+async def _fetch_metered(
+    client: TelegramClient,
+    username: str,
+    semaphore: asyncio.Semaphore,
+    cursor: Optional[int],
+    entity_cache: Optional[EntityCache],
+) -> ChannelFetch:
+    """fetch_channel с метриками этапа collect:<канал>"""
+    with stage(f"collect:{username}") as metrics:
+        result = await fetch_channel(client, username, semaphore, cursor, entity_cache)
+        metrics.items_out += len(result.messages)
+        if result.error is not None:
+            metrics.errors += 1
+        return result
+
+
+async def collect_channels(
+    client: TelegramClient,
+    usernames: List[str],
+    cursors: Optional[Dict[str, int]] = None,
+    entity_cache: Optional[EntityCache] = None,
+    concurrency: Optional[int] = None,
+) -> List[ChannelFetch]:
+    """
+    Параллельно загружает сообщения из списка каналов.
+
+    Args:
+        client: Подключённый Telethon клиент
+        usernames: Список каналов
+        cursors: Словарь канал -> ID последнего загруженного сообщения
+        entity_cache: Кэш разрешённых каналов
+        concurrency: Максимум одновременных запросов (по умолчанию COLLECT_CONCURRENCY)
+
+    Returns:
+        Список ChannelFetch в порядке usernames
+    """
+    cursors = cursors or {}
+    semaphore = asyncio.Semaphore(concurrency or COLLECT_CONCURRENCY)
+    return await asyncio.gather(
+        *(
+            _fetch_metered(
+                client, username, semaphore, cursors.get(username), entity_cache
+            )
+            for username in usernames
+        )
+    )
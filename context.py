@@ -0,0 +1,99 @@
+"""
+Модуль контекста приложения: ленивое создание и подмена клиентов
+"""
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Optional
+
+from telethon import TelegramClient
+
+from cassette import cassette_ai, cassette_telegram
+from llm import get_async_client
+
+logger = logging.getLogger(__name__)
+
+
+def _default_telegram() -> TelegramClient:
+    """Создаёт Telegram клиент из переменных окружения"""
+    return TelegramClient(
+        os.getenv("PHONE"), int(os.getenv("API_ID")), os.getenv("API_HASH")
+    )
+
+
+class AppContext:
+    """
+    Контекст с клиентами Telegram и LLM.
+
+    Клиенты создаются при первом обращении, поэтому импорт модулей и работа
+    с функциями, не требующими сети, не делают сетевых вызовов и не требуют
+    учётных данных. Фабрики можно подменить (тесты, бенчмарки); клиенты по
+    умолчанию учитывают режим записи/воспроизведения CASSETTE_MODE.
+    """
+
+    def __init__(
+        self,
+        telegram_factory: Optional[Callable[[], Any]] = None,
+        ai_factory: Optional[Callable[[], Any]] = None,
+    ) -> None:
+        self._telegram_factory = telegram_factory or (
+            lambda: cassette_telegram(_default_telegram)
+        )
+        self._ai_factory = ai_factory or (lambda: cassette_ai(get_async_client))
+        self._telegram: Optional[Any] = None
+        self._telegram_started = False
+        self._ai: Optional[Any] = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """Цикл событий, в котором живут клиенты"""
+        return asyncio.get_event_loop_policy().get_event_loop()
+
+    def run(self, coro: Awaitable[Any]) -> Any:
+        """Выполняет корутину в цикле событий контекста"""
+        return self.loop.run_until_complete(coro)
+
+    async def telegram(self) -> Any:
+        """Возвращает подключённый Telegram клиент (логин - при первом вызове)"""
+        if self._telegram is None:
+            self._telegram = self._telegram_factory()
+        if not self._telegram_started:
+            start = getattr(self._telegram, "start", None)
+            if start is not None:
+                result = start()
+                if asyncio.iscoroutine(result):
+                    await result
+            self._telegram_started = True
+        return self._telegram
+
+    @property
+    def ai(self) -> Any:
+        """Асинхронный LLM клиент (создаётся при первом обращении)"""
+        if self._ai is None:
+            self._ai = self._ai_factory()
+        return self._ai
+
+    async def close(self) -> None:
+        """Отключает Telegram клиент, если он был подключён"""
+        if self._telegram is not None and self._telegram_started:
+            result = self._telegram.disconnect()
+            if asyncio.iscoroutine(result):
+                await result
+            self._telegram_started = False
+
+
+_context: Optional[AppContext] = None
+
+
+def get_context() -> AppContext:
+    """Возвращает текущий контекст приложения (создаёт при первом вызове)"""
+    global _context
+    if _context is None:
+        _context = AppContext()
+    return _context
+
+
+def set_context(context: Optional[AppContext]) -> None:
+    """Устанавливает контекст приложения (None - вернуть контекст по умолчанию)"""
+    global _context
+    _context = context
@@ -0,0 +1,169 @@
+"""
+Модуль постоянно работающего режима: сбор по интервалу и публикация по расписанию
+"""
+import asyncio
+import datetime
+import json
+import logging
+import os
+import signal
+from typing import Optional
+
+import pytz
+
+import logic
+from context import get_context
+from ingest import INGEST_MODE, RECONCILE_INTERVAL, EventIngestor
+
+logger = logging.getLogger(__name__)
+
+# === Настройки расписания ===
+COLLECT_INTERVAL = int(os.getenv("COLLECT_INTERVAL", "900"))
+# Пропущенный слот публикуется, если с его начала прошло не больше этого времени
+PUBLISH_CATCHUP_HOURS = float(os.getenv("PUBLISH_CATCHUP_HOURS", "12"))
+# Пауза перед повтором неудавшейся публикации
+PUBLISH_RETRY_SECONDS = int(os.getenv("PUBLISH_RETRY_SECONDS", "600"))
+SCHEDULER_STATE_FILE = "scheduler_state.json"
+
+MOSCOW_TZ = pytz.timezone("Europe/Moscow")
+
+
+def _now() -> datetime.datetime:
+    """Текущее время по Москве"""
+    return datetime.datetime.now(MOSCOW_TZ)
+
+
+def _slot_at(day: datetime.date, hhmm: str) -> datetime.datetime:
+    """Момент слота публикации HH:MM в указанный день по Москве"""
+    hour, minute = (int(part) for part in hhmm.split(":"))
+    naive = datetime.datetime.combine(day, datetime.time(hour, minute))
+    return MOSCOW_TZ.localize(naive)
+
+
+def last_due_slot(now: datetime.datetime) -> datetime.datetime:
+    """Последний слот из POSTING_TIMES, наступивший к моменту now"""
+    candidates = [
+        _slot_at(now.date() - datetime.timedelta(days=offset), hhmm)
+        for offset in (0, 1)
+        for hhmm in logic.POSTING_TIMES
+    ]
+    return max(slot for slot in candidates if slot <= now)
+
+
+def next_slot(now: datetime.datetime) -> datetime.datetime:
+    """Ближайший будущий слот из POSTING_TIMES"""
+    candidates = [
+        _slot_at(now.date() + datetime.timedelta(days=offset), hhmm)
+        for offset in (0, 1)
+        for hhmm in logic.POSTING_TIMES
+    ]
+    return min(slot for slot in candidates if slot > now)
+
+
+def load_last_slot() -> Optional[datetime.datetime]:
+    """Загружает последний отработанный слот публикации"""
+    if os.path.exists(SCHEDULER_STATE_FILE):
+        try:
+            with open(SCHEDULER_STATE_FILE, "r", encoding="utf-8") as f:
+                return datetime.datetime.fromisoformat(json.load(f)["last_slot"])
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать {SCHEDULER_STATE_FILE}: {e}")
+    return None
+
+
+def save_last_slot(slot: datetime.datetime) -> None:
+    """Сохраняет последний отработанный слот публикации"""
+    with open(SCHEDULER_STATE_FILE, "w", encoding="utf-8") as f:
+        json.dump({"last_slot": slot.isoformat()}, f, indent=2)
+
+
+async def run_daemon() -> None:
+    """
+    Основной цикл постоянного режима.
+
+    Клиенты Telegram и OpenAI остаются подключёнными между проходами. Сбор
+    запускается каждые COLLECT_INTERVAL секунд (в режиме INGEST_MODE=events
+    посты приходят событиями, а сбор раз в RECONCILE_INTERVAL секунд
+    подбирает пропущенное), публикация - в слоты
+    POSTING_TIMES по Москве. Слот, пропущенный из-за простоя, публикуется
+    при запуске, если он не старше PUBLISH_CATCHUP_HOURS. Без сохранённого
+    состояния (первый запуск) прошедший слот считается отработанным: его
+    мог уже опубликовать cron. SIGTERM/SIGINT завершают цикл после текущей
+    операции.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    catchup = datetime.timedelta(hours=PUBLISH_CATCHUP_HOURS)
+    last_slot = load_last_slot()
+    if last_slot is None:
+        last_slot = last_due_slot(_now())
+        save_last_slot(last_slot)
+        logger.info(
+            f"Первый запуск: слот {last_slot:%d.%m %H:%M} считается отработанным"
+        )
+    next_collect = _now()
+    next_publish_try = _now()
+
+    ingestor: Optional[EventIngestor] = None
+    collect_interval = COLLECT_INTERVAL
+    if INGEST_MODE == "events":
+        client_tg = await get_context().telegram()
+        ingestor = EventIngestor(client_tg, logic.channel_usernames)
+        await ingestor.start()
+        # Посты приходят событиями, сбор по курсорам только подбирает пропуски
+        collect_interval = RECONCILE_INTERVAL
+
+    logger.info(
+        f"Постоянный режим: сбор каждые {collect_interval} с "
+        f"({'сверка, посты по событиям' if ingestor else 'опрос каналов'}), "
+        f"публикация в {', '.join(logic.POSTING_TIMES)} (МСК)"
+    )
+
+    while not stop.is_set():
+        now = _now()
+
+        if now >= next_collect:
+            try:
+                await logic.collect_news_async()
+                logger.info("Сбор новостей завершён")
+            except Exception as e:
+                logger.error(f"Ошибка сбора новостей: {e}")
+            next_collect = now + datetime.timedelta(seconds=collect_interval)
+
+        due = last_due_slot(now)
+        if due > last_slot:
+            if now - due > catchup:
+                logger.warning(f"Слот {due:%d.%m %H:%M} пропущен: прошло слишком много")
+                last_slot = due
+                save_last_slot(due)
+            elif now >= next_publish_try:
+                published = False
+                try:
+                    published = await logic.publish_summary_async()
+                except Exception as e:
+                    logger.error(f"Ошибка публикации: {e}")
+                if published:
+                    last_slot = due
+                    save_last_slot(due)
+                else:
+                    next_publish_try = now + datetime.timedelta(
+                        seconds=PUBLISH_RETRY_SECONDS
+                    )
+                    logger.info(f"Повтор публикации после {next_publish_try:%H:%M}")
+
+        wake_at = min(next_collect, next_slot(_now()))
+        if last_due_slot(_now()) > last_slot:
+            wake_at = min(wake_at, next_publish_try)
+        timeout = max(1.0, (wake_at - _now()).total_seconds())
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    logger.info("Получен сигнал остановки, отключаюсь...")
+    if ingestor is not None:
+        ingestor.stop()
+    await get_context().close()
@@ -1,27 +1,185 @@
 import json
 import logging
 import os
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from openai import OpenAI
+from llm import get_async_client, get_client
+from llm_cache import discard
 from loader import get_prompt
+from routing import route, route_async
+from similarity import similar_pairs
+from tokens import (
+    count_messages,
+    count_tokens,
+    input_budget,
+    output_budget,
+    trim_to_tokens,
+)
 
 logger = logging.getLogger(__name__)
 
+# Пороги локального сходства: точный коэффициент Жаккара пар, найденных MinHash/LSH
+DEDUP_AUTO_THRESHOLD = float(os.getenv("DEDUP_AUTO_THRESHOLD", "0.8"))
+DEDUP_CANDIDATE_THRESHOLD = float(os.getenv("DEDUP_CANDIDATE_THRESHOLD", "0.25"))
+# Для сравнения достаточно начала новости
+DEDUP_ITEM_TOKENS = 80
+DEDUP_MIN_ITEM_TOKENS = 16
+# Ожидаемый размер ответа: JSON-обёртка и по несколько токенов на ID
+DEDUP_BASE_TOKENS = 30
+DEDUP_TOKENS_PER_ITEM = 5
+
 
 def _default_client() -> OpenAI:
-    """Создаёт клиент OpenAI по умолчанию"""
-    return OpenAI(
-        base_url=os.getenv("OPENAI_BASE_URL", "https://openrouter.ai/api/v1"),
-        api_key=os.getenv("OPENROUTER_API_KEY"),
+    """Возвращает общий клиент OpenAI (ответы кэшируются)"""
+    return get_client()
+
+
+def _find(parent: List[int], idx: int) -> int:
+    """Находит представителя кластера (union-find со сжатием путей)"""
+    while parent[idx] != idx:
+        parent[idx] = parent[parent[idx]]
+        idx = parent[idx]
+    return idx
+
+
+def _union(parent: List[int], a: int, b: int) -> None:
+    """Объединяет кластеры; представителем остаётся меньший индекс"""
+    root_a, root_b = _find(parent, a), _find(parent, b)
+    if root_a != root_b:
+        parent[max(root_a, root_b)] = min(root_a, root_b)
+
+
+def _groups_request(news_items: List[Dict[str, Any]], model: Optional[str]) -> dict:
+    """
+    Собирает запрос группировки дубликатов среди переданных новостей.
+    Если кандидатов много, начало каждой новости укорачивается так, чтобы
+    все они поместились в контекст модели одним запросом.
+    """
+    expected = DEDUP_BASE_TOKENS + DEDUP_TOKENS_PER_ITEM * len(news_items)
+    overhead = count_tokens(get_prompt("DEDUP_SYSTEM"), model) + count_tokens(
+        get_prompt("DEDUP_USER", count=len(news_items), news_list=""), model
+    )
+    # "ID N: " и перевод строки между новостями
+    per_item = input_budget(model, expected, overhead) // len(news_items) - 6
+    per_item = max(DEDUP_MIN_ITEM_TOKENS, min(DEDUP_ITEM_TOKENS, per_item))
+
+    news_list = "\n\n".join(
+        [
+            f"ID {i}: {trim_to_tokens(item['text'], per_item, model)}"
+            for i, item in enumerate(news_items)
+        ]
+    )
+
+    prompt = get_prompt("DEDUP_USER", count=len(news_items), news_list=news_list)
+    messages = [
+        {
+            "role": "system",
+            "content": get_prompt("DEDUP_SYSTEM"),
+        },
+        {"role": "user", "content": prompt},
+    ]
+
+    return dict(
+        model=model,
+        messages=messages,
+        temperature=0.1,
+        max_tokens=output_budget(model, count_messages(messages, model), expected),
+    )
+
+
+def _parse_groups(request: dict, response: Any) -> List[List[int]]:
+    """Извлекает группы дубликатов из ответа модели"""
+    try:
+        result_text = response.choices[0].message.content
+        data = json.loads(result_text)
+        return data.get("groups", [])
+    except Exception:
+        discard(request)
+        raise
+
+
+def _local_clusters(news_items: List[Dict[str, Any]]) -> Tuple[List[int], List[int]]:
+    """
+    Кластеризует новости локально по сходству пар, найденных MinHash/LSH.
+
+    Returns:
+        Массив union-find и отсортированный список представителей кластеров,
+        которые нужно показать модели
+    """
+    parent = list(range(len(news_items)))
+    ambiguous = []
+    for i, j, similarity in similar_pairs([item["text"] for item in news_items]):
+        if similarity >= DEDUP_AUTO_THRESHOLD:
+            _union(parent, i, j)
+        elif similarity >= DEDUP_CANDIDATE_THRESHOLD:
+            ambiguous.append((i, j))
+
+    # В модель отправляем по одному представителю от каждого кластера,
+    # участвующего в ещё не разрешённых неоднозначных парах
+    candidates = sorted(
+        {
+            _find(parent, idx)
+            for i, j in ambiguous
+            if _find(parent, i) != _find(parent, j)
+            for idx in (i, j)
+        }
+    )
+    return parent, candidates if len(candidates) > 1 else []
+
+
+def _apply_groups(
+    parent: List[int], candidates: List[int], groups: List[List[int]]
+) -> None:
+    """Объединяет кластеры по группам, найденным моделью"""
+    for group in groups:
+        members = [
+            candidates[idx]
+            for idx in group
+            if isinstance(idx, int) and 0 <= idx < len(candidates)
+        ]
+        for idx in members[1:]:
+            _union(parent, members[0], idx)
+
+
+def _merge_clusters(
+    news_items: List[Dict[str, Any]], parent: List[int], sent: int
+) -> List[Dict[str, Any]]:
+    """Оставляет первую новость каждого кластера и объединяет источники"""
+    clusters: Dict[int, List[int]] = {}
+    for idx in range(len(news_items)):
+        clusters.setdefault(_find(parent, idx), []).append(idx)
+
+    deduplicated = []
+    for members in clusters.values():
+        primary_item = news_items[members[0]].copy()
+        sources = [primary_item.get("channel_username", "")]
+        for dup_idx in members[1:]:
+            dup_source = news_items[dup_idx].get("channel_username", "")
+            if dup_source and dup_source not in sources:
+                sources.append(dup_source)
+        primary_item["merged_sources"] = sources
+        deduplicated.append(primary_item)
+
+    removed = len(news_items) - len(deduplicated)
+    logger.info(
+        f"Дедупликация: {len(news_items)} → {len(deduplicated)} (удалено {removed}, "
+        f"в модель отправлено {sent})"
     )
 
+    return deduplicated
+
 
 def deduplicate_news(
     news_items: List[Dict[str, Any]], client: Optional[OpenAI] = None
 ) -> List[Dict[str, Any]]:
     """
-    Обнаруживает и удаляет дубликаты похожих новостей в одном пакетном вызове.
+    Обнаруживает и удаляет дубликаты похожих новостей.
+
+    Сначала локальный MinHash/LSH находит пары похожих текстов: явные
+    репосты (сходство >= DEDUP_AUTO_THRESHOLD) объединяются сразу, а в модель
+    одним пакетным вызовом уходят только неоднозначные кандидаты. Новости без
+    похожих соседей в модель не отправляются.
 
     Args:
         news_items: Список словарей новостей с 'text', 'channel_username', 'message_id'
@@ -33,75 +191,52 @@ def deduplicate_news(
     if not news_items or len(news_items) <= 1:
         return news_items
 
-    ai_client = client or _default_client()
-    model = os.getenv("MODEL")
-
-    # Build a prompt asking the model to identify duplicates
-    news_list = "\n\n".join(
-        [f"ID {i}: {item['text'][:200]}" for i, item in enumerate(news_items)]
-    )
-
-    prompt = get_prompt("DEDUP_USER", count=len(news_items), news_list=news_list)
-
-    try:
-        logger.info(f"Deduplicating {len(news_items)} news items...")
-
-        response = ai_client.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": get_prompt("DEDUP_SYSTEM"),
-                },
-                {"role": "user", "content": prompt},
-            ],
-            temperature=0.1,
-            max_tokens=500,
-        )
-
-        result_text = response.choices[0].message.content
-        data = json.loads(result_text)
-        groups = data.get("groups", [])
-
-        # Build deduplicated list: keep first item from each group, merge sources
-        seen_indices = set()
-        deduplicated = []
-
-        for group in groups:
-            if not group:
-                continue
-            primary_idx = group[0]
-            if primary_idx in seen_indices:
-                continue
-
-            primary_item = news_items[primary_idx].copy()
-
-            # Merge sources from duplicates
-            sources = [primary_item.get("channel_username", "")]
-            for dup_idx in group[1:]:
-                if dup_idx not in seen_indices:
-                    dup_source = news_items[dup_idx].get("channel_username", "")
-                    if dup_source and dup_source not in sources:
-                        sources.append(dup_source)
-                    seen_indices.add(dup_idx)
-
-            primary_item["merged_sources"] = sources
-            deduplicated.append(primary_item)
-            seen_indices.add(primary_idx)
-
-        # Add any ungrouped items (those not in any group)
-        for i, item in enumerate(news_items):
-            if i not in seen_indices:
-                deduplicated.append(item)
-                seen_indices.add(i)
-
-        removed = len(news_items) - len(deduplicated)
-        logger.info(
-            f"Дедупликация: {len(news_items)} → {len(deduplicated)} (удалено {removed})"
-        )
-
-        return deduplicated
-
-    except Exception as e:
-        logger.error(f"Ошибка дедупликации: {e}. Пропускаю.")
+    logger.info(f"Deduplicating {len(news_items)} news items...")
+
+    parent, candidates = _local_clusters(news_items)
+    if candidates:
+        try:
+            ai_client = client or _default_client()
+            request, response = route(
+                "dedup",
+                lambda model: _groups_request(
+                    [news_items[idx] for idx in candidates], model
+                ),
+                ai_client,
+            )
+            _apply_groups(parent, candidates, _parse_groups(request, response))
+        except Exception as e:
+            logger.error(
+                f"Ошибка дедупликации моделью: {e}. Оставляю только локальные группы."
+            )
+
+    return _merge_clusters(news_items, parent, len(candidates))
+
+
+async def deduplicate_news_async(
+    news_items: List[Dict[str, Any]], client: Optional[Any] = None
+) -> List[Dict[str, Any]]:
+    """Асинхронный вариант deduplicate_news (общий AsyncOpenAI клиент по умолчанию)"""
+    if not news_items or len(news_items) <= 1:
         return news_items
+
+    logger.info(f"Deduplicating {len(news_items)} news items...")
+
+    parent, candidates = _local_clusters(news_items)
+    if candidates:
+        try:
+            ai_client = client or get_async_client()
+            request, response = await route_async(
+                "dedup",
+                lambda model: _groups_request(
+                    [news_items[idx] for idx in candidates], model
+                ),
+                ai_client,
+            )
+            _apply_groups(parent, candidates, _parse_groups(request, response))
+        except Exception as e:
+            logger.error(
+                f"Ошибка дедупликации моделью: {e}. Оставляю только локальные группы."
+            )
+
+    return _merge_clusters(news_items, parent, len(candidates))
@@ -0,0 +1,119 @@
+"""
+Модуль подготовки дайджеста за один потоковый вызов модели
+(суммаризация и форматирование для Telegram вместе)
+"""
+import logging
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+from format import FORMAT_EXTRA_TOKENS
+from llm import get_async_client
+from loader import get_prompt
+from metrics import record_usage
+from routing import route_async
+from summarize import SUMMARY_BASE_TOKENS, SUMMARY_TOKENS_PER_ITEM, pack_news_list
+from tokens import count_messages, count_tokens, input_budget, output_budget
+
+logger = logging.getLogger(__name__)
+
+DIGEST_TEMPERATURE = 0.2
+# Подводка и тематические блоки разделены двумя пустыми строками
+SECTION_BREAK = re.compile(r"\n[ \t]*\n[ \t]*\n\s*")
+
+
+def _digest_request(
+    news_items: List[Dict[str, Any]], feedback: Optional[str], model: Optional[str]
+) -> dict:
+    """Собирает потоковый запрос на готовый к публикации дайджест"""
+    messages = [
+        {"role": "system", "content": get_prompt("DIGEST_SYSTEM")},
+        {"role": "user", "content": ""},
+    ]
+    if feedback and feedback.strip():
+        messages.append(
+            {
+                "role": "user",
+                "content": get_prompt("SUMMARIZE_FEEDBACK", feedback=feedback),
+            }
+        )
+
+    overhead = count_messages(messages, model) + count_tokens(
+        get_prompt("DIGEST_USER", news_list=""), model
+    )
+    expected = SUMMARY_BASE_TOKENS + FORMAT_EXTRA_TOKENS
+    budget = input_budget(
+        model, expected + SUMMARY_TOKENS_PER_ITEM * len(news_items), overhead
+    )
+    news_list, kept = pack_news_list(news_items, budget, model)
+    messages[1]["content"] = get_prompt("DIGEST_USER", news_list=news_list)
+    expected += SUMMARY_TOKENS_PER_ITEM * kept
+
+    return dict(
+        model=model,
+        messages=messages,
+        max_tokens=output_budget(model, count_messages(messages, model), expected),
+        temperature=DIGEST_TEMPERATURE,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+
+
+async def stream_digest_async(
+    news_items: List[Dict[str, Any]],
+    client: Optional[Any] = None,
+    feedback: Optional[str] = None,
+    on_section: Optional[Callable[[str], None]] = None,
+) -> str:
+    """
+    Генерирует дайджест для Telegram одним потоковым вызовом.
+
+    Args:
+        news_items: Отобранные новости по убыванию рейтинга
+        client: Асинхронный OpenAI клиент (общий, если не предоставлен)
+        feedback: Замечания модератора к предыдущему варианту
+        on_section: Вызывается с каждым законченным блоком (подводкой или
+            темой), пока модель пишет следующие
+
+    Returns:
+        Текст дайджеста
+
+    Raises:
+        Ошибку модели или обрыва потока, ValueError для дайджеста, обрезанного
+        по max_tokens: вызывающий код решает, повторить ли запрос или перейти
+        на раздельные суммаризацию и форматирование
+    """
+    if not news_items:
+        return ""
+
+    ai_client = client or get_async_client()
+    _, stream = await route_async(
+        "digest",
+        lambda model: _digest_request(news_items, feedback, model),
+        ai_client,
+    )
+
+    parts: List[str] = []
+    pending = ""
+    finish_reason = None
+    async for chunk in stream:
+        record_usage(getattr(chunk, "usage", None))
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        finish_reason = choice.finish_reason or finish_reason
+        delta = choice.delta.content or ""
+        if not delta:
+            continue
+        parts.append(delta)
+        pending += delta
+        *sections, pending = SECTION_BREAK.split(pending)
+        for section in sections:
+            if section.strip() and on_section is not None:
+                on_section(section.strip())
+
+    if finish_reason == "length":
+        # Оборванный на полуслове дайджест публиковать нельзя
+        raise ValueError("Дайджест обрезан по max_tokens")
+    if pending.strip() and on_section is not None:
+        on_section(pending.strip())
+    return "".join(parts).strip()
@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+from telethon import TelegramClient, utils
+from telethon.errors import (
+    ChannelInvalidError,
+    ChannelPrivateError,
+    UsernameInvalidError,
+    UsernameNotOccupiedError,
+)
+from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerUser
+
+logger = logging.getLogger(__name__)
+
+# === Настройки кэша сущностей ===
+ENTITY_CACHE_FILE = "entity_cache.json"
+ENTITY_CACHE_TTL = int(os.getenv("ENTITY_CACHE_TTL", str(7 * 24 * 3600)))
+
+# Ошибки, после которых сохранённый peer больше нельзя использовать
+INVALIDATING_ERRORS = (
+    UsernameInvalidError,
+    UsernameNotOccupiedError,
+    ChannelPrivateError,
+    ChannelInvalidError,
+)
+
+
+def _peer_to_record(peer: Any) -> Optional[Dict[str, Any]]:
+    """Преобразует InputPeer в словарь для хранения на диске"""
+    if isinstance(peer, InputPeerChannel):
+        return {
+            "type": "channel",
+            "id": peer.channel_id,
+            "access_hash": peer.access_hash,
+        }
+    if isinstance(peer, InputPeerUser):
+        return {"type": "user", "id": peer.user_id, "access_hash": peer.access_hash}
+    if isinstance(peer, InputPeerChat):
+        return {"type": "chat", "id": peer.chat_id}
+    return None
+
+
+def _record_to_peer(record: Dict[str, Any]) -> Optional[Any]:
+    """Восстанавливает InputPeer из сохранённого словаря"""
+    kind = record.get("type")
+    if kind == "channel":
+        return InputPeerChannel(record["id"], record["access_hash"])
+    if kind == "user":
+        return InputPeerUser(record["id"], record["access_hash"])
+    if kind == "chat":
+        return InputPeerChat(record["id"])
+    return None
+
+
+class EntityCache:
+    """
+    Постоянный кэш разрешённых каналов: username -> (peer id, access hash).
+
+    Разрешение username - один из самых лимитированных запросов Telegram,
+    поэтому в установившемся режиме сбор не делает ни одного такого вызова.
+    """
+
+    def __init__(
+        self, path: str = ENTITY_CACHE_FILE, ttl: int = ENTITY_CACHE_TTL
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+        self._records: Dict[str, Dict[str, Any]] = {}
+        self._dirty = False
+
+    @classmethod
+    def load(
+        cls, path: str = ENTITY_CACHE_FILE, ttl: int = ENTITY_CACHE_TTL
+    ) -> "EntityCache":
+        """Загружает кэш с диска (пустой кэш, если файла нет или он повреждён)"""
+        cache = cls(path, ttl)
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    cache._records = json.load(f)
+            except Exception as e:
+                logger.warning(f"Кэш сущностей повреждён, будет пересобран: {e}")
+        return cache
+
+    def save(self) -> None:
+        """Сохраняет кэш на диск, если он изменился"""
+        if not self._dirty:
+            return
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(self._records, f, indent=2, ensure_ascii=False)
+        self._dirty = False
+
+    def get(self, username: str) -> Optional[Any]:
+        """Возвращает InputPeer из кэша или None, если записи нет или она устарела"""
+        record = self._records.get(username)
+        if not record:
+            return None
+        if time.time() - record.get("resolved_at", 0) > self.ttl:
+            return None
+        return _record_to_peer(record)
+
+    def put(self, username: str, entity: Any) -> Any:
+        """Запоминает разрешённую сущность и возвращает её InputPeer"""
+        peer = utils.get_input_peer(entity)
+        record = _peer_to_record(peer)
+        if record is not None:
+            record["resolved_at"] = time.time()
+            self._records[username] = record
+            self._dirty = True
+        return peer
+
+    def invalidate(self, username: str) -> None:
+        """Удаляет запись, чтобы канал был разрешён заново"""
+        if self._records.pop(username, None) is not None:
+            self._dirty = True
+            logger.info(f"Кэш сущности {username} сброшен")
+
+
+async def resolve_entity(
+    client: TelegramClient, username: str, cache: Optional[EntityCache] = None
+) -> Any:
+    """
+    Разрешает канал через кэш, обращаясь к Telegram только при промахе.
+
+    Args:
+        client: Подключённый Telethon клиент
+        username: Имя канала
+        cache: Кэш сущностей (без него каждый вызов идёт в Telegram)
+
+    Returns:
+        InputPeer канала, пригодный для get_messages/iter_messages
+    """
+    if cache is None:
+        return await client.get_entity(username)
+
+    peer = cache.get(username)
+    if peer is not None:
+        return peer
+
+    try:
+        entity = await client.get_entity(username)
+    except INVALIDATING_ERRORS:
+        cache.invalidate(username)
+        raise
+    return cache.put(username, entity)
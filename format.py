@@ -1,43 +1,96 @@
 import logging
-import os
-from typing import Optional
+from typing import Any, Optional
 
 from openai import OpenAI
+from llm import get_async_client, get_client
+from llm_cache import discard
 from loader import get_prompt
+from routing import route, route_async
+from tokens import count_messages, count_tokens, output_budget
 
 logger = logging.getLogger(__name__)
 
+# Отформатированный текст длиннее исходного на разметку и подводку
+FORMAT_GROWTH = 1.3
+FORMAT_EXTRA_TOKENS = 150
+
 
 def _default_client() -> OpenAI:
-    """Создаёт клиент OpenAI по умолчанию"""
-    return OpenAI(
-        base_url=os.getenv("OPENAI_BASE_URL", "https://openrouter.ai/api/v1"),
-        api_key=os.getenv("OPENROUTER_API_KEY"),
+    """Возвращает общий клиент OpenAI (ответы кэшируются)"""
+    return get_client()
+
+
+def _format_request(summary_markdown: str, model: Optional[str]) -> dict:
+    """Собирает запрос на форматирование дайджеста"""
+    system_prompt = get_prompt("FORMAT_SYSTEM")
+    user_prompt = get_prompt("FORMAT_USER", summary_markdown=summary_markdown)
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+    expected = int(count_tokens(summary_markdown, model) * FORMAT_GROWTH)
+    expected += FORMAT_EXTRA_TOKENS
+
+    return dict(
+        model=model,
+        messages=messages,
+        temperature=0.35,
+        max_tokens=output_budget(model, count_messages(messages, model), expected),
     )
 
 
-def format_for_telegram(summary_markdown: str, client: Optional[OpenAI] = None) -> str:
-    """Форматирует дайджест для публикации в Telegram и добавляет краткую подводку"""
+def _parse_format(request: dict, completion: Any) -> str:
+    """Извлекает отформатированный текст из ответа модели"""
+    choice = completion.choices[0]
+    if choice.finish_reason == "length":
+        # Текст, оборванный на полуслове, нельзя ни публиковать, ни кэшировать
+        discard(request)
+        raise ValueError("Отформатированный текст обрезан по max_tokens")
+    content = choice.message.content
+    if not content or not content.strip():
+        discard(request)
+    return content
+
+
+def format_for_telegram(
+    summary_markdown: str, client: Optional[OpenAI] = None
+) -> Optional[str]:
+    """
+    Форматирует дайджест для публикации в Telegram и добавляет краткую подводку.
+
+    Returns:
+        Текст для публикации или None при ошибке: неформатированный markdown
+        публиковать нельзя
+    """
     if not summary_markdown or not summary_markdown.strip():
         return ""
 
     ai_client = client or _default_client()
-    model = os.getenv("MODEL")
 
-    system_prompt = get_prompt("FORMAT_SYSTEM")
-    user_prompt = get_prompt("FORMAT_USER", summary_markdown=summary_markdown)
+    try:
+        request, completion = route(
+            "format", lambda model: _format_request(summary_markdown, model), ai_client
+        )
+        return _parse_format(request, completion)
+    except Exception as e:
+        logger.error("Ошибка при форматировании для Telegram: %s", e)
+        return None
+
+
+async def format_for_telegram_async(
+    summary_markdown: str, client: Optional[Any] = None
+) -> Optional[str]:
+    """Асинхронный вариант format_for_telegram"""
+    if not summary_markdown or not summary_markdown.strip():
+        return ""
+
+    ai_client = client or get_async_client()
 
     try:
-        completion = ai_client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
-            temperature=0.35,
-            max_tokens=800,
+        request, completion = await route_async(
+            "format", lambda model: _format_request(summary_markdown, model), ai_client
         )
-        return completion.choices[0].message.content
+        return _parse_format(request, completion)
     except Exception as e:
         logger.error("Ошибка при форматировании для Telegram: %s", e)
-        return summary_markdown
+        return None
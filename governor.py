@@ -0,0 +1,295 @@
+"""
+Модуль регулирования запросов к модели: лимиты RPM/TPM, повторы
+с экспоненциальной задержкой и адаптивная конкурентность (AIMD)
+"""
+import asyncio
+import contextvars
+import email.utils
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Tuple
+
+import openai
+
+from metrics import record_retry
+from tokens import count_messages
+
+logger = logging.getLogger(__name__)
+
+# === Настройки регулятора ===
+# Лимиты провайдера в минуту (0 - без ограничения)
+LLM_RPM = int(os.getenv("LLM_RPM", "0"))
+LLM_TPM = int(os.getenv("LLM_TPM", "0"))
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "4"))
+LLM_RETRY_BASE = float(os.getenv("LLM_RETRY_BASE", "1"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "60"))
+# Границы адаптивной конкурентности; стартовое значение - LLM_CONCURRENCY
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+LLM_MIN_CONCURRENCY = int(os.getenv("LLM_MIN_CONCURRENCY", "1"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+# После снижения лимита следующее снижение не раньше, чем через столько секунд
+AIMD_COOLDOWN = 2.0
+# Оценка ответа, если в запросе нет max_tokens
+DEFAULT_COMPLETION_TOKENS = 512
+
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+# Есть ли у текущего запроса запасная модель (выставляет routing)
+_failover_available: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "failover_available", default=False
+)
+
+
+class TokenBucket:
+    """
+    Потокобезопасное ведро токенов с резервированием.
+
+    reserve() сразу списывает запрошенное (баланс может уйти в минус) и
+    возвращает, сколько нужно подождать, чтобы уложиться в лимит. Так
+    ожидающие запросы выстраиваются в очередь, а не обгоняют друг друга.
+    """
+
+    def __init__(self, per_minute: int) -> None:
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self._level = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._level = min(
+            self.capacity, self._level + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Резервирует amount и возвращает задержку в секундах"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill()
+            self._level -= min(amount, self.capacity)
+            return max(0.0, -self._level / self.rate)
+
+    def adjust(self, amount: float) -> None:
+        """Доначисляет (amount > 0) или возвращает (amount < 0) списанное"""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self._refill()
+            self._level = min(self.capacity, self._level - amount)
+
+
+class AdaptiveLimiter:
+    """
+    Ограничитель одновременных запросов с AIMD: после каждого успешного
+    ответа лимит растёт на 1/лимит (примерно +1 за «окно» запросов), при
+    429/5xx и таймаутах - уменьшается вдвое.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int) -> None:
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(self.maximum, max(self.minimum, initial)))
+        self._in_flight = 0
+        self._decreased_at = 0.0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self) -> "AdaptiveLimiter":
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self._in_flight < int(self.limit)
+            )
+            self._in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self) -> None:
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_overload(self) -> None:
+        now = time.monotonic()
+        if now - self._decreased_at < AIMD_COOLDOWN:
+            return  # одна перегрузка видна сразу нескольким запросам
+        self._decreased_at = now
+        self.limit = max(self.minimum, self.limit / 2)
+        logger.warning(
+            f"Провайдер перегружен, конкурентность снижена до {int(self.limit)}"
+        )
+
+
+_requests_bucket = TokenBucket(LLM_RPM)
+_tokens_bucket = TokenBucket(LLM_TPM)
+_limiters: Dict[asyncio.AbstractEventLoop, AdaptiveLimiter] = {}
+
+
+def get_limiter() -> AdaptiveLimiter:
+    """Адаптивный ограничитель для текущего цикла событий"""
+    loop = asyncio.get_running_loop()
+    if loop not in _limiters:
+        for old_loop in [old for old in _limiters if old.is_closed()]:
+            del _limiters[old_loop]
+        _limiters[loop] = AdaptiveLimiter(
+            LLM_CONCURRENCY, LLM_MIN_CONCURRENCY, LLM_MAX_CONCURRENCY
+        )
+    return _limiters[loop]
+
+
+def estimate_tokens(request: Dict[str, Any]) -> int:
+    """Оценка токенов запроса для лимита TPM: промпт и максимум ответа"""
+    prompt = count_messages(request.get("messages") or [], request.get("model"))
+    return prompt + (request.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+
+
+def _reserve(request: Dict[str, Any]) -> Tuple[int, float]:
+    """Резервирует запрос и токены, возвращает (оценка токенов, задержка)"""
+    estimate = estimate_tokens(request)
+    delay = max(_requests_bucket.reserve(1), _tokens_bucket.reserve(estimate))
+    return estimate, delay
+
+
+def _settle(response: Any, estimate: int) -> None:
+    """Поправляет лимит TPM на фактический расход из response.usage"""
+    usage = getattr(response, "usage", None)
+    total = getattr(usage, "total_tokens", None) if usage is not None else None
+    if total:
+        _tokens_bucket.adjust(total - estimate)
+
+
+def is_retryable(error: Exception) -> bool:
+    """Стоит ли повторять запрос после ошибки"""
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUSES
+    return False
+
+
+@contextmanager
+def failover_available(available: bool) -> Iterator[None]:
+    """
+    Помечает запросы внутри блока: если у них есть запасная модель, таймаут
+    и 5xx не повторяются на той же модели, а сразу возвращаются в routing
+    """
+    token = _failover_available.set(available)
+    try:
+        yield
+    finally:
+        _failover_available.reset(token)
+
+
+def _fails_over(error: Exception) -> bool:
+    """Ошибка модели, которую быстрее обойти запасной моделью, чем повторять"""
+    if not _failover_available.get():
+        return False
+    if isinstance(error, openai.APITimeoutError):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def is_overload(error: Exception) -> bool:
+    """Признак перегрузки провайдера (для снижения конкурентности)"""
+    if isinstance(error, openai.APITimeoutError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Задержка из заголовков Retry-After / retry-after-ms, если есть"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            moment = email.utils.parsedate_to_datetime(value)
+            return max(0.0, moment.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(error: Exception, attempt: int) -> float:
+    """
+    Задержка перед повтором: Retry-After провайдера, а без него -
+    экспоненциальная задержка с полным джиттером.
+    """
+    hinted = retry_after(error)
+    if hinted is not None:
+        return min(hinted, LLM_RETRY_MAX_DELAY) + random.uniform(0, 0.5)
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE * 2**attempt))
+
+
+async def call_async(
+    func: Callable[[], Awaitable[Any]], request: Dict[str, Any]
+) -> Any:
+    """Выполняет асинхронный запрос к модели под управлением регулятора"""
+    limiter = get_limiter()
+    for attempt in range(LLM_RETRIES + 1):
+        estimate, delay = _reserve(request)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            async with limiter:
+                response = await func()
+        except Exception as e:
+            _tokens_bucket.adjust(-estimate)
+            if is_overload(e):
+                limiter.on_overload()
+            if attempt >= LLM_RETRIES or not is_retryable(e) or _fails_over(e):
+                raise
+            pause = backoff_delay(e, attempt)
+            logger.warning(
+                f"Ошибка запроса к модели ({e}), "
+                f"повтор {attempt + 1} через {pause:.1f} с"
+            )
+            record_retry()
+            await asyncio.sleep(pause)
+            continue
+        limiter.on_success()
+        _settle(response, estimate)
+        return response
+
+
+def call(func: Callable[[], Any], request: Dict[str, Any]) -> Any:
+    """
+    Синхронный вариант call_async: лимиты RPM/TPM и повторы. Конкурентность
+    синхронного клиента задаётся размером пула потоков вызывающего кода.
+    """
+    for attempt in range(LLM_RETRIES + 1):
+        estimate, delay = _reserve(request)
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            response = func()
+        except Exception as e:
+            _tokens_bucket.adjust(-estimate)
+            if attempt >= LLM_RETRIES or not is_retryable(e) or _fails_over(e):
+                raise
+            pause = backoff_delay(e, attempt)
+            logger.warning(
+                f"Ошибка запроса к модели ({e}), "
+                f"повтор {attempt + 1} через {pause:.1f} с"
+            )
+            record_retry()
+            time.sleep(pause)
+            continue
+        _settle(response, estimate)
+        return response
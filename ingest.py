@@ -0,0 +1,139 @@
+"""
+Модуль событийного сбора новостей.
+
+Вместо опроса каналов по интервалу бот подписывается на события Telethon
+NewMessage и MessageEdited отслеживаемых каналов и пишет посты в кэш новостей
+сразу по приходу. Сбор по курсорам (logic.collect_news_async) остаётся как
+редкая сверка: он подбирает посты, пропущенные, пока клиент был отключён.
+"""
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from telethon import TelegramClient, events
+
+import logic
+from entities import EntityCache, resolve_entity
+from storage import ProcessedStore
+
+logger = logging.getLogger(__name__)
+
+# === Настройки событийного сбора ===
+# poll - сбор по интервалу COLLECT_INTERVAL, events - по событиям Telegram
+INGEST_MODE = os.getenv("INGEST_MODE", "poll")
+# Интервал сверки по курсорам в режиме events
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "3600"))
+
+
+class EventIngestor:
+    """
+    Подписка на новые и отредактированные посты отслеживаемых каналов.
+
+    Новый пост дописывается в журнал кэша и отмечается обработанным.
+    Правка поста, который ещё ждёт публикации, дописывается новой версией
+    (при чтении снимка она заменяет прежнюю). Правки постов не из кэша
+    принимаются, только если пост выше курсора канала и ещё не обработан:
+    это пост, пропущенный при разрыве соединения. Остальные правки (уже
+    опубликованные посты и посты старше окна первого сбора) пропускаются.
+    """
+
+    def __init__(self, client: TelegramClient, channels: List[str]) -> None:
+        self.client = client
+        self.channels = channels
+        self.received = 0
+        self._usernames: Dict[int, str] = {}
+        self._handlers: List[Tuple[Any, Any]] = []
+        self._processed = ProcessedStore()
+
+    async def start(self) -> None:
+        """Разрешает каналы (через кэш сущностей) и регистрирует обработчики"""
+        entity_cache = EntityCache.load()
+        peers = []
+        for username in self.channels:
+            try:
+                peer = await resolve_entity(self.client, username, entity_cache)
+            except Exception as e:
+                logger.error(f"Не удалось подписаться на {username}: {e}")
+                continue
+            channel_id = getattr(peer, "channel_id", None)
+            if channel_id is None:
+                logger.warning(f"{username} не канал, события не отслеживаются")
+                continue
+            self._usernames[channel_id] = username
+            peers.append(peer)
+        entity_cache.save()
+
+        for callback, builder in (
+            (self._on_new_message, events.NewMessage(chats=peers)),
+            (self._on_message_edited, events.MessageEdited(chats=peers)),
+        ):
+            self.client.add_event_handler(callback, builder)
+            self._handlers.append((callback, builder))
+        logger.info(f"Подписка на события {len(peers)} каналов")
+
+    def stop(self) -> None:
+        """Снимает обработчики событий и закрывает хранилище обработанных"""
+        for callback, builder in self._handlers:
+            self.client.remove_event_handler(callback, builder)
+        self._handlers.clear()
+        self._processed.close()
+
+    @staticmethod
+    def _below_cursor(key: Tuple[str, int]) -> bool:
+        """Пост не выше курсора канала (без курсора - считается давним)"""
+        username, message_id = key
+        cursor = logic.load_channel_cursors().get(username)
+        return cursor is None or message_id <= cursor
+
+    def _username(self, message: Any) -> Optional[str]:
+        peer = getattr(message, "peer_id", None)
+        return self._usernames.get(getattr(peer, "channel_id", None))
+
+    async def _on_new_message(self, event: Any) -> None:
+        self.ingest(event.message, edited=False)
+
+    async def _on_message_edited(self, event: Any) -> None:
+        self.ingest(event.message, edited=True)
+
+    def ingest(self, message: Any, edited: bool = False) -> bool:
+        """
+        Записывает пост в кэш новостей.
+
+        Returns:
+            True, если пост (или его новая версия) добавлен в кэш
+        """
+        username = self._username(message)
+        if username is None or not message.text or not message.text.strip():
+            return False
+
+        key = (username, message.id)
+        try:
+            if edited and logic.is_cached(key):
+                pass  # новая версия заменит прежнюю в снимке
+            elif key in self._processed or (edited and self._below_cursor(key)):
+                # Уже в кэше (пришёл сверкой) или правка давнего поста
+                return False
+            logic.append_news_cache([logic.news_item(username, message)])
+            self._processed.add_many([key])
+        except Exception as e:
+            logger.error(f"Ошибка записи поста {username}/{message.id}: {e}")
+            return False
+
+        if not edited:
+            advance_cursor(username, message.id)
+        self.received += 1
+        action = "обновлена" if edited else "добавлена"
+        logger.info(f"Новость {action} из {username} (событие)")
+        return True
+
+
+def advance_cursor(username: str, message_id: int) -> None:
+    """
+    Сдвигает курсор канала на доставленный событием пост. Назад курсор не
+    двигается, а канал без курсора ждёт первого сбора с его окном истории.
+    """
+    cursors = logic.load_channel_cursors()
+    cursor = cursors.get(username)
+    if cursor is not None and message_id > cursor:
+        cursors[username] = message_id
+        logic.save_channel_cursors(cursors)
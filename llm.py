@@ -0,0 +1,162 @@
+"""
+Модуль общего подключения к OpenAI-совместимому API (OpenRouter)
+"""
+import importlib
+import logging
+import os
+import threading
+from types import ModuleType, SimpleNamespace
+from typing import Any, Optional
+
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+import governor
+from llm_cache import cached_async_client, cached_client
+from metrics import record_error, record_response
+
+logger = logging.getLogger(__name__)
+
+# === Настройки пула соединений ===
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "10"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "90"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+
+_client: Optional[Any] = None
+_async_client: Optional[Any] = None
+_lock = threading.Lock()
+
+
+def http_transport() -> ModuleType:
+    """
+    HTTP-библиотека, поверх которой собран установленный openai (httpx или
+    httpx2 в зависимости от версии SDK): лимиты пула должны быть её типа
+    """
+    base = DefaultHttpxClient.__mro__[1]
+    return importlib.import_module(base.__module__.split(".")[0])
+
+
+def _limits() -> Any:
+    """Лимиты пула: keep-alive соединения переиспользуются между вызовами"""
+    return http_transport().Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    )
+
+
+def _client_kwargs() -> dict:
+    """Общие параметры подключения для синхронного и асинхронного клиентов"""
+    return dict(
+        base_url=os.getenv("OPENAI_BASE_URL", "https://openrouter.ai/api/v1"),
+        api_key=os.getenv("OPENROUTER_API_KEY"),
+        timeout=LLM_TIMEOUT,
+        # Повторы выполняет governor: встроенные повторы SDK их бы умножали
+        max_retries=0,
+    )
+
+
+def get_client() -> Any:
+    """
+    Возвращает общий синхронный клиент (один пул соединений на процесс).
+    Ответы проходят через кэш LLM.
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            _client = cached_client(
+                MeteredOpenAI(
+                    OpenAI(
+                        **_client_kwargs(),
+                        http_client=DefaultHttpxClient(limits=_limits()),
+                    )
+                )
+            )
+        return _client
+
+
+class _MeteredCompletions:
+    """
+    chat.completions под управлением регулятора (лимиты RPM/TPM, повторы),
+    учитывающий вызовы и токены в метриках этапа
+    """
+
+    def __init__(self, completions: Any) -> None:
+        self._completions = completions
+
+    def create(self, **kwargs: Any) -> Any:
+        try:
+            response = governor.call(
+                lambda: self._completions.create(**kwargs), kwargs
+            )
+        except Exception:
+            record_error()
+            raise
+        record_response(response)
+        return response
+
+
+class MeteredOpenAI:
+    """OpenAI клиент с регулятором запросов и учётом вызовов в метриках"""
+
+    def __init__(self, client: OpenAI) -> None:
+        self._client = client
+        self.chat = SimpleNamespace(
+            completions=_MeteredCompletions(client.chat.completions)
+        )
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._client, name)
+
+
+class _BoundedCompletions:
+    """
+    chat.completions под управлением регулятора: лимиты RPM/TPM, повторы
+    и адаптивное число одновременных запросов; вызовы учитываются в метриках
+    """
+
+    def __init__(self, completions: Any) -> None:
+        self._completions = completions
+
+    async def create(self, **kwargs: Any) -> Any:
+        try:
+            response = await governor.call_async(
+                lambda: self._completions.create(**kwargs), kwargs
+            )
+        except Exception:
+            record_error()
+            raise
+        record_response(response)
+        return response
+
+
+class BoundedAsyncOpenAI:
+    """AsyncOpenAI, чьи запросы к модели проходят через governor"""
+
+    def __init__(self, client: AsyncOpenAI) -> None:
+        self._client = client
+        self.chat = SimpleNamespace(
+            completions=_BoundedCompletions(client.chat.completions)
+        )
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._client, name)
+
+
+def get_async_client() -> Any:
+    """
+    Возвращает общий асинхронный клиент на тёплом пуле соединений.
+    Попадания в кэш LLM не занимают слот конкурентности.
+    """
+    global _async_client
+    with _lock:
+        if _async_client is None:
+            _async_client = cached_async_client(
+                BoundedAsyncOpenAI(
+                    AsyncOpenAI(
+                        **_client_kwargs(),
+                        http_client=DefaultAsyncHttpxClient(limits=_limits()),
+                    )
+                )
+            )
+        return _async_client
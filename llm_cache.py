@@ -0,0 +1,235 @@
+"""
+Модуль кэширования ответов LLM по содержимому запроса
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, Optional
+
+from openai import AsyncOpenAI, OpenAI
+from openai.types.chat import ChatCompletion
+
+from metrics import record_cache_hit
+
+logger = logging.getLogger(__name__)
+
+# === Настройки кэша ===
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+LLM_CACHE_FILE = os.getenv("LLM_CACHE_FILE", "llm_cache.db")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+
+# Параметры запроса, от которых зависит ответ модели
+KEY_FIELDS = ("model", "messages", "tools", "tool_choice", "temperature", "max_tokens")
+
+
+def request_key(request: Dict[str, Any]) -> str:
+    """Вычисляет ключ кэша по параметрам запроса"""
+    payload = {field: request.get(field) for field in KEY_FIELDS}
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """
+    Дисковый кэш ответов chat.completions в SQLite.
+
+    Записи живут не дольше ttl секунд; при превышении max_entries удаляются
+    давно не читанные. Счётчики hits/misses доступны через stats().
+    """
+
+    def __init__(
+        self,
+        path: str = LLM_CACHE_FILE,
+        ttl: int = LLM_CACHE_TTL,
+        max_entries: int = LLM_CACHE_MAX_ENTRIES,
+    ) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed_at)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        """Возвращает сохранённый ответ (JSON) или None"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        """Сохраняет ответ и вытесняет устаревшие и лишние записи"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, response, created_at, "
+                "accessed_at) VALUES (?, ?, ?, ?)",
+                (key, response, now, now),
+            )
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,)
+            )
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache "
+                "ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def delete(self, key: str) -> None:
+        """Удаляет запись из кэша"""
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        """Возвращает счётчики попаданий и промахов"""
+        return {"hits": self.hits, "misses": self.misses}
+
+
+_cache: Optional[LLMCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> LLMCache:
+    """Возвращает общий для всех модулей экземпляр кэша"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMCache()
+        return _cache
+
+
+def discard(request: Dict[str, Any]) -> None:
+    """
+    Удаляет из кэша ответ на запрос, который не прошёл проверку
+    (невалидный JSON, несовпадение длины и т.п.), чтобы повтор запроса
+    снова ушёл в модель.
+    """
+    discard_key(request_key(request))
+
+
+def discard_key(key: str) -> None:
+    """Удаляет из кэша ответ по ключу запроса (см. request_key)"""
+    if LLM_CACHE_ENABLED:
+        get_cache().delete(key)
+
+
+def _store(cache: LLMCache, key: str, response: Any) -> None:
+    """Сохраняет ответ в кэш, если он полный и сериализуемый"""
+    # Обрезанные по max_tokens ответы не кэшируем: повтор может пройти
+    truncated = any(
+        getattr(choice, "finish_reason", None) == "length"
+        for choice in response.choices
+    )
+    if hasattr(response, "model_dump_json") and not truncated:
+        cache.put(key, response.model_dump_json())
+
+
+class CachedCompletions:
+    """Обёртка над chat.completions с кэшированием ответов"""
+
+    def __init__(self, completions: Any, cache: LLMCache) -> None:
+        self._completions = completions
+        self._cache = cache
+
+    def create(self, **kwargs: Any) -> Any:
+        if kwargs.get("stream"):
+            return self._completions.create(**kwargs)
+
+        key = request_key(kwargs)
+        cached = self._cache.get(key)
+        if cached is not None:
+            record_cache_hit()
+            return ChatCompletion.model_validate_json(cached)
+
+        response = self._completions.create(**kwargs)
+        _store(self._cache, key, response)
+        return response
+
+
+class CachedAsyncCompletions(CachedCompletions):
+    """Асинхронная обёртка над chat.completions с кэшированием ответов"""
+
+    async def create(self, **kwargs: Any) -> Any:
+        if kwargs.get("stream"):
+            return await self._completions.create(**kwargs)
+
+        key = request_key(kwargs)
+        cached = self._cache.get(key)
+        if cached is not None:
+            record_cache_hit()
+            return ChatCompletion.model_validate_json(cached)
+
+        response = await self._completions.create(**kwargs)
+        _store(self._cache, key, response)
+        return response
+
+
+class CachedOpenAI:
+    """
+    OpenAI клиент, у которого chat.completions.create идёт через кэш.
+    Остальные атрибуты берутся из исходного клиента.
+    """
+
+    completions_class = CachedCompletions
+
+    def __init__(self, client: Any, cache: LLMCache) -> None:
+        self._client = client
+        self.chat = SimpleNamespace(
+            completions=self.completions_class(client.chat.completions, cache)
+        )
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._client, name)
+
+
+class CachedAsyncOpenAI(CachedOpenAI):
+    """AsyncOpenAI клиент, у которого chat.completions.create идёт через кэш"""
+
+    completions_class = CachedAsyncCompletions
+
+
+def cached_client(client: OpenAI) -> Any:
+    """Оборачивает клиент кэшем (если кэш включён и клиент ещё не обёрнут)"""
+    if not LLM_CACHE_ENABLED or isinstance(client, CachedOpenAI):
+        return client
+    return CachedOpenAI(client, get_cache())
+
+
+def cached_async_client(client: AsyncOpenAI) -> Any:
+    """Оборачивает асинхронный клиент кэшем"""
+    if not LLM_CACHE_ENABLED or isinstance(client, CachedOpenAI):
+        return client
+    return CachedAsyncOpenAI(client, get_cache())
@@ -1,39 +1,69 @@
+import asyncio
 import datetime
 import json
 import logging
 import os
-from typing import Any, Dict, List
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 import pytz
-from telethon.sync import TelegramClient
-from openai import OpenAI
 
-from censure import moderate_content, should_block_content, review_summary
-from dedup import deduplicate_news
-from format import format_for_telegram
-from rate import rate_batch, RatingResult
-from summarize import summarize_news
+from censure import (
+    moderate_batch_async,
+    moderate_content_async,
+    review_summary_async,
+    should_block_content,
+)
+from collect import collect_channels
+from context import get_context
+from dedup import deduplicate_news_async
+from digest import stream_digest_async
+from entities import EntityCache
+from format import format_for_telegram_async
+from llm_cache import discard_key, request_key
+from metrics import metered_run, record_cache_hit, stage
+from prerank import prerank
+from rate import content_hash, prompt_version, rate_batch_async, RatingResult
+from storage import CheckpointStore, ProcessedStore, RatingStore
+from summarize import SUMMARY_TEMPERATURE, summarize_with_request_async
 
 logger = logging.getLogger(__name__)
 
 # === Настройки ===
-PROCESSED_MESSAGES_FILE = "processed_messages.json"
-NEWS_CACHE_FILE = "news_cache.json"
+NEWS_CACHE_FILE = "news_cache.jsonl"
+LEGACY_NEWS_CACHE_FILE = "news_cache.json"
+CHANNEL_CURSORS_FILE = "channel_cursors.json"
 POSTING_TIMES = ["00:00"]
 TARGET_CHANNEL = os.getenv("TARGET_CHANNEL", "@cho_tam_official")
-
-# === Настройки Telegram клиента ===
-api_id = int(os.getenv("API_ID"))
-api_hash = os.getenv("API_HASH")
-phone = os.getenv("PHONE")
-client_tg = TelegramClient(phone, api_id, api_hash)
-client_tg.start()
-
-# === Настройки OpenAI / OpenRouter ===
-client_ai = OpenAI(
-    base_url=os.getenv("OPENAI_BASE_URL", "https://openrouter.ai/api/v1"),
-    api_key=os.getenv("OPENROUTER_API_KEY"),
-)
+# Циклов "сводка -> модерация" до публикации
+REVIEW_ROUNDS = 5
+# Сколько вариантов сводки генерировать и модерировать параллельно за цикл
+# (1 - последовательные правки по замечаниям модератора)
+SUMMARY_CANDIDATES = int(os.getenv("SUMMARY_CANDIDATES", "1"))
+# Диапазон температур вариантов: первый - самый консервативный
+SUMMARY_TEMPERATURES = (0.1, 0.9)
+# Пакетная модерация отобранных новостей до суммаризации
+PREMODERATION = os.getenv("PREMODERATION", "1") != "0"
+# Дайджест одним потоковым вызовом вместо суммаризации и форматирования
+FUSED_DIGEST = os.getenv("FUSED_DIGEST", "0") != "0"
+# Сколько часов повторы сорвавшейся публикации берут её снимок кэша
+# (и контрольные точки), а не весь накопленный кэш
+PUBLISH_RESUME_HOURS = float(os.getenv("PUBLISH_RESUME_HOURS", "6"))
+
+# Ключи новостей в журнале кэша (None - ещё не прочитаны, см. is_cached)
+_cached_keys: Optional[Set[Tuple[str, int]]] = None
+
+# Клиенты Telegram и OpenAI создаются лениво через context.get_context()
 
 # === Список каналов для отслеживания ===
 channel_usernames = [
@@ -63,66 +93,281 @@ channel_usernames = [
 
 
 # === Функции работы с данными ===
-def load_processed_ids() -> set:
-    """Загружает множество ID обработанных сообщений"""
-    if os.path.exists(PROCESSED_MESSAGES_FILE):
+def load_channel_cursors() -> Dict[str, int]:
+    """Загружает ID последнего обработанного сообщения для каждого канала"""
+    if os.path.exists(CHANNEL_CURSORS_FILE):
         try:
-            with open(PROCESSED_MESSAGES_FILE, "r", encoding="utf-8") as f:
-                return set(json.load(f))
+            with open(CHANNEL_CURSORS_FILE, "r", encoding="utf-8") as f:
+                return {k: int(v) for k, v in json.load(f).items()}
         except:
-            return set()
-    return set()
+            return {}
+    return {}
+
+
+def save_channel_cursors(cursors: Dict[str, int]) -> None:
+    """Сохраняет курсоры каналов"""
+    with open(CHANNEL_CURSORS_FILE, "w", encoding="utf-8") as f:
+        json.dump(cursors, f, indent=2, ensure_ascii=False)
 
 
-def save_processed_ids(ids: set) -> None:
-    """Сохраняет множество ID обработанных сообщений"""
-    with open(PROCESSED_MESSAGES_FILE, "w", encoding="utf-8") as f:
-        json.dump(list(ids), f, indent=2)
+def _migrate_legacy_news_cache() -> None:
+    """Переносит старый news_cache.json в журнал (однократно)"""
+    if not os.path.exists(LEGACY_NEWS_CACHE_FILE) or os.path.exists(NEWS_CACHE_FILE):
+        return
+    try:
+        with open(LEGACY_NEWS_CACHE_FILE, "r", encoding="utf-8") as f:
+            legacy = json.load(f)
+    except Exception as e:
+        logger.error(f"Не удалось прочитать {LEGACY_NEWS_CACHE_FILE}: {e}")
+        return
+    append_news_cache(legacy)
+    os.replace(LEGACY_NEWS_CACHE_FILE, LEGACY_NEWS_CACHE_FILE + ".migrated")
+    logger.info(f"Кэш новостей перенесён в журнал {NEWS_CACHE_FILE}")
+
+
+def _read_news_journal() -> Iterator[Tuple[Dict[str, Any], int]]:
+    """
+    Потоково читает журнал кэша новостей.
+
+    Возвращает пары (новость, смещение конца строки). Недописанная последняя
+    строка (сбой во время записи) и повреждённые строки пропускаются, а не
+    обнуляют весь кэш.
+    """
+    _migrate_legacy_news_cache()
+    if not os.path.exists(NEWS_CACHE_FILE):
+        return
+
+    offset = 0
+    with open(NEWS_CACHE_FILE, "rb") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.endswith(b"\n"):
+                logger.warning(f"Недописанная запись в конце {NEWS_CACHE_FILE}")
+                break
+            offset += len(line)
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line.decode("utf-8")), offset
+            except ValueError:
+                logger.warning(
+                    f"Пропущена повреждённая запись {NEWS_CACHE_FILE}:{line_no}"
+                )
+
+
+def iter_news_cache() -> Iterator[Dict[str, Any]]:
+    """Потоково читает накопленные новости из журнала на диске"""
+    for item, _ in _read_news_journal():
+        yield item
 
 
 def load_news_cache() -> List[Dict[str, Any]]:
     """Загружает накопленные новости из кэша на диске"""
-    if os.path.exists(NEWS_CACHE_FILE):
-        try:
-            with open(NEWS_CACHE_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except:
-            return []
-    return []
+    return snapshot_news_cache()[0]
 
 
-def save_news_cache(news: List[Dict[str, Any]]) -> None:
-    """Сохраняет накопленные новости в кэш на диске"""
-    with open(NEWS_CACHE_FILE, "w", encoding="utf-8") as f:
-        json.dump(news, f, indent=2, ensure_ascii=False)
+def news_key(item: Dict[str, Any]) -> Optional[Tuple[str, int]]:
+    """Ключ новости (канал, message_id); None для записей без message_id"""
+    if item.get("message_id") is None:
+        return None
+    return item.get("channel_username", ""), item["message_id"]
 
 
-def clear_news_cache() -> List[Dict[str, Any]]:
-    """Очищает кэш новостей после успешной публикации"""
-    if os.path.exists(NEWS_CACHE_FILE):
-        os.remove(NEWS_CACHE_FILE)
+def news_item(username: str, msg: Any) -> Dict[str, Any]:
+    """Запись кэша новостей для сообщения канала"""
+    return {
+        "text": msg.text,
+        "channel_username": username,
+        "message_id": msg.id,
+        "timestamp": datetime.datetime.now().isoformat(),
+    }
+
+
+def is_cached(key: Tuple[str, int]) -> bool:
+    """
+    Лежит ли новость с ключом key в кэше. Ключи читаются из журнала один
+    раз, дальше их обновляют append_news_cache и clear_news_cache.
+    """
+    global _cached_keys
+    if _cached_keys is None:
+        _cached_keys = {news_key(item) for item in iter_news_cache()} - {None}
+    return key in _cached_keys
+
+
+def _journal_key(line: bytes) -> Optional[Tuple[str, int]]:
+    """Ключ новости из строки журнала (None для неразборчивых строк)"""
+    try:
+        return news_key(json.loads(line))
+    except (ValueError, AttributeError):
+        return None
+
+
+def snapshot_news_cache(
+    upto: Optional[int] = None,
+) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Читает текущее содержимое журнала для публикации.
+
+    Args:
+        upto: Читать журнал только до этого смещения (снимок прошлой попытки)
+
+    Returns:
+        Список новостей (для отредактированных постов - последняя версия)
+        и смещение, до которого они прочитаны; его нужно передать
+        в clear_news_cache, чтобы не потерять новости, дописанные после
+        снимка
+    """
+    news: Dict[Any, Dict[str, Any]] = {}
+    offset = 0
+    for item, end in _read_news_journal():
+        if upto is not None and end > upto:
+            break
+        offset = end
+        # Правка поста дописывается в журнал новой записью и заменяет
+        # прежнюю версию на её месте
+        news[news_key(item) or len(news)] = item
+    return list(news.values()), offset
+
+
+def snapshot_hash(news: List[Dict[str, Any]]) -> str:
+    """Хэш содержимого снимка кэша: ключ контрольных точек публикации"""
+    return content_hash(json.dumps(news, sort_keys=True, ensure_ascii=False))
+
+
+def append_news_cache(news: List[Dict[str, Any]]) -> None:
+    """Дописывает новости в журнал кэша и сбрасывает запись на диск"""
+    if not news:
+        return
+
+    prefix = ""
+    if os.path.exists(NEWS_CACHE_FILE) and os.path.getsize(NEWS_CACHE_FILE) > 0:
+        with open(NEWS_CACHE_FILE, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                # Закрываем строку, оборванную сбоем, чтобы не склеить записи
+                prefix = "\n"
+
+    with open(NEWS_CACHE_FILE, "a", encoding="utf-8") as f:
+        f.write(prefix)
+        for item in news:
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    if _cached_keys is not None:
+        _cached_keys.update(news_key(item) for item in news)
+        _cached_keys.discard(None)
+
+
+def clear_news_cache(upto: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Очищает кэш новостей после успешной публикации.
+
+    Журнал атомарно заменяется своим хвостом после смещения upto (новости,
+    собранные после снимка), без upto журнал очищается полностью. Правки
+    опубликованных постов, пришедшие после снимка, из хвоста убираются.
+    """
+    global _cached_keys
+    if not os.path.exists(NEWS_CACHE_FILE):
+        return []
+
+    tail: List[bytes] = []
+    if upto is not None:
+        published = set()
+        for item, offset in _read_news_journal():
+            if offset > upto:
+                break
+            published.add(news_key(item))
+        published.discard(None)
+        with open(NEWS_CACHE_FILE, "rb") as f:
+            f.seek(upto)
+            tail = [line for line in f if _journal_key(line) not in published]
+
+    tmp_file = NEWS_CACHE_FILE + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(b"".join(tail))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, NEWS_CACHE_FILE)
+    _cached_keys = {_journal_key(line) for line in tail} - {None}
     return []
 
 
-def select_top_news(
+def _run(coro: Awaitable[Any]) -> Any:
+    """Выполняет корутину в цикле событий контекста приложения"""
+    return get_context().run(coro)
+
+
+async def select_top_news_async(
     news_items: List[Dict[str, Any]], top_n: int = 15
 ) -> List[Dict[str, Any]]:
-    """Оценивает новости с помощью агента и возвращает топ-N по рейтингу"""
+    """
+    Оценивает новости с помощью агента и возвращает топ-N по рейтингу.
+
+    Оценки сохраняются по хэшу текста и версии промпта, поэтому в модель
+    уходят только новости, которые ещё не оценивались. Из них локальный
+    предварительный отбор оставляет не больше PRERANK_TOP_K кандидатов.
+    """
+    top_news, _ = await _rate_top_news(news_items, top_n)
+    return top_news
+
+
+async def _rate_top_news(
+    news_items: List[Dict[str, Any]], top_n: int = 15
+) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Топ-N новостей по рейтингу (см. select_top_news_async) и признак того,
+    что все оценки получены от модели, а не подставлены запасным путём
+    """
     rated_news = []
+    complete = True
+    store = RatingStore()
+    version = prompt_version()
 
     try:
-        ratings: List[RatingResult] = rate_batch(
-            [item["text"] for item in news_items], client_ai
+        hashes = [content_hash(item["text"]) for item in news_items]
+        known = store.get_many(hashes, version)
+        pending = [i for i, text_hash in enumerate(hashes) if text_hash not in known]
+        record_cache_hit(len(news_items) - len(pending))
+        pending = [
+            pending[i] for i in prerank([news_items[i] for i in pending])
+        ]
+        logger.info(
+            f"Оценки из кэша: {len(known)}, "
+            f"к оценке моделью: {len(pending)}"
         )
-        for item, rating in zip(news_items, ratings):
+
+        if pending:
+            ratings: List[RatingResult] = await rate_batch_async(
+                [news_items[i]["text"] for i in pending], get_context().ai
+            )
+            # Оценки сохраняются с версией модели, которая их дала: после
+            # переключения на запасную модель они не выдаются за оценки основной
+            fresh: Dict[Optional[str], List[Tuple[str, float, str]]] = {}
+            for i, rating in zip(pending, ratings):
+                known[hashes[i]] = (rating.score, rating.reasoning)
+                if not rating.fallback:
+                    fresh.setdefault(rating.model, []).append(
+                        (hashes[i], rating.score, rating.reasoning)
+                    )
+            for model, rows in fresh.items():
+                store.put_many(rows, prompt_version(model))
+            complete = sum(map(len, fresh.values())) == len(pending)
+
+        for item, text_hash in zip(news_items, hashes):
+            if text_hash not in known:
+                continue
+            score, reason = known[text_hash]
             item_with_rating = {
                 **item,
-                "rating_score": rating.score,
-                "rating_reason": rating.reasoning,
+                "rating_score": score,
+                "rating_reason": reason,
             }
             rated_news.append(item_with_rating)
+        store.prune()
     except Exception as e:
         logger.error(f"Ошибка при пакетной оценке новостей: {e}")
+        complete = False
+    finally:
+        store.close()
 
     rated_news.sort(key=lambda x: x.get("rating_score", 0.0), reverse=True)
 
@@ -130,7 +375,301 @@ def select_top_news(
         rated_news = rated_news[:top_n]
 
     logger.info(f"Отобрано {len(rated_news)} лучших новостей из {len(news_items)}")
-    return rated_news
+    return rated_news, complete
+
+
+def select_top_news(
+    news_items: List[Dict[str, Any]], top_n: int = 15
+) -> List[Dict[str, Any]]:
+    """Оценивает новости с помощью агента и возвращает топ-N по рейтингу"""
+    return _run(select_top_news_async(news_items, top_n))
+
+
+async def _select_for_digest(news_items: List[Dict[str, Any]]) -> Any:
+    """
+    Лучшие новости для дайджеста (после пакетной модерации, если включена).
+    Если часть оценок подставлена запасным путём, отбор оборачивается в
+    _Unsaved: повтор публикации оценит эти новости заново.
+    """
+    best_news, complete = await _rate_top_news(news_items)
+    if PREMODERATION and best_news:
+        with stage("premoderation") as metrics:
+            metrics.items_in = len(best_news)
+            best_news = await premoderate_news_async(best_news, get_context().ai)
+            metrics.items_out = len(best_news)
+    return best_news if complete else _Unsaved(best_news)
+
+
+async def premoderate_news_async(
+    news_items: List[Dict[str, Any]], client_ai: Any
+) -> List[Dict[str, Any]]:
+    """
+    Исключает новости, из-за которых модерация отклонила бы дайджест.
+    Новости, которые проверить не удалось, остаются: дайджест всё равно
+    проходит модерацию целиком.
+    """
+    results = await moderate_batch_async(
+        [item["text"] for item in news_items], client_ai
+    )
+    kept = []
+    for item, result in zip(news_items, results):
+        if not result.get("error") and should_block_content(result):
+            logger.info(
+                f"Новость {item['channel_username']}/{item['message_id']} "
+                f"исключена модерацией"
+            )
+            continue
+        kept.append(item)
+    return kept
+
+
+def _candidate_temperatures(count: int) -> List[float]:
+    """Температуры вариантов сводки, равномерно по SUMMARY_TEMPERATURES"""
+    if count <= 1:
+        return [SUMMARY_TEMPERATURE]
+    low, high = SUMMARY_TEMPERATURES
+    return [round(low + (high - low) * i / (count - 1), 2) for i in range(count)]
+
+
+async def _summarize(
+    best_news: List[Dict[str, Any]], client_ai: Any, **kwargs: Any
+) -> Optional[Dict[str, str]]:
+    """
+    Сводка вместе с ключом её запроса в кэше LLM ({"text", "cache_key"})
+    или None, если суммаризатор вернул пустой результат
+    """
+    summary, request = await summarize_with_request_async(
+        best_news, client_ai, **kwargs
+    )
+    if not summary or not summary.strip() or request is None:
+        return None
+    return {"text": summary, "cache_key": request_key(request)}
+
+
+async def _review_sequential(
+    best_news: List[Dict[str, Any]], client_ai: Any
+) -> Optional[Dict[str, str]]:
+    """
+    Итеративная модерация и правки: сводка переписывается по замечаниям
+    модератора, пока он её не одобрит (не больше REVIEW_ROUNDS циклов).
+
+    Returns:
+        Сводка (последняя, если одобрения не было) в формате _summarize
+        или None, если суммаризатор вернул пустой результат
+    """
+    with stage("summarize.1") as metrics:
+        metrics.items_in = len(best_news)
+        summary = await _summarize(best_news, client_ai)
+    for attempt in range(REVIEW_ROUNDS):
+        if summary is None:
+            return None
+        with stage(f"review.{attempt + 1}"):
+            review = await review_summary_async(summary["text"], client_ai)
+        if review.get("approved"):
+            break
+        feedback = review.get("feedback", "")
+        logger.info(f"Модератор просит правки (итерация {attempt+1}): {feedback}")
+        with stage(f"summarize.{attempt + 2}") as metrics:
+            metrics.items_in = len(best_news)
+            summary = await _summarize(best_news, client_ai, feedback=feedback)
+    return summary
+
+
+async def _summary_candidate(
+    best_news: List[Dict[str, Any]],
+    client_ai: Any,
+    round_number: int,
+    temperature: float,
+    feedback: str,
+) -> Tuple[Optional[Dict[str, str]], Dict[str, Any]]:
+    """Генерирует один вариант сводки и сразу отправляет его на модерацию"""
+    with stage(f"summarize.{round_number}") as metrics:
+        metrics.items_in = len(best_news)
+        summary = await _summarize(
+            best_news, client_ai, feedback=feedback, temperature=temperature
+        )
+    if summary is None:
+        return None, {"approved": False, "feedback": ""}
+    with stage(f"review.{round_number}"):
+        review = await review_summary_async(summary["text"], client_ai)
+    return summary, review
+
+
+async def _review_speculative(
+    best_news: List[Dict[str, Any]], client_ai: Any, count: int
+) -> Optional[Dict[str, str]]:
+    """
+    Параллельные варианты сводки: за цикл генерируется count вариантов с
+    разной температурой, каждый модерируется, как только готов. Берётся
+    первый одобренный, остальные задачи отменяются. Если одобренных нет,
+    следующий цикл получает замечания модератора.
+
+    Returns:
+        Сводка (последний непустой вариант, если одобрения не было) в
+        формате _summarize или None, если все варианты оказались пустыми
+    """
+    temperatures = _candidate_temperatures(count)
+    feedback = ""
+    fallback: Optional[Dict[str, str]] = None
+    for round_number in range(1, REVIEW_ROUNDS + 1):
+        tasks = [
+            asyncio.ensure_future(
+                _summary_candidate(
+                    best_news, client_ai, round_number, temperature, feedback
+                )
+            )
+            for temperature in temperatures
+        ]
+        feedbacks = []
+        try:
+            for finished in asyncio.as_completed(tasks):
+                summary, review = await finished
+                if summary is None:
+                    continue
+                if review.get("approved"):
+                    logger.info(
+                        f"Сводка одобрена в цикле {round_number}, "
+                        f"остальные варианты отменены"
+                    )
+                    return summary
+                fallback = summary
+                if review.get("feedback"):
+                    feedbacks.append(review["feedback"])
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if fallback is None:
+            return None
+        feedback = "\n".join(dict.fromkeys(feedbacks))
+        logger.info(f"Модератор просит правки (цикл {round_number}): {feedback}")
+    return fallback
+
+
+async def _reviewed_summary(
+    best_news: List[Dict[str, Any]], client_ai: Any
+) -> Optional[Dict[str, str]]:
+    """
+    Сводка, прошедшая цикл модерации, в формате _summarize
+    (None - суммаризатор не справился)
+    """
+    if SUMMARY_CANDIDATES > 1:
+        summary = await _review_speculative(best_news, client_ai, SUMMARY_CANDIDATES)
+    else:
+        summary = await _review_sequential(best_news, client_ai)
+    if summary is None:
+        logger.error("Суммаризатор вернул пустой результат")
+    return summary
+
+
+async def _format_and_moderate(
+    summary: Dict[str, str],
+    client_ai: Any,
+    checkpoints: CheckpointStore,
+    snapshot: str,
+) -> Optional[str]:
+    """
+    Форматирует сводку для Telegram и проверяет отформатированный текст
+    финальной модерацией. Если модерация его отклонила, сводка удаляется
+    из контрольной точки и кэша LLM, чтобы повтор написал её заново.
+
+    Returns:
+        Текст для публикации или None, если публиковать нельзя
+    """
+    with stage("format"):
+        formatted_summary = await format_for_telegram_async(
+            summary["text"], client_ai
+        )
+    if not formatted_summary or not formatted_summary.strip():
+        logger.error("Форматирование вернуло пустой результат")
+        return None
+
+    # Финальная проверка отформатированного текста
+    try:
+        with stage("moderation"):
+            moderation_result = await moderate_content_async(
+                formatted_summary, client_ai
+            )
+    except Exception as e:
+        logger.error(f"Ошибка финальной модерации: {e}")
+        return None
+    if should_block_content(moderation_result):
+        logger.warning(
+            "Сводка отклонена финальной модерацией и не будет опубликована, "
+            "повтор напишет её заново."
+        )
+        checkpoints.drop(snapshot, "summary")
+        discard_key(summary["cache_key"])
+        return None
+    return formatted_summary
+
+
+async def _review_section(
+    section: str, client_ai: Any, round_number: int
+) -> Dict[str, Any]:
+    """Модерирует готовый блок дайджеста, пока модель пишет следующие"""
+    with stage(f"review.{round_number}"):
+        return await review_summary_async(section, client_ai)
+
+
+async def _fused_digest(
+    best_news: List[Dict[str, Any]], client_ai: Any
+) -> Optional[str]:
+    """
+    Дайджест одним потоковым вызовом: каждый законченный блок сразу уходит
+    на модерацию, поэтому к концу генерации проверен почти весь текст.
+    Если какой-то блок отклонён, дайджест пишется заново с замечаниями
+    (не больше REVIEW_ROUNDS раз).
+
+    Returns:
+        Текст для публикации или None, если публиковать нельзя
+
+    Raises:
+        Ошибку модели или потока (вызывающий код переходит на раздельные
+        суммаризацию и форматирование)
+    """
+    feedback = ""
+    for round_number in range(1, REVIEW_ROUNDS + 1):
+        reviews: List["asyncio.Future[Dict[str, Any]]"] = []
+
+        def on_section(section: str, number: int = round_number) -> None:
+            reviews.append(
+                asyncio.ensure_future(_review_section(section, client_ai, number))
+            )
+
+        try:
+            with stage(f"digest.{round_number}") as metrics:
+                metrics.items_in = len(best_news)
+                digest = await stream_digest_async(
+                    best_news, client_ai, feedback=feedback, on_section=on_section
+                )
+        except BaseException:
+            for review in reviews:
+                review.cancel()
+            await asyncio.gather(*reviews, return_exceptions=True)
+            raise
+
+        results = await asyncio.gather(*reviews)
+        if not digest:
+            logger.error("Модель вернула пустой дайджест")
+            return None
+        rejected = [result for result in results if not result.get("approved")]
+        if not rejected:
+            logger.info(
+                f"Дайджест одобрен: {len(results)} блоков проверено "
+                f"во время генерации"
+            )
+            return digest
+        feedback = "\n".join(
+            dict.fromkeys(r["feedback"] for r in rejected if r.get("feedback"))
+        )
+        logger.info(
+            f"Модератор отклонил {len(rejected)} из {len(results)} блоков "
+            f"(цикл {round_number}): {feedback}"
+        )
+
+    logger.warning("Дайджест не прошёл модерацию и не будет опубликован.")
+    return None
 
 
 def should_post_now() -> bool:
@@ -140,93 +679,218 @@ def should_post_now() -> bool:
     return now in POSTING_TIMES
 
 
-def collect_news() -> bool:
+@metered_run("collect")
+async def collect_news_async() -> bool:
     """Собирает новые сообщения из отслеживаемых Telegram каналов"""
-    processed_ids = load_processed_ids()
-    news_cache = load_news_cache()
+    processed = ProcessedStore()
+    new_news = []
+    cursors = load_channel_cursors()
+    entity_cache = EntityCache.load()
     new_news_collected = False
 
-    for username in channel_usernames:
-        try:
-            entity = client_tg.get_entity(username)
-            messages = client_tg.get_messages(entity, limit=13)
-
-            for msg in messages:
-                if msg.id not in processed_ids and msg.text and msg.text.strip():
-                    news_cache.append(
-                        {
-                            "text": msg.text,
-                            "channel_username": username,
-                            "message_id": msg.id,
-                            "timestamp": datetime.datetime.now().isoformat(),
-                        }
-                    )
-                    processed_ids.add(msg.id)
-                    new_news_collected = True
-                    logger.info(f"Новость добавлена из {username}")
-        except Exception as e:
-            logger.error(f"Ошибка при получении данных из {username}: {e}")
-
-    if new_news_collected:
-        save_news_cache(news_cache)
-        save_processed_ids(processed_ids)
+    client_tg = await get_context().telegram()
+    fetched = await collect_channels(
+        client_tg, channel_usernames, cursors, entity_cache
+    )
+    entity_cache.save()
+
+    new_keys = []
+    new_cursors = dict(cursors)
+    for result in fetched:
+        if result.cursor is not None:
+            new_cursors[result.username] = result.cursor
+        for msg in result.messages:
+            key = (result.username, msg.id)
+            if key not in processed and msg.text and msg.text.strip():
+                new_news.append(news_item(result.username, msg))
+                new_keys.append(key)
+                new_news_collected = True
+                logger.info(f"Новость добавлена из {result.username}")
+
+    with stage("store") as metrics:
+        metrics.items_in = sum(len(result.messages) for result in fetched)
+        metrics.items_out = len(new_news)
+        if new_news_collected:
+            append_news_cache(new_news)
+            processed.add_many(new_keys)
+        processed.prune()
+        processed.close()
+
+    # Курсоры сохраняем после кэша: сбой между записями приведёт к повторной
+    # загрузке сообщений (их отсеет хранилище обработанных), а не к их потере
+    if new_cursors != cursors:
+        save_channel_cursors(new_cursors)
 
     return new_news_collected
 
 
-def publish_summary() -> None:
-    """Публикует обработанный дайджест в Telegram и очищает кэш новостей"""
-    news_cache = load_news_cache()
-    if news_cache:
+def collect_news() -> bool:
+    """Собирает новые сообщения из отслеживаемых Telegram каналов"""
+    return _run(collect_news_async())
+
+
+@dataclass
+class _Unsaved:
+    """Результат этапа, полученный запасным путём: используется, но не сохраняется"""
+
+    value: Any
+
+
+async def _checkpointed(
+    checkpoints: CheckpointStore,
+    snapshot: str,
+    name: str,
+    produce: Callable[[], Awaitable[Any]],
+) -> Any:
+    """
+    Результат этапа из контрольной точки снимка, а если его нет - результат
+    produce(), который сохраняется. None означает неудачу, а _Unsaved -
+    деградированный результат: оба не сохраняются.
+    """
+    saved = checkpoints.get(snapshot, name)
+    if saved is not None:
+        logger.info(f"Этап {name} восстановлен из контрольной точки")
+        record_cache_hit()
+        return saved
+    value = await produce()
+    if isinstance(value, _Unsaved):
+        logger.warning(f"Этап {name} выполнен запасным путём и не сохраняется")
+        return value.value
+    if value is not None:
+        checkpoints.put(snapshot, name, value)
+    return value
+
+
+async def _digest_text(
+    best_news: List[Dict[str, Any]],
+    client_ai: Any,
+    checkpoints: CheckpointStore,
+    snapshot: str,
+) -> Optional[str]:
+    """Готовый к публикации текст дайджеста (None - публиковать нельзя)"""
+    if FUSED_DIGEST:
+        try:
+            return await _fused_digest(best_news, client_ai)
+        except Exception as e:
+            logger.error(
+                f"Ошибка потоковой генерации дайджеста, "
+                f"переход на раздельные суммаризацию и форматирование: {e}"
+            )
+
+    summary = await _checkpointed(
+        checkpoints,
+        snapshot,
+        "summary",
+        lambda: _reviewed_summary(best_news, client_ai),
+    )
+    if summary is None:
+        return None
+    return await _format_and_moderate(summary, client_ai, checkpoints, snapshot)
+
+
+def _publish_snapshot(
+    checkpoints: CheckpointStore,
+) -> Tuple[List[Dict[str, Any]], int, str]:
+    """
+    Снимок кэша для публикации: новости, смещение в журнале и хэш.
+
+    Если публикация сорвалась не больше PUBLISH_RESUME_HOURS назад, берётся
+    её снимок (журнал до закреплённого смещения), чтобы повтор продолжил
+    с контрольных точек. Новости, собранные после сбоя, остаются в журнале
+    до следующего дайджеста. Иначе закрепляется новый снимок всего кэша.
+    """
+    pinned = checkpoints.pinned(PUBLISH_RESUME_HOURS * 3600)
+    if pinned is not None:
+        snapshot, offset = pinned
+        news, offset = snapshot_news_cache(upto=offset)
+        if news and snapshot_hash(news) == snapshot:
+            logger.info("Повтор публикации прерванного снимка кэша")
+            return news, offset, snapshot
+
+    news, offset = snapshot_news_cache()
+    snapshot = snapshot_hash(news)
+    checkpoints.retain(snapshot)
+    if news:
+        checkpoints.pin(snapshot, offset)
+    return news, offset, snapshot
+
+
+@metered_run("publish", false_is_failure=True)
+async def publish_summary_async() -> bool:
+    """
+    Публикует обработанный дайджест в Telegram и очищает кэш новостей.
+
+    Результаты этапов (дубли убраны, лучшие новости отобраны, сводка
+    одобрена, текст отформатирован) сохраняются как контрольные точки
+    снимка кэша, поэтому повтор после сбоя продолжает с первого
+    незавершённого этапа того же снимка.
+
+    Returns:
+        False, если публикация сорвалась и её стоит повторить, иначе True
+        (дайджест опубликован или публиковать нечего)
+    """
+    context = get_context()
+    checkpoints = CheckpointStore()
+    try:
+        news_cache, cache_offset, snapshot = _publish_snapshot(checkpoints)
+        if not news_cache:
+            logger.warning("Нет новостей для публикации")
+            return True
+
+        client_ai = context.ai
         logger.info(f"Подготовка сводки из {len(news_cache)} новостей...")
-        news_cache = deduplicate_news(news_cache, client_ai)
-        best_news = select_top_news(news_cache)
+        with stage("dedup") as metrics:
+            metrics.items_in = len(news_cache)
+            news_cache = await _checkpointed(
+                checkpoints,
+                snapshot,
+                "dedup",
+                lambda: deduplicate_news_async(news_cache, client_ai),
+            )
+            metrics.items_out = len(news_cache)
+        with stage("rate") as metrics:
+            metrics.items_in = len(news_cache)
+            best_news = await _checkpointed(
+                checkpoints, snapshot, "top", lambda: _select_for_digest(news_cache)
+            )
+            metrics.items_out = len(best_news)
         if not best_news:
             logger.warning("Нет новостей после отбора для суммаризации")
-            return
-
-        # Итеративная модерация и правки (до 5 циклов)
-        summary = summarize_news(best_news, client_ai)
-        feedback = ""
-        for attempt in range(5):
-            if not summary or not summary.strip():
-                logger.error("Суммаризатор вернул пустой результат")
-                return
-            review = review_summary(summary, client_ai)
-            if review.get("approved"):
-                break
-            feedback = review.get("feedback", "")
-            logger.info(f"Модератор просит правки (итерация {attempt+1}): {feedback}")
-            summary = summarize_news(best_news, client_ai, feedback=feedback)
-
-        formatted_summary = format_for_telegram(summary, client_ai)
-        if not formatted_summary or not formatted_summary.strip():
-            logger.error("Форматирование вернуло пустой результат")
-            return
+            # Следующая публикация возьмёт весь кэш, а не этот снимок
+            checkpoints.clear(snapshot)
+            return True
+
+        formatted_summary = await _checkpointed(
+            checkpoints,
+            snapshot,
+            "formatted",
+            lambda: _digest_text(best_news, client_ai, checkpoints, snapshot),
+        )
+        if formatted_summary is None:
+            return False
 
         now = datetime.datetime.now(pytz.timezone("Europe/Moscow")).strftime("%d.%m.%Y")
-
-        # Финальная проверка отформатированного текста
-        try:
-            moderation_result = moderate_content(formatted_summary, client_ai)
-            if should_block_content(moderation_result):
-                logger.warning(
-                    "Сводка отклонена финальной модерацией и не будет опубликована."
-                )
-                return
-        except Exception as e:
-            logger.error(f"Ошибка финальной модерации: {e}")
-            return
-
         header = f"#ЧЕТАМ_ОТ {now}\n\n"
         full_message = header + formatted_summary
 
         try:
-            client_tg.send_message(TARGET_CHANNEL, full_message, link_preview=False)
+            with stage("send"):
+                client_tg = await context.telegram()
+                await client_tg.send_message(
+                    TARGET_CHANNEL, full_message, link_preview=False
+                )
             logger.info(f"Сводка опубликована в {TARGET_CHANNEL}")
-            clear_news_cache()
+            clear_news_cache(cache_offset)
+            checkpoints.clear(snapshot)
             logger.info("Кэш новостей очищен после публикации")
         except Exception as e:
             logger.error(f"Ошибка при публикации в канал: {e}")
-    else:
-        logger.warning("Нет новостей для публикации")
+            return False
+    finally:
+        checkpoints.close()
+    return True
+
+
+def publish_summary() -> bool:
+    """Публикует обработанный дайджест в Telegram и очищает кэш новостей"""
+    return _run(publish_summary_async())
@@ -1,8 +1,10 @@
+import argparse
 import logging
 from dotenv import load_dotenv
 
 load_dotenv()
 
+from context import get_context
 from logic import collect_news, publish_summary
 
 logging.basicConfig(
@@ -13,7 +15,21 @@ logger = logging.getLogger(__name__)
 
 def main() -> None:
     """Основной цикл приложения"""
+    parser = argparse.ArgumentParser(description="Новостной бот")
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="работать постоянно: сбор по интервалу и публикация по расписанию",
+    )
+    args = parser.parse_args()
+
     logger.info("Запуск новостного бота...")
+    if args.daemon:
+        from daemon import run_daemon
+
+        get_context().run(run_daemon())
+        return
+
     logger.info("Будет публиковать сводки по расписанию")
     collect_news()
     logger.info("Сбор новостей завершён")
@@ -0,0 +1,273 @@
+"""
+Модуль метрик этапов конвейера: время, токены, повторы, попадания в кэш
+"""
+import contextvars
+import datetime
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# === Настройки отчётов ===
+# Отчёты о запусках дописываются в JSONL (пустое значение - не писать)
+METRICS_REPORT_FILE = os.getenv("METRICS_REPORT_FILE", "run_reports.jsonl")
+# Файл для textfile-коллектора node_exporter (пустое значение - не писать)
+METRICS_PROM_FILE = os.getenv("METRICS_PROM_FILE", "")
+# Цены модели в долларах за миллион токенов для оценки стоимости запуска
+METRICS_PROMPT_PRICE = float(os.getenv("METRICS_PROMPT_PRICE", "0"))
+METRICS_COMPLETION_PRICE = float(os.getenv("METRICS_COMPLETION_PRICE", "0"))
+PROM_PREFIX = "news_bot"
+
+
+@dataclass
+class StageMetrics:
+    """Метрики одного этапа (одноимённые вызовы суммируются)"""
+
+    name: str
+    wall_seconds: float = 0.0
+    runs: int = 0
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cache_hits: int = 0
+    retries: int = 0
+    errors: int = 0
+    items_in: int = 0
+    items_out: int = 0
+
+
+@dataclass
+class RunMetrics:
+    """Метрики одного запуска конвейера (сбор или публикация)"""
+
+    name: str
+    started_at: str = field(
+        default_factory=lambda: datetime.datetime.now().isoformat()
+    )
+    wall_seconds: float = 0.0
+    ok: bool = True
+    stages: Dict[str, StageMetrics] = field(default_factory=dict)
+
+    def stage(self, name: str) -> StageMetrics:
+        """Возвращает метрики этапа, создавая их при первом обращении"""
+        if name not in self.stages:
+            self.stages[name] = StageMetrics(name)
+        return self.stages[name]
+
+    def totals(self) -> Dict[str, Any]:
+        """Суммарные показатели по всем этапам и оценка стоимости"""
+        keys = (
+            "calls",
+            "prompt_tokens",
+            "completion_tokens",
+            "cache_hits",
+            "retries",
+            "errors",
+        )
+        totals: Dict[str, Any] = {
+            key: sum(getattr(stage, key) for stage in self.stages.values())
+            for key in keys
+        }
+        totals["cost_usd"] = round(
+            (
+                totals["prompt_tokens"] * METRICS_PROMPT_PRICE
+                + totals["completion_tokens"] * METRICS_COMPLETION_PRICE
+            )
+            / 1_000_000,
+            6,
+        )
+        return totals
+
+    def report(self) -> Dict[str, Any]:
+        """Отчёт о запуске в виде словаря для JSON"""
+        return {
+            "run": self.name,
+            "started_at": self.started_at,
+            "wall_seconds": round(self.wall_seconds, 3),
+            "ok": self.ok,
+            "totals": self.totals(),
+            "stages": [
+                {**asdict(stage), "wall_seconds": round(stage.wall_seconds, 3)}
+                for stage in self.stages.values()
+            ],
+        }
+
+
+_current_run: contextvars.ContextVar[Optional[RunMetrics]] = contextvars.ContextVar(
+    "current_run", default=None
+)
+_current_stage: contextvars.ContextVar[
+    Optional[StageMetrics]
+] = contextvars.ContextVar("current_stage", default=None)
+# Счётчики обновляются и из потоков пула (rate_batch)
+_lock = threading.Lock()
+
+
+def current_stage() -> Optional[StageMetrics]:
+    """Возвращает метрики текущего этапа (None вне этапа)"""
+    return _current_stage.get()
+
+
+@contextmanager
+def stage(name: str) -> Iterator[StageMetrics]:
+    """
+    Замеряет этап конвейера. Вызовы модели, повторы и ошибки внутри блока
+    (в том числе в задачах и потоках, запущенных с копией контекста)
+    записываются в этот этап.
+    """
+    run = _current_run.get()
+    metrics = run.stage(name) if run is not None else StageMetrics(name)
+    token = _current_stage.set(metrics)
+    started = time.perf_counter()
+    try:
+        yield metrics
+    except Exception:
+        with _lock:
+            metrics.errors += 1
+        raise
+    finally:
+        with _lock:
+            metrics.wall_seconds += time.perf_counter() - started
+            metrics.runs += 1
+        _current_stage.reset(token)
+
+
+def _add(name: str, value: int = 1) -> None:
+    """Увеличивает счётчик текущего этапа"""
+    metrics = _current_stage.get()
+    if metrics is not None:
+        with _lock:
+            setattr(metrics, name, getattr(metrics, name) + value)
+
+
+def record_response(response: Any) -> None:
+    """Учитывает вызов модели и токены из response.usage"""
+    _add("calls")
+    record_usage(getattr(response, "usage", None))
+
+
+def record_usage(usage: Any) -> None:
+    """
+    Учитывает токены из usage (для потоковых ответов usage приходит
+    в последнем фрагменте, уже после record_response)
+    """
+    if usage is not None:
+        _add("prompt_tokens", getattr(usage, "prompt_tokens", 0) or 0)
+        _add("completion_tokens", getattr(usage, "completion_tokens", 0) or 0)
+
+
+def record_cache_hit(count: int = 1) -> None:
+    """Учитывает ответ, полученный из кэша без обращения к модели"""
+    _add("cache_hits", count)
+
+
+def record_retry() -> None:
+    """Учитывает повтор запроса"""
+    _add("retries")
+
+
+def record_error() -> None:
+    """Учитывает ошибку, не прервавшую этап"""
+    _add("errors")
+
+
+def _escape(value: str) -> str:
+    """Экранирует значение метки Prometheus"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _prom_line(metric: str, labels: Dict[str, str], value: float) -> str:
+    """Строка формата Prometheus text exposition"""
+    rendered = ",".join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+    return f"{PROM_PREFIX}_{metric}{{{rendered}}} {value}"
+
+
+def _write_prometheus(run: RunMetrics, path: str) -> None:
+    """Атомарно записывает метрики запуска для textfile-коллектора"""
+    fields = [name for name in StageMetrics.__dataclass_fields__ if name != "name"]
+    lines: List[str] = []
+    for name in fields:
+        metric = f"stage_{name}"
+        lines.append(f"# TYPE {PROM_PREFIX}_{metric} gauge")
+        for stage_metrics in run.stages.values():
+            labels = {"run": run.name, "stage": stage_metrics.name}
+            lines.append(_prom_line(metric, labels, getattr(stage_metrics, name)))
+    for name, value in [("wall_seconds", run.wall_seconds), *run.totals().items()]:
+        metric = f"run_{name}"
+        lines.append(f"# TYPE {PROM_PREFIX}_{metric} gauge")
+        lines.append(_prom_line(metric, {"run": run.name}, value))
+    lines.append(f"# TYPE {PROM_PREFIX}_run_ok gauge")
+    lines.append(_prom_line("run_ok", {"run": run.name}, int(run.ok)))
+
+    # Файл на каждый вид запуска: публикация не затирает метрики сбора
+    root, ext = os.path.splitext(path)
+    target = f"{root}_{run.name}{ext or '.prom'}"
+    tmp_file = target + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_file, target)
+
+
+def write_report(run: RunMetrics) -> None:
+    """Сохраняет отчёт о запуске в JSONL и (опционально) для Prometheus"""
+    report = run.report()
+    totals = report["totals"]
+    logger.info(
+        f"Запуск {run.name}: {report['wall_seconds']} с, вызовов модели "
+        f"{totals['calls']}, токенов {totals['prompt_tokens']}+"
+        f"{totals['completion_tokens']}, из кэша {totals['cache_hits']}"
+    )
+    try:
+        if METRICS_REPORT_FILE:
+            with open(METRICS_REPORT_FILE, "a", encoding="utf-8") as f:
+                f.write(json.dumps(report, ensure_ascii=False) + "\n")
+        if METRICS_PROM_FILE:
+            _write_prometheus(run, METRICS_PROM_FILE)
+    except OSError as e:
+        logger.warning(f"Не удалось записать отчёт о метриках: {e}")
+
+
+@contextmanager
+def pipeline_run(name: str) -> Iterator[RunMetrics]:
+    """Собирает метрики запуска и пишет отчёт по его завершении"""
+    run = RunMetrics(name)
+    token = _current_run.set(run)
+    started = time.perf_counter()
+    try:
+        yield run
+    except Exception:
+        run.ok = False
+        raise
+    finally:
+        run.wall_seconds = time.perf_counter() - started
+        _current_run.reset(token)
+        write_report(run)
+
+
+def metered_run(
+    name: str, false_is_failure: bool = False
+) -> Callable[[Callable[..., Awaitable[Any]]], Callable[..., Awaitable[Any]]]:
+    """
+    Декоратор асинхронного шага конвейера: оборачивает вызов в pipeline_run.
+    При false_is_failure результат False отмечает запуск как неудачный.
+    """
+
+    def decorator(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with pipeline_run(name) as run:
+                result = await func(*args, **kwargs)
+                if false_is_failure and result is False:
+                    run.ok = False
+                return result
+
+        return wrapper
+
+    return decorator
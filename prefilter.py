@@ -0,0 +1,137 @@
+"""
+Модуль быстрой локальной проверки текста перед модерацией моделью.
+
+Словарь подозрительных основ по шести категориям модерации ищется в тексте
+автоматом Ахо-Корасик за один проход. Текст без совпадений считается явно
+чистым и в модель не отправляется; при любом совпадении решение остаётся
+за моделью. Словарь поэтому намеренно широкий: ложное срабатывание стоит
+одного вызова модели, пропуск - нарушения в канале.
+"""
+import re
+from collections import deque
+from functools import lru_cache
+from typing import Dict, Iterator, List, Tuple
+
+# Основы слов ищутся как подстроки, а слова и фразы с пробелами по краям -
+# целиком (текст приводится к виду " слово слово ")
+LEXICON: Dict[str, Tuple[str, ...]] = {
+    "violence": (
+        " убий", " убит", " убив", " убью", "насили", "теракт", "террор",
+        "взрыв", "бомб", "расстрел", "застрел", "резня", " пытк", " казнь ",
+        " казни ", "казнен", "оружи", "нападен", "погиб", "жертв", " войн",
+        "обстрел", "удар по", "заложник", "угрож", "уничтож", " бить ",
+        "избил", "избиен",
+    ),
+    "hate_speech": (
+        "нацист", "фашист", "расизм", "расист", "ксенофоб", "геноцид",
+        "этнич", "неполноцен", "нелюд", "ненавист", "дискримин", "быдл",
+        "ублюд", "мраз", "сволоч", "хрен", " тупые ", "понаех",
+    ),
+    "adult_content": (
+        "секс", " порн", "эрот", "интим", "18+", "обнаж", " голая ", " голые ",
+        "проститу", "разврат", "педофил", "совращ",
+    ),
+    "self_harm": (
+        "суицид", "самоубий", "самоповрежд", "покончить с собой",
+        "покончил с собой", "вскрыть вены", "повесил", "повеситься",
+        "депресси", "передоз",
+    ),
+    "misinformation": (
+        "заговор", "чипирован", "рептилоид", "плоская земля", "масон",
+        "скрывают правду", "вакцины вызывают", "лженаук", "фейк",
+        "непроверенн", "слухи", " 5g ",
+    ),
+    "government_content": (
+        "президент", "правительств", "госдум", " дума ", " думы ", " думе ",
+        " министр", "кремл", "путин", "власт", "чиновник", "депутат",
+        "губернатор", "санкци", "митинг", " протест ", " протесты",
+        " протестов", " протестн", "свержен", "восстани", "экстремиз",
+        " сво ", "спецоперац", "мобилизац", "украин", " всу ", " фронт ",
+        " фронте ", " фронта ", " армия", " армии", "военн", " выборы ",
+        " выборах ", " выборов ", "оппозиц", " партия ", " партии ",
+        "минобороны", "иноагент",
+    ),
+}
+
+_SEPARATORS = re.compile(r"[^\w+]+")
+
+
+def normalize(text: str) -> str:
+    """Нижний регистр, ё как е, слова через одиночные пробелы с краями"""
+    words = _SEPARATORS.sub(" ", text.lower().replace("ё", "е")).strip()
+    return f" {words} "
+
+
+class AhoCorasick:
+    """
+    Автомат Ахо-Корасик: поиск всех вхождений набора шаблонов за один
+    проход по тексту (время линейно по длине текста и числу совпадений).
+    """
+
+    def __init__(self, patterns: Dict[str, str]) -> None:
+        """
+        Args:
+            patterns: Шаблон -> метка (например, категория модерации)
+        """
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[Tuple[str, str]]] = [[]]
+        for pattern, label in patterns.items():
+            self._add(pattern, label)
+        self._build()
+
+    def _add(self, pattern: str, label: str) -> None:
+        state = 0
+        for char in pattern:
+            if char not in self._goto[state]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[state][char] = len(self._goto) - 1
+            state = self._goto[state][char]
+        self._out[state].append((pattern, label))
+
+    def _build(self) -> None:
+        """Суффиксные ссылки обходом в ширину"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def find(self, text: str) -> Iterator[Tuple[str, str]]:
+        """Все вхождения шаблонов в text: пары (шаблон, метка)"""
+        state = 0
+        for char in text:
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            yield from self._out[state]
+
+
+@lru_cache(maxsize=1)
+def _automaton() -> AhoCorasick:
+    return AhoCorasick(
+        {term: category for category, terms in LEXICON.items() for term in terms}
+    )
+
+
+def scan(text: str) -> Dict[str, List[str]]:
+    """Найденные подозрительные основы по категориям"""
+    found: Dict[str, List[str]] = {}
+    for term, category in _automaton().find(normalize(text)):
+        terms = found.setdefault(category, [])
+        if term.strip() not in terms:
+            terms.append(term.strip())
+    return found
+
+
+def is_clean(text: str) -> bool:
+    """Текст без единого подозрительного слова: модерация моделью не нужна"""
+    return next(_automaton().find(normalize(text)), None) is None
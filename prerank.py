@@ -0,0 +1,202 @@
+"""
+Модуль быстрого локального предварительного отбора новостей перед оценкой моделью
+"""
+import logging
+import math
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# === Настройки предварительного отбора ===
+# Сколько новостей передавать на оценку модели (0 - всех)
+PRERANK_TOP_K = int(os.getenv("PRERANK_TOP_K", "60"))
+
+# Основы слов по критериям RATE_SYSTEM: высокая и средняя релевантность
+POSITIVE_STEMS: Dict[str, float] = {
+    "физик": 1.0,
+    "математ": 1.0,
+    "информат": 0.9,
+    "алгоритм": 0.8,
+    "программир": 0.7,
+    "космос": 0.9,
+    "космич": 0.9,
+    "ракет": 0.7,
+    "спутник": 0.7,
+    "астроном": 0.8,
+    "наук": 0.8,
+    "научн": 0.8,
+    "учён": 0.7,
+    "учен": 0.6,
+    "исследова": 0.8,
+    "открыт": 0.5,
+    "лаборатор": 0.8,
+    "квант": 0.9,
+    "технолог": 0.6,
+    "инженер": 0.6,
+    "нейросет": 0.6,
+    "искусственн": 0.5,
+    "образован": 0.7,
+    "студент": 0.8,
+    "универс": 0.6,
+    "вуз": 0.6,
+    "олимпиад": 0.9,
+    "хакатон": 0.9,
+    "конференц": 0.7,
+    "грант": 0.8,
+    "стипенд": 0.8,
+    "магистрат": 0.6,
+    "аспирант": 0.6,
+    "атом": 0.6,
+    "энерг": 0.4,
+    "робот": 0.6,
+}
+
+# Низкая релевантность: реклама, вакансии, розыгрыши, бытовые новости
+NEGATIVE_STEMS: Dict[str, float] = {
+    "реклам": 1.5,
+    "erid": 2.0,
+    "промокод": 1.5,
+    "скидк": 1.2,
+    "распродаж": 1.2,
+    "купить": 1.0,
+    "закажи": 1.0,
+    "розыгрыш": 1.2,
+    "подписывайтесь": 0.8,
+    "подпишись": 0.8,
+    "ваканси": 1.5,
+    "ищем": 0.8,
+    "требуется": 1.0,
+    "зарплат": 0.8,
+    "резюме": 1.0,
+    "откликнуться": 1.0,
+    "кэшбэк": 1.0,
+    "инвестиц": 0.4,
+    "акци": 0.5,
+    "гороскоп": 1.5,
+    "репост": 0.6,
+}
+
+# Априорная ценность каналов для аудитории (+ поднимает, - опускает)
+CHANNEL_PRIORS: Dict[str, float] = {
+    "@miptru": 0.5,
+    "@phystechunion": 0.3,
+    "@stfpmi": 0.3,
+    "@fpmi_students": 0.3,
+    "@naukamsu": 0.4,
+    "@roscosmos_gk": 0.4,
+    "@fsprussia": 0.3,
+    "@rucodefestival": 0.3,
+    "@t_central_university": 0.2,
+    "@vkjobs": -0.8,
+    "@tb_invest_official": -0.6,
+    "@partynewpeople": -0.4,
+}
+
+# Веса признаков линейной модели
+WEIGHTS: Dict[str, float] = {
+    "positive": 1.0,
+    "negative": -1.2,
+    "prior": 1.0,
+    "length": 0.6,
+    "short": -1.5,
+    "links": -2.0,
+    "hashtags": -0.5,
+    "sources": 0.4,
+}
+
+_WORD_RE = re.compile(r"\w+")
+_LINK_RE = re.compile(r"https?://\S+|t\.me/\S+|@\w{5,}")
+_HASHTAG_RE = re.compile(r"#\w+")
+SHORT_TEXT_CHARS = 80
+
+
+def _parse_priors(raw: str) -> Dict[str, float]:
+    """Разбирает PRERANK_PRIORS вида "@канал:0.3,@другой:-0.5" """
+    priors = {}
+    for part in raw.split(","):
+        name, _, value = part.strip().partition(":")
+        if name and value:
+            try:
+                priors[name] = float(value)
+            except ValueError:
+                logger.warning(f"Некорректный приоритет канала: {part}")
+    return priors
+
+
+PRIORS = {**CHANNEL_PRIORS, **_parse_priors(os.getenv("PRERANK_PRIORS", ""))}
+
+
+def _stem_pattern(stems: Dict[str, float]) -> "re.Pattern[str]":
+    """Одно регулярное выражение на весь словарь: текст проходится один раз"""
+    alternatives = "|".join(sorted(map(re.escape, stems), key=len, reverse=True))
+    return re.compile(rf"\b({alternatives})", re.IGNORECASE)
+
+
+_POSITIVE_RE = _stem_pattern(POSITIVE_STEMS)
+_NEGATIVE_RE = _stem_pattern(NEGATIVE_STEMS)
+
+
+def _lexicon_score(
+    text: str, pattern: "re.Pattern[str]", stems: Dict[str, float]
+) -> float:
+    """Сумма весов основ, встретившихся в тексте (каждая - один раз)"""
+    found = {match.lower() for match in pattern.findall(text)}
+    return sum(stems[stem] for stem in found)
+
+
+def features(item: Dict[str, Any]) -> Dict[str, float]:
+    """Признаки новости для линейного скоринга"""
+    text = item.get("text") or ""
+    word_count = max(1, len(_WORD_RE.findall(text)))
+    return {
+        # log сглаживает насыщение: пятое упоминание науки мало что добавляет
+        "positive": math.log1p(
+            _lexicon_score(text, _POSITIVE_RE, POSITIVE_STEMS)
+        ),
+        "negative": math.log1p(
+            _lexicon_score(text, _NEGATIVE_RE, NEGATIVE_STEMS)
+        ),
+        "prior": PRIORS.get(item.get("channel_username", ""), 0.0),
+        "length": min(1.0, math.log1p(len(text)) / math.log1p(1500)),
+        "short": 1.0 if len(text.strip()) < SHORT_TEXT_CHARS else 0.0,
+        "links": min(1.0, len(_LINK_RE.findall(text)) * 5 / word_count),
+        "hashtags": min(1.0, len(_HASHTAG_RE.findall(text)) / 5),
+        # Новость, которую дали несколько каналов, скорее важна
+        "sources": math.log(max(1, len(item.get("merged_sources") or [1]))),
+    }
+
+
+def score(item: Dict[str, Any]) -> float:
+    """Локальная оценка новости: чем больше, тем интереснее аудитории"""
+    return sum(WEIGHTS[name] * value for name, value in features(item).items())
+
+
+def prerank(
+    news_items: List[Dict[str, Any]], top_k: Optional[int] = None
+) -> List[int]:
+    """
+    Отбирает кандидатов для оценки моделью.
+
+    Args:
+        news_items: Список новостей
+        top_k: Сколько оставить (по умолчанию PRERANK_TOP_K, 0 - всех)
+
+    Returns:
+        Индексы отобранных новостей в исходном порядке
+    """
+    top_k = PRERANK_TOP_K if top_k is None else top_k
+    if top_k <= 0 or len(news_items) <= top_k:
+        return list(range(len(news_items)))
+
+    scores = [score(item) for item in news_items]
+    best = sorted(
+        range(len(news_items)), key=lambda idx: scores[idx], reverse=True
+    )
+    selected = sorted(best[:top_k])
+    logger.info(
+        f"Предварительный отбор: {len(selected)} из {len(news_items)} новостей "
+        f"(порог {scores[best[top_k - 1]]:.2f})"
+    )
+    return selected
@@ -1,14 +1,45 @@
+import asyncio
+import contextvars
+import hashlib
 import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List, Optional
+from typing import Any, List, Optional
 
 from openai import OpenAI
+from llm import get_async_client, get_client
+from llm_cache import discard
 from loader import get_prompt
+from metrics import record_retry
+from routing import primary_model, route, route_async
+from tokens import (
+    ITEM_MAX_TOKENS,
+    LLM_MAX_OUTPUT_TOKENS,
+    count_messages,
+    count_tokens,
+    input_budget,
+    output_budget,
+    pack,
+    trim_to_tokens,
+)
 
 logger = logging.getLogger(__name__)
 
+# === Настройки пакетной оценки ===
+RATE_CHUNK_SIZE = int(os.getenv("RATE_CHUNK_SIZE", "20"))
+RATE_MAX_WORKERS = int(os.getenv("RATE_MAX_WORKERS", "4"))
+RATE_CHUNK_RETRIES = 1
+# Ожидаемый размер ответа: JSON-обёртка и одна оценка с обоснованием
+RATE_BASE_TOKENS = 50
+RATE_TOKENS_PER_ITEM = 80
+
+
+def _default_client() -> OpenAI:
+    """Возвращает общий клиент OpenAI (ответы кэшируются)"""
+    return get_client()
+
 
 @dataclass
 class RatingResult:
@@ -16,6 +47,65 @@ class RatingResult:
 
     score: float
     reasoning: str
+    fallback: bool = False
+    # Модель, которая дала оценку (при переключении - не основная)
+    model: Optional[str] = None
+
+
+def content_hash(content: str) -> str:
+    """Возвращает хэш текста новости для мемоизации оценок"""
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def prompt_version(model: Optional[str] = None) -> str:
+    """
+    Возвращает версию пакетной оценки: хэш промптов и модели.
+    Сохранённые оценки с другой версией считаются устаревшими.
+    """
+    raw = "\n".join(
+        [
+            get_prompt("RATE_BATCH_SYSTEM"),
+            get_prompt("RATE_BATCH_USER"),
+            model or primary_model("rate") or "",
+        ]
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _content_request(content: str, model: Optional[str]) -> dict:
+    """Собирает запрос оценки одной новости"""
+    return dict(
+        model=model,
+        messages=[
+            {
+                "role": "system",
+                "content": get_prompt("RATE_SYSTEM"),
+            },
+            {"role": "user", "content": get_prompt("RATE_USER", content=content)},
+        ],
+        temperature=0.3,
+    )
+
+
+def _parse_content(request: dict, response: Any) -> RatingResult:
+    """Разбирает ответ модели с оценкой одной новости"""
+    result_text = response.choices[0].message.content
+    try:
+        result_json = json.loads(result_text)
+    except json.JSONDecodeError as e:
+        logger.error(f"Failed to parse OpenAI response: {e}")
+        discard(request)
+        raise ValueError(f"Invalid rating response from OpenAI: {e}")
+
+    score = float(result_json.get("score", 0.5))
+    reasoning = str(result_json.get("reasoning", "No reasoning provided"))
+
+    # Ensure score is within bounds
+    score = max(0.0, min(1.0, score))
+
+    logger.info(f"Rating result: {score} - {reasoning}")
+
+    return RatingResult(score=score, reasoning=reasoning, model=request["model"])
 
 
 def rate_content(content: str, client: Optional[OpenAI] = None) -> RatingResult:
@@ -24,7 +114,7 @@ def rate_content(content: str, client: Optional[OpenAI] = None) -> RatingResult:
 
     Args:
         content: Текст новости для оценки
-        client: Экземпляр OpenAI клиента (создаёт новый, если не предоставлен)
+        client: Экземпляр OpenAI клиента (общий клиент, если не предоставлен)
 
     Returns:
         RatingResult с оценкой (0.0-1.0) и обоснованием
@@ -36,58 +126,181 @@ def rate_content(content: str, client: Optional[OpenAI] = None) -> RatingResult:
         raise ValueError("Content cannot be empty")
 
     if client is None:
-        client = OpenAI(
-            base_url=os.getenv("OPENAI_BASE_URL", "https://openrouter.ai/api/v1"),
-            api_key=os.getenv("OPENROUTER_API_KEY"),
+        client = _default_client()
+
+    try:
+        logger.info(f"Rating content: {content[:100]}...")
+        request, response = route(
+            "rate", lambda model: _content_request(content, model), client
         )
+        return _parse_content(request, response)
+    except Exception as e:
+        logger.error(f"Error rating content: {e}")
+        raise
 
-    model = os.getenv("MODEL")
+
+async def rate_content_async(
+    content: str, client: Optional[Any] = None
+) -> RatingResult:
+    """Асинхронный вариант rate_content (общий AsyncOpenAI клиент по умолчанию)"""
+    if not content or not content.strip():
+        raise ValueError("Content cannot be empty")
+
+    if client is None:
+        client = get_async_client()
 
     try:
         logger.info(f"Rating content: {content[:100]}...")
-
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": get_prompt("RATE_SYSTEM"),
-                },
-                {"role": "user", "content": get_prompt("RATE_USER", content=content)},
-            ],
-            temperature=0.3,
+        request, response = await route_async(
+            "rate", lambda model: _content_request(content, model), client
         )
+        return _parse_content(request, response)
+    except Exception as e:
+        logger.error(f"Error rating content: {e}")
+        raise
+
 
+def _batch_request(contents: List[str], model: Optional[str]) -> dict:
+    """Собирает запрос оценки пакета новостей"""
+    numbered = "\n\n".join([f"{i+1}. {text}" for i, text in enumerate(contents)])
+    system = get_prompt("RATE_BATCH_SYSTEM")
+    user = get_prompt("RATE_BATCH_USER", numbered_items=numbered)
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user},
+    ]
+    expected = RATE_BASE_TOKENS + RATE_TOKENS_PER_ITEM * len(contents)
+
+    return dict(
+        model=model,
+        messages=messages,
+        temperature=0.3,
+        max_tokens=output_budget(model, count_messages(messages, model), expected),
+    )
+
+
+def _parse_batch(request: dict, response: Any, count: int) -> List[RatingResult]:
+    """Разбирает ответ модели с оценками пакета новостей"""
+    try:
         result_text = response.choices[0].message.content
-        result_json = json.loads(result_text)
+        data = json.loads(result_text)
+        results: List[RatingResult] = []
+        for i, item in enumerate(data):
+            score = float(item.get("score", 0.5))
+            reasoning = str(item.get("reasoning", "No reasoning"))
+            score = max(0.0, min(1.0, score))
+            results.append(
+                RatingResult(score=score, reasoning=reasoning, model=request["model"])
+            )
+        if len(results) != count:
+            raise ValueError("Batch rating length mismatch")
+    except Exception:
+        # Не даём повтору получить тот же негодный ответ из кэша
+        discard(request)
+        raise
+    return results
 
-        score = float(result_json.get("score", 0.5))
-        reasoning = str(result_json.get("reasoning", "No reasoning provided"))
 
-        # Ensure score is within bounds
-        score = max(0.0, min(1.0, score))
+def _fallback_rating() -> RatingResult:
+    """Нейтральная оценка для новости, которую не удалось оценить"""
+    return RatingResult(score=0.5, reasoning="Fallback due to error", fallback=True)
 
-        logger.info(f"Rating result: {score} - {reasoning}")
 
-        return RatingResult(score=score, reasoning=reasoning)
+def _rate_chunk(contents: List[str], client: OpenAI) -> List[RatingResult]:
+    """
+    Оценивает пакет с повтором при ошибке; если пакет так и не удалось
+    оценить, каждая его новость оценивается отдельно через rate_content.
+    """
+    for attempt in range(RATE_CHUNK_RETRIES + 1):
+        if attempt:
+            record_retry()
+        try:
+            logger.info(f"Batch rating {len(contents)} items...")
+            request, response = route(
+                "rate", lambda model: _batch_request(contents, model), client
+            )
+            return _parse_batch(request, response, len(contents))
+        except Exception as e:
+            logger.error(f"Error in batch rating (attempt {attempt + 1}): {e}")
+
+    logger.warning(f"Rating {len(contents)} items one by one after batch failure")
+    results: List[RatingResult] = []
+    for content in contents:
+        try:
+            results.append(rate_content(content, client))
+        except Exception:
+            # Fallback: neutral score only for the item that failed
+            results.append(_fallback_rating())
+    return results
 
-    except json.JSONDecodeError as e:
-        logger.error(f"Failed to parse OpenAI response: {e}")
-        raise ValueError(f"Invalid rating response from OpenAI: {e}")
-    except Exception as e:
-        logger.error(f"Error rating content: {e}")
-        raise
+
+async def _rate_chunk_async(contents: List[str], client: Any) -> List[RatingResult]:
+    """Асинхронный вариант _rate_chunk"""
+    for attempt in range(RATE_CHUNK_RETRIES + 1):
+        if attempt:
+            record_retry()
+        try:
+            logger.info(f"Batch rating {len(contents)} items...")
+            request, response = await route_async(
+                "rate", lambda model: _batch_request(contents, model), client
+            )
+            return _parse_batch(request, response, len(contents))
+        except Exception as e:
+            logger.error(f"Error in batch rating (attempt {attempt + 1}): {e}")
+
+    logger.warning(f"Rating {len(contents)} items one by one after batch failure")
+    singles = await asyncio.gather(
+        *(rate_content_async(content, client) for content in contents),
+        return_exceptions=True,
+    )
+    return [
+        result if isinstance(result, RatingResult) else _fallback_rating()
+        for result in singles
+    ]
+
+
+def _chunks(
+    contents: List[str], chunk_size: Optional[int], model: Optional[str]
+) -> List[List[str]]:
+    """
+    Делит список новостей на пакеты: не больше chunk_size новостей и не
+    больше, чем помещается в контекст модели вместе с ответом на них.
+    """
+    size = max(1, chunk_size or RATE_CHUNK_SIZE)
+    size = min(size, max(1, LLM_MAX_OUTPUT_TOKENS // RATE_TOKENS_PER_ITEM))
+    overhead = count_tokens(get_prompt("RATE_BATCH_SYSTEM"), model) + count_tokens(
+        get_prompt("RATE_BATCH_USER", numbered_items=""), model
+    )
+    budget = input_budget(
+        model, RATE_BASE_TOKENS + RATE_TOKENS_PER_ITEM * size, overhead
+    )
+    # "N. " и перевод строки между новостями
+    costs = [count_tokens(text, model) + 4 for text in contents]
+    return [contents[start:end] for start, end in pack(costs, budget, size)]
+
+
+def _trim_all(contents: List[str], model: Optional[str]) -> List[str]:
+    """Обрезает слишком длинные новости до ITEM_MAX_TOKENS"""
+    return [trim_to_tokens(text, ITEM_MAX_TOKENS, model) for text in contents]
 
 
 def rate_batch(
-    contents: List[str], client: Optional[OpenAI] = None
+    contents: List[str],
+    client: Optional[OpenAI] = None,
+    chunk_size: Optional[int] = None,
 ) -> List[RatingResult]:
     """
-    Оценивает несколько контентов в одном вызове модели для снижения количества запросов.
+    Оценивает несколько контентов пакетами.
+
+    Пакеты отправляются параллельно, поэтому время оценки определяется самым
+    медленным пакетом, а не одним огромным запросом. Ошибка в пакете
+    затрагивает только его новости. Размер пакета ограничен chunk_size и
+    контекстом модели, слишком длинные новости обрезаются.
 
     Args:
         contents: Список новостей/текстов для оценки
         client: Опциональный OpenAI клиент
+        chunk_size: Наибольший размер пакета (по умолчанию RATE_CHUNK_SIZE)
 
     Returns:
         Список RatingResult в исходном порядке
@@ -96,42 +309,46 @@ def rate_batch(
         return []
 
     if client is None:
-        client = OpenAI(
-            base_url=os.getenv("OPENAI_BASE_URL", "https://openrouter.ai/api/v1"),
-            api_key=os.getenv("OPENROUTER_API_KEY"),
-        )
-
-    model = os.getenv("MODEL")
+        client = _default_client()
 
-    numbered = "\n\n".join([f"{i+1}. {text}" for i, text in enumerate(contents)])
-    system = get_prompt("RATE_BATCH_SYSTEM")
-    user = get_prompt("RATE_BATCH_USER", numbered_items=numbered)
+    model = primary_model("rate")
 
-    try:
-        logger.info(f"Batch rating {len(contents)} items...")
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": user},
-            ],
-            temperature=0.3,
-        )
+    chunks = _chunks(_trim_all(contents, model), chunk_size, model)
+    if len(chunks) == 1:
+        return _rate_chunk(chunks[0], client)
 
-        result_text = response.choices[0].message.content
-        data = json.loads(result_text)
-        results: List[RatingResult] = []
-        for i, item in enumerate(data):
-            score = float(item.get("score", 0.5))
-            reasoning = str(item.get("reasoning", "No reasoning"))
-            score = max(0.0, min(1.0, score))
-            results.append(RatingResult(score=score, reasoning=reasoning))
-        if len(results) != len(contents):
-            raise ValueError("Batch rating length mismatch")
-        return results
-    except Exception as e:
-        logger.error(f"Error in batch rating: {e}")
-        # Fallback: neutral scores
-        return [
-            RatingResult(score=0.5, reasoning="Fallback due to error") for _ in contents
+    # Каждый поток получает копию контекста, чтобы вызовы попали в метрики этапа
+    with ThreadPoolExecutor(max_workers=min(RATE_MAX_WORKERS, len(chunks))) as pool:
+        futures = [
+            pool.submit(
+                contextvars.copy_context().run, _rate_chunk, chunk, client
+            )
+            for chunk in chunks
         ]
+        parts = [future.result() for future in futures]
+
+    return [result for part in parts for result in part]
+
+
+async def rate_batch_async(
+    contents: List[str],
+    client: Optional[Any] = None,
+    chunk_size: Optional[int] = None,
+) -> List[RatingResult]:
+    """
+    Асинхронный вариант rate_batch: пакеты выполняются конкурентно на общем
+    пуле соединений (конкурентность регулирует governor).
+    """
+    if not contents:
+        return []
+
+    if client is None:
+        client = get_async_client()
+
+    model = primary_model("rate")
+
+    chunks = _chunks(_trim_all(contents, model), chunk_size, model)
+    parts = await asyncio.gather(
+        *(_rate_chunk_async(chunk, client) for chunk in chunks)
+    )
+    return [result for part in parts for result in part]
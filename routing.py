@@ -0,0 +1,149 @@
+"""
+Модуль выбора модели для этапов конвейера с цепочкой запасных моделей.
+
+Модели этапа задаются переменной MODEL_<ЭТАП> списком через запятую
+(первая - основная, остальные - запасные), например:
+    MODEL_RATE=openai/gpt-4o-mini,google/gemini-flash-1.5
+Без неё этап использует MODEL. ROUTE_TIMEOUT_<ЭТАП> ограничивает время
+одного HTTP-запроса (ожидание в очереди регулятора не считается). Таймаут
+или 5xx сразу передают запрос следующей модели (регулятор не повторяет их,
+пока в цепочке есть запасная), 429 - после повторов регулятора; остальные
+ошибки (например, 400 на неверный запрос) на других моделях не повторяются.
+"""
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from governor import failover_available, is_overload
+
+logger = logging.getLogger(__name__)
+
+# Таймаут HTTP-запроса по умолчанию для всех этапов (0 - без ограничения)
+ROUTE_TIMEOUT = float(os.getenv("ROUTE_TIMEOUT", "0"))
+# Сколько секунд отказавшая модель идёт в конце цепочки этапа
+ROUTE_COOLDOWN = float(os.getenv("ROUTE_COOLDOWN", "300"))
+
+# Отказы учитываются по паре (этап, модель): таймаут длинной суммаризации
+# не должен понижать ту же модель для коротких запросов оценки
+_failed_at: Dict[Tuple[str, Optional[str]], float] = {}
+_lock = threading.Lock()
+
+
+def models_for(stage: str) -> List[Optional[str]]:
+    """Цепочка моделей этапа в порядке конфигурации"""
+    raw = os.getenv(f"MODEL_{stage.upper()}") or os.getenv("MODEL") or ""
+    models = [model.strip() for model in raw.split(",") if model.strip()]
+    return models or [None]
+
+
+def primary_model(stage: str) -> Optional[str]:
+    """Основная модель этапа"""
+    return models_for(stage)[0]
+
+
+def stage_timeout(stage: str) -> Optional[float]:
+    """Таймаут HTTP-запроса этапа в секундах (None - без ограничения)"""
+    raw = os.getenv(f"ROUTE_TIMEOUT_{stage.upper()}")
+    timeout = float(raw) if raw else ROUTE_TIMEOUT
+    return timeout if timeout > 0 else None
+
+
+def _ordered(stage: str) -> List[Optional[str]]:
+    """Цепочка моделей, где недавно отказавшие перенесены в конец"""
+    now = time.monotonic()
+    with _lock:
+        recent = {
+            model
+            for (failed_stage, model), failed in _failed_at.items()
+            if failed_stage == stage and now - failed < ROUTE_COOLDOWN
+        }
+    models = models_for(stage)
+    return [m for m in models if m not in recent] + [m for m in models if m in recent]
+
+
+def _mark_failed(stage: str, model: Optional[str], error: Exception) -> None:
+    if model is None:
+        return
+    with _lock:
+        _failed_at[(stage, model)] = time.monotonic()
+    logger.warning(f"Модель {model} не ответила на этапе {stage}: {error!r}")
+
+
+def _mark_ok(stage: str, model: Optional[str]) -> None:
+    if model is not None and (stage, model) in _failed_at:
+        with _lock:
+            _failed_at.pop((stage, model), None)
+
+
+def _with_timeout(request: dict, timeout: Optional[float]) -> dict:
+    """
+    Параметры вызова клиента: таймаут уходит в SDK openai и ограничивает
+    каждую HTTP-попытку, а не ожидание лимитов и паузы между повторами
+    """
+    return {**request, "timeout": timeout} if timeout else request
+
+
+async def route_async(
+    stage: str, build_request: Callable[[Optional[str]], dict], client: Any
+) -> Tuple[dict, Any]:
+    """
+    Отправляет запрос этапа первой доступной модели цепочки.
+
+    Args:
+        stage: Имя этапа (rate, dedup, summarize, format, digest, moderate)
+        build_request: Функция, собирающая запрос для заданной модели
+        client: Асинхронный OpenAI клиент
+
+    Returns:
+        Отправленный запрос и ответ модели
+
+    Raises:
+        Ошибку, не связанную с доступностью модели, сразу, а таймаут,
+        429 или 5xx - если не ответила ни одна модель цепочки
+    """
+    timeout = stage_timeout(stage)
+    last_error: Optional[Exception] = None
+    models = _ordered(stage)
+    for position, model in enumerate(models, 1):
+        request = build_request(model)
+        try:
+            with failover_available(position < len(models)):
+                response = await client.chat.completions.create(
+                    **_with_timeout(request, timeout)
+                )
+        except Exception as e:
+            if not is_overload(e):
+                raise
+            last_error = e
+            _mark_failed(stage, model, e)
+            continue
+        _mark_ok(stage, model)
+        return request, response
+    raise last_error
+
+
+def route(
+    stage: str, build_request: Callable[[Optional[str]], dict], client: Any
+) -> Tuple[dict, Any]:
+    """Синхронный вариант route_async"""
+    timeout = stage_timeout(stage)
+    last_error: Optional[Exception] = None
+    models = _ordered(stage)
+    for position, model in enumerate(models, 1):
+        request = build_request(model)
+        try:
+            with failover_available(position < len(models)):
+                response = client.chat.completions.create(
+                    **_with_timeout(request, timeout)
+                )
+        except Exception as e:
+            if not is_overload(e):
+                raise
+            last_error = e
+            _mark_failed(stage, model, e)
+            continue
+        _mark_ok(stage, model)
+        return request, response
+    raise last_error
@@ -0,0 +1,100 @@
+"""
+Модуль локального поиска почти-дубликатов текстов (MinHash + LSH)
+"""
+import random
+import re
+import zlib
+from collections import defaultdict
+from typing import Dict, List, Set, Tuple
+
+# 32 полосы по 3 строки: пара становится кандидатом с вероятностью
+# 1 - (1 - s^3)^32, порог около (1/32)^(1/3) ≈ 0.3 - чуть выше
+# DEDUP_CANDIDATE_THRESHOLD. Пары со сходством 0.1 проходят в ~3% случаев,
+# 0.5 - в 98%
+NUM_PERM = 96
+LSH_BANDS = 32
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+_rng = random.Random(1)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)
+]
+
+_URL_RE = re.compile(r"https?://\S+|t\.me/\S+")
+_WORD_RE = re.compile(r"\w+")
+
+
+def shingles(text: str, stem: int = 6, min_len: int = 4) -> Set[int]:
+    """
+    Превращает текст в множество хэшей нормализованных слов.
+
+    Ссылки отбрасываются, короткие служебные слова пропускаются, а слова
+    обрезаются до stem символов - грубая замена стеммингу, чтобы разные
+    падежи одного слова совпадали.
+    """
+    text = _URL_RE.sub(" ", text.lower())
+    return {
+        zlib.crc32(word[:stem].encode("utf-8"))
+        for word in _WORD_RE.findall(text)
+        if len(word) >= min_len
+    }
+
+
+def minhash(features: Set[int]) -> Tuple[int, ...]:
+    """Вычисляет MinHash-сигнатуру множества признаков"""
+    if not features:
+        return tuple([_MAX_HASH] * NUM_PERM)
+    return tuple(
+        min(((a * x + b) % _PRIME) & _MAX_HASH for x in features)
+        for a, b in _PERMUTATIONS
+    )
+
+
+def jaccard(features_a: Set[int], features_b: Set[int]) -> float:
+    """Точный коэффициент Жаккара двух множеств признаков"""
+    if not features_a or not features_b:
+        return 0.0
+    common = len(features_a & features_b)
+    return common / (len(features_a) + len(features_b) - common)
+
+
+def candidate_pairs(signatures: List[Tuple[int, ...]]) -> Set[Tuple[int, int]]:
+    """
+    Находит пары-кандидаты через LSH: сигнатуры режутся на полосы, и пары,
+    совпавшие хотя бы в одной полосе, попадают в кандидаты.
+    """
+    rows = NUM_PERM // LSH_BANDS
+    pairs: Set[Tuple[int, int]] = set()
+    for band in range(LSH_BANDS):
+        buckets: Dict[Tuple[int, ...], List[int]] = defaultdict(list)
+        for idx, sig in enumerate(signatures):
+            if sig[0] == _MAX_HASH:
+                continue  # пустой текст не сравниваем
+            buckets[sig[band * rows : (band + 1) * rows]].append(idx)
+        for members in buckets.values():
+            for i in range(len(members)):
+                for j in range(i + 1, len(members)):
+                    pairs.add((members[i], members[j]))
+    return pairs
+
+
+def similar_pairs(texts: List[str]) -> List[Tuple[int, int, float]]:
+    """
+    Возвращает пары похожих текстов со сходством.
+
+    LSH только отбирает кандидатов, а сходство считается точно по множествам
+    признаков: оценка по сигнатуре слишком шумная для порогов дедупликации.
+
+    Args:
+        texts: Список текстов
+
+    Returns:
+        Список (i, j, сходство) для пар-кандидатов, i < j
+    """
+    features = [shingles(text) for text in texts]
+    signatures = [minhash(item) for item in features]
+    return [
+        (i, j, jaccard(features[i], features[j]))
+        for i, j in sorted(candidate_pairs(signatures))
+    ]
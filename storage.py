@@ -0,0 +1,250 @@
+"""
+Модуль постоянного состояния бота в SQLite
+"""
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# === Настройки хранилища ===
+STATE_DB_FILE = os.getenv("STATE_DB_FILE", "state.db")
+PROCESSED_RETENTION_DAYS = int(os.getenv("PROCESSED_RETENTION_DAYS", "30"))
+# Служебный этап контрольных точек: смещение снимка в журнале кэша
+PIN_STAGE = "pin"
+
+
+def connect(path: str = STATE_DB_FILE) -> sqlite3.Connection:
+    """Открывает базу состояния в режиме WAL"""
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class ProcessedStore:
+    """
+    Множество обработанных сообщений с ключом (канал, message_id).
+
+    ID сообщений уникальны только внутри канала, поэтому канал входит в ключ.
+    Проверка принадлежности - поиск по первичному ключу, запись - только
+    новых строк, старые записи удаляются по сроку хранения.
+    """
+
+    def __init__(self, path: str = STATE_DB_FILE) -> None:
+        self.conn = connect(path)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS processed (
+                channel TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                seen_at REAL NOT NULL,
+                PRIMARY KEY (channel, message_id)
+            ) WITHOUT ROWID
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS processed_seen_at ON processed (seen_at)"
+        )
+        self.conn.commit()
+
+    def __contains__(self, key: Tuple[str, int]) -> bool:
+        channel, message_id = key
+        row = self.conn.execute(
+            "SELECT 1 FROM processed WHERE channel = ? AND message_id = ?",
+            (channel, message_id),
+        ).fetchone()
+        return row is not None
+
+    def add_many(self, keys: Iterable[Tuple[str, int]]) -> None:
+        """Отмечает сообщения обработанными одной транзакцией"""
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO processed (channel, message_id, seen_at) "
+            "VALUES (?, ?, ?)",
+            [(channel, message_id, now) for channel, message_id in keys],
+        )
+        self.conn.commit()
+
+    def prune(self, retention_days: Optional[int] = None) -> int:
+        """Удаляет записи старше срока хранения и возвращает их количество"""
+        days = PROCESSED_RETENTION_DAYS if retention_days is None else retention_days
+        cutoff = time.time() - days * 24 * 3600
+        cursor = self.conn.execute(
+            "DELETE FROM processed WHERE seen_at < ?", (cutoff,)
+        )
+        self.conn.commit()
+        if cursor.rowcount:
+            logger.info(f"Удалено {cursor.rowcount} устаревших записей о сообщениях")
+        return cursor.rowcount
+
+    def close(self) -> None:
+        """Закрывает соединение с базой"""
+        self.conn.close()
+
+
+class RatingStore:
+    """
+    Сохранённые оценки новостей с ключом (хэш текста, версия промпта).
+
+    Новость, пролежавшая в кэше несколько неудачных попыток публикации,
+    оценивается моделью один раз.
+    """
+
+    def __init__(self, path: str = STATE_DB_FILE) -> None:
+        self.conn = connect(path)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ratings (
+                text_hash TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                score REAL NOT NULL,
+                reason TEXT NOT NULL,
+                rated_at REAL NOT NULL,
+                PRIMARY KEY (text_hash, prompt_version)
+            ) WITHOUT ROWID
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS ratings_rated_at ON ratings (rated_at)"
+        )
+        self.conn.commit()
+
+    def get_many(
+        self, text_hashes: List[str], prompt_version: str
+    ) -> Dict[str, Tuple[float, str]]:
+        """Возвращает известные оценки: хэш текста -> (оценка, обоснование)"""
+        found: Dict[str, Tuple[float, str]] = {}
+        unique = list(dict.fromkeys(text_hashes))
+        # Пакеты по 500, чтобы не упереться в лимит параметров SQLite
+        for i in range(0, len(unique), 500):
+            chunk = unique[i : i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                "SELECT text_hash, score, reason FROM ratings "
+                f"WHERE prompt_version = ? AND text_hash IN ({placeholders})",
+                [prompt_version, *chunk],
+            )
+            for text_hash, score, reason in rows:
+                found[text_hash] = (score, reason)
+        return found
+
+    def put_many(
+        self, ratings: Iterable[Tuple[str, float, str]], prompt_version: str
+    ) -> None:
+        """Сохраняет оценки (хэш текста, оценка, обоснование) одной транзакцией"""
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO ratings "
+            "(text_hash, prompt_version, score, reason, rated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [
+                (text_hash, prompt_version, score, reason, now)
+                for text_hash, score, reason in ratings
+            ],
+        )
+        self.conn.commit()
+
+    def prune(self, retention_days: Optional[int] = None) -> int:
+        """Удаляет оценки старше срока хранения"""
+        days = PROCESSED_RETENTION_DAYS if retention_days is None else retention_days
+        cutoff = time.time() - days * 24 * 3600
+        cursor = self.conn.execute("DELETE FROM ratings WHERE rated_at < ?", (cutoff,))
+        self.conn.commit()
+        return cursor.rowcount
+
+    def close(self) -> None:
+        """Закрывает соединение с базой"""
+        self.conn.close()
+
+
+class CheckpointStore:
+    """
+    Промежуточные результаты публикации с ключом (снимок кэша, этап).
+
+    Снимок - хэш содержимого кэша новостей. Повтор сорвавшейся публикации
+    читает кэш до закреплённого смещения (pin), то есть тот же снимок, и
+    продолжает с первого незавершённого этапа. Значения хранятся в JSON.
+    """
+
+    def __init__(self, path: str = STATE_DB_FILE) -> None:
+        self.conn = connect(path)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                snapshot TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                saved_at REAL NOT NULL,
+                PRIMARY KEY (snapshot, stage)
+            ) WITHOUT ROWID
+            """
+        )
+        self.conn.commit()
+
+    def get(self, snapshot: str, stage: str) -> Optional[Any]:
+        """Возвращает сохранённый результат этапа или None"""
+        row = self.conn.execute(
+            "SELECT payload FROM checkpoints WHERE snapshot = ? AND stage = ?",
+            (snapshot, stage),
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, snapshot: str, stage: str, value: Any) -> None:
+        """Сохраняет результат этапа"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO checkpoints (snapshot, stage, payload, saved_at) "
+            "VALUES (?, ?, ?, ?)",
+            (snapshot, stage, json.dumps(value, ensure_ascii=False), time.time()),
+        )
+        self.conn.commit()
+
+    def pin(self, snapshot: str, offset: int) -> None:
+        """
+        Запоминает, до какого смещения журнала кэша прочитан снимок: повтор
+        после сбоя возьмёт те же новости, даже если в кэш дописаны новые
+        """
+        self.put(snapshot, PIN_STAGE, offset)
+
+    def pinned(self, max_age: float) -> Optional[Tuple[str, int]]:
+        """
+        Снимок незавершённой публикации и его смещение в журнале, если он
+        закреплён не раньше, чем max_age секунд назад
+        """
+        row = self.conn.execute(
+            "SELECT snapshot, payload FROM checkpoints "
+            "WHERE stage = ? AND saved_at >= ? ORDER BY saved_at DESC LIMIT 1",
+            (PIN_STAGE, time.time() - max_age),
+        ).fetchone()
+        return (row[0], json.loads(row[1])) if row is not None else None
+
+    def retain(self, snapshot: str) -> int:
+        """
+        Удаляет контрольные точки других снимков: после изменения кэша
+        они больше не пригодятся
+        """
+        cursor = self.conn.execute(
+            "DELETE FROM checkpoints WHERE snapshot != ?", (snapshot,)
+        )
+        self.conn.commit()
+        return cursor.rowcount
+
+    def drop(self, snapshot: str, stage: str) -> None:
+        """Удаляет результат этапа, чтобы повтор выполнил этап заново"""
+        self.conn.execute(
+            "DELETE FROM checkpoints WHERE snapshot = ? AND stage = ?",
+            (snapshot, stage),
+        )
+        self.conn.commit()
+
+    def clear(self, snapshot: str) -> None:
+        """Удаляет контрольные точки снимка после успешной публикации"""
+        self.conn.execute("DELETE FROM checkpoints WHERE snapshot = ?", (snapshot,))
+        self.conn.commit()
+
+    def close(self) -> None:
+        """Закрывает соединение с базой"""
+        self.conn.close()
@@ -1,59 +1,193 @@
 import logging
-import os
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from openai import OpenAI
+from llm import get_async_client, get_client
+from llm_cache import discard
 from loader import get_prompt
+from routing import route, route_async
+from tokens import (
+    ITEM_MAX_TOKENS,
+    count_messages,
+    count_tokens,
+    input_budget,
+    output_budget,
+    trim_to_tokens,
+)
 
 logger = logging.getLogger(__name__)
 
+# Ожидаемый размер дайджеста: вступление и абзац на каждую новость
+SUMMARY_BASE_TOKENS = 200
+SUMMARY_TOKENS_PER_ITEM = 60
+SUMMARY_TEMPERATURE = 0.1
+
 
 def _default_client() -> OpenAI:
-    """Создаёт клиент OpenAI по умолчанию"""
-    return OpenAI(
-        base_url=os.getenv("OPENAI_BASE_URL", "https://openrouter.ai/api/v1"),
-        api_key=os.getenv("OPENROUTER_API_KEY"),
+    """Возвращает общий клиент OpenAI (ответы кэшируются)"""
+    return get_client()
+
+
+def pack_news_list(
+    news_items: List[Dict[str, Any]], budget: int, model: Optional[str]
+) -> Tuple[str, int]:
+    """
+    Нумерованный список новостей со ссылками на источник в пределах budget
+    токенов. Длинные посты обрезаются до ITEM_MAX_TOKENS, не вошедшие в
+    бюджет новости отбрасываются с конца.
+
+    Returns:
+        Текст списка и число вошедших новостей
+    """
+    news_list = ""
+    used = 0
+    kept = 0
+    for i, item in enumerate(news_items):
+        text = trim_to_tokens(item["text"], ITEM_MAX_TOKENS, model)
+        line = f"{i + 1}. {text} t.me/{item['channel_username'].replace('@', '')}/{item['message_id']}\n\n"
+        cost = count_tokens(line, model)
+        if kept and used + cost > budget:
+            logger.warning(
+                f"В контекст модели вошло {kept} новостей из {len(news_items)}"
+            )
+            break
+        news_list += line
+        used += cost
+        kept += 1
+    return news_list, kept
+
+
+def _summarize_request(
+    news_items: List[Dict[str, Any]],
+    feedback: Optional[str],
+    model: Optional[str],
+    temperature: float = SUMMARY_TEMPERATURE,
+) -> dict:
+    """
+    Собирает запрос на генерацию дайджеста.
+
+    Длинные посты обрезаются до ITEM_MAX_TOKENS. Новости идут по убыванию
+    рейтинга, поэтому если все не помещаются в контекст, отбрасываются
+    последние. max_tokens рассчитывается по числу вошедших новостей.
+    """
+    messages = [
+        {
+            "role": "system",
+            "content": get_prompt("SUMMARIZE_SYSTEM"),
+        },
+        {"role": "user", "content": ""},
+    ]
+    if feedback and feedback.strip():
+        messages.append(
+            {
+                "role": "user",
+                "content": get_prompt("SUMMARIZE_FEEDBACK", feedback=feedback),
+            }
+        )
+
+    overhead = count_messages(messages, model) + count_tokens(
+        get_prompt("SUMMARIZE_USER", news_list=""), model
+    )
+    budget = input_budget(
+        model,
+        SUMMARY_BASE_TOKENS + SUMMARY_TOKENS_PER_ITEM * len(news_items),
+        overhead,
     )
 
+    news_list, kept = pack_news_list(news_items, budget, model)
+    messages[1]["content"] = get_prompt("SUMMARIZE_USER", news_list=news_list)
+    expected = SUMMARY_BASE_TOKENS + SUMMARY_TOKENS_PER_ITEM * kept
+    max_tokens = output_budget(model, count_messages(messages, model), expected)
+
+    return dict(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=temperature,
+    )
+
+
+def _parse_summary(request: dict, completion: Any) -> str:
+    """Извлекает текст дайджеста из ответа модели"""
+    choice = completion.choices[0]
+    if choice.finish_reason == "length":
+        # Текст, оборванный на полуслове, нельзя ни публиковать, ни кэшировать
+        discard(request)
+        raise ValueError("Сводка обрезана по max_tokens")
+    content = choice.message.content
+    if not content or not content.strip():
+        discard(request)
+    return content
+
 
 def summarize_news(
     news_items: List[Dict[str, Any]],
     client: Optional[OpenAI] = None,
     feedback: Optional[str] = None,
-) -> str:
-    """Генерирует краткий дайджест из собранных новостей"""
+    temperature: float = SUMMARY_TEMPERATURE,
+) -> Optional[str]:
+    """
+    Генерирует краткий дайджест из собранных новостей.
+    При ошибке модели возвращает None: текст-заглушку нельзя ни публиковать,
+    ни сохранять как контрольную точку.
+    """
     if not news_items:
         return ""
 
-    news_list = ""
-    for i, item in enumerate(news_items):
-        news_list += f"{i + 1}. {item['text']} t.me/{item['channel_username'].replace('@', '')}/{item['message_id']}\n\n"
-    
-    prompt = get_prompt("SUMMARIZE_USER", news_list=news_list)
-
     ai_client = client or _default_client()
-    model = os.getenv("MODEL")
 
     try:
-        messages = [
-            {
-                "role": "system",
-                "content": get_prompt("SUMMARIZE_SYSTEM"),
-            },
-            {"role": "user", "content": prompt},
-        ]
-        if feedback and feedback.strip():
-            messages.append(
-                {
-                    "role": "user",
-                    "content": get_prompt("SUMMARIZE_FEEDBACK", feedback=feedback),
-                }
-            )
+        request, completion = route(
+            "summarize",
+            lambda model: _summarize_request(
+                news_items, feedback, model, temperature
+            ),
+            ai_client,
+        )
+        return _parse_summary(request, completion)
+    except Exception as e:
+        logger.error("Ошибка при генерации сводки: %s", e)
+        return None
+
+
+async def summarize_news_async(
+    news_items: List[Dict[str, Any]],
+    client: Optional[Any] = None,
+    feedback: Optional[str] = None,
+    temperature: float = SUMMARY_TEMPERATURE,
+) -> Optional[str]:
+    """Асинхронный вариант summarize_news (общий AsyncOpenAI клиент по умолчанию)"""
+    summary, _ = await summarize_with_request_async(
+        news_items, client, feedback, temperature
+    )
+    return summary
+
+
+async def summarize_with_request_async(
+    news_items: List[Dict[str, Any]],
+    client: Optional[Any] = None,
+    feedback: Optional[str] = None,
+    temperature: float = SUMMARY_TEMPERATURE,
+) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """
+    Как summarize_news_async, но вместе со сводкой возвращает запрос, на
+    который она получена (None, если запроса не было): по нему ответ
+    удаляется из кэша LLM, когда сводку отклоняет финальная модерация.
+    """
+    if not news_items:
+        return "", None
 
-        completion = ai_client.chat.completions.create(
-            model=model, messages=messages, max_tokens=1024, temperature=0.1
+    ai_client = client or get_async_client()
+
+    try:
+        request, completion = await route_async(
+            "summarize",
+            lambda model: _summarize_request(
+                news_items, feedback, model, temperature
+            ),
+            ai_client,
         )
-        return completion.choices[0].message.content
+        return _parse_summary(request, completion), request
     except Exception as e:
         logger.error("Ошибка при генерации сводки: %s", e)
-        return "Ошибка при генерации сводки. Попробуйте позже."
+        return None, None
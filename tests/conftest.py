@@ -0,0 +1,8 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Тесты не ходят в сеть и не пишут на диск кэш ответов модели
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+os.environ.setdefault("LLM_CACHE", "0")
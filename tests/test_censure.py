@@ -0,0 +1,56 @@
+import asyncio
+import json
+import re
+from types import SimpleNamespace
+
+from censure import CATEGORIES, moderate_batch_async, should_block_content
+
+TEXTS = ["Президент подписал указ о грантах", "Митинг студентов у вуза"]
+
+
+def _completion(arguments):
+    function = SimpleNamespace(arguments=json.dumps(arguments))
+    message = SimpleNamespace(tool_calls=[SimpleNamespace(function=function)])
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+def _scores(score):
+    return {category: {"score": score, "flags": []} for category in CATEGORIES}
+
+
+class FakeModerationClient:
+    """Текст о митинге в пакетном ответе всегда без оценок"""
+
+    def __init__(self):
+        self.batch_calls = 0
+        self.single_calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **kwargs):
+        if kwargs["tools"][0]["function"]["name"] == "batch_content_moderation":
+            self.batch_calls += 1
+            content = kwargs["messages"][0]["content"]
+            items = []
+            for text in TEXTS:
+                match = re.search(rf"^(\d+)\. {re.escape(text)}$", content, re.M)
+                if match is None:
+                    continue
+                if text.startswith("Митинг"):
+                    scores = {category: {} for category in CATEGORIES}
+                else:
+                    scores = _scores(0.1)
+                items.append({"id": int(match.group(1)), **scores})
+            return _completion({"items": items})
+        self.single_calls += 1
+        return _completion(_scores(0.2))
+
+
+def test_batch_entry_without_scores_falls_back_to_single_request():
+    client = FakeModerationClient()
+    results = asyncio.run(moderate_batch_async(TEXTS, client))
+
+    assert client.batch_calls == 2  # пакет и переспрос пропущенного текста
+    assert client.single_calls == 1
+    assert results[0]["categories"]["violence"]["score"] == 0.1
+    assert results[1]["categories"]["violence"]["score"] == 0.2
+    assert not any(should_block_content(result) for result in results)
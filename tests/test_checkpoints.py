@@ -0,0 +1,65 @@
+import asyncio
+from types import SimpleNamespace
+
+import logic
+from format import format_for_telegram_async
+from rate import RatingResult
+from storage import CheckpointStore, RatingStore
+
+NEWS = [
+    {"text": f"Новость номер {i}", "channel_username": "@ch", "message_id": i}
+    for i in range(3)
+]
+
+
+def test_fallback_ratings_are_not_checkpointed(tmp_path, monkeypatch):
+    async def rate_batch(texts, client_ai):
+        return [RatingResult(0.5, "запасная оценка", fallback=True) for _ in texts]
+
+    db = str(tmp_path / "state.db")
+    monkeypatch.setattr(logic, "PREMODERATION", False)
+    monkeypatch.setattr(logic, "rate_batch_async", rate_batch)
+    monkeypatch.setattr(logic, "RatingStore", lambda: RatingStore(db))
+    monkeypatch.setattr(logic, "get_context", lambda: SimpleNamespace(ai=None))
+    checkpoints = CheckpointStore(db)
+
+    best_news = asyncio.run(
+        logic._checkpointed(
+            checkpoints, "s", "top", lambda: logic._select_for_digest(NEWS)
+        )
+    )
+    assert len(best_news) == len(NEWS)
+    assert checkpoints.get("s", "top") is None
+
+
+def test_failed_format_returns_none():
+    async def create(**kwargs):
+        raise ValueError("модель недоступна")
+
+    completions = SimpleNamespace(create=create)
+    client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    assert asyncio.run(format_for_telegram_async("**сводка**", client)) is None
+
+
+def test_final_moderation_block_drops_summary(tmp_path, monkeypatch):
+    async def format_summary(summary, client_ai):
+        return f"<b>{summary}</b>"
+
+    async def moderate(text, client_ai):
+        return {"blocked": True}
+
+    discarded = []
+    monkeypatch.setattr(logic, "format_for_telegram_async", format_summary)
+    monkeypatch.setattr(logic, "moderate_content_async", moderate)
+    monkeypatch.setattr(logic, "should_block_content", lambda result: True)
+    monkeypatch.setattr(logic, "discard_key", discarded.append)
+    checkpoints = CheckpointStore(str(tmp_path / "state.db"))
+    summary = {"text": "сводка", "cache_key": "k"}
+    checkpoints.put("s", "summary", summary)
+    checkpoints.put("s", "top", NEWS)
+
+    text = asyncio.run(logic._format_and_moderate(summary, None, checkpoints, "s"))
+    assert text is None
+    assert checkpoints.get("s", "summary") is None
+    assert checkpoints.get("s", "top") == NEWS
+    assert discarded == ["k"]
@@ -0,0 +1,112 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import logic
+from digest import stream_digest_async
+
+
+def _chunk(content, finish_reason=None):
+    delta = SimpleNamespace(content=content)
+    choice = SimpleNamespace(delta=delta, finish_reason=finish_reason)
+    return SimpleNamespace(choices=[choice], usage=None)
+
+
+class FakeStreamClient:
+    """Потоковый ответ модели из заданных кусков"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **kwargs):
+        async def stream():
+            for chunk in self.chunks:
+                yield chunk
+
+        return stream()
+
+
+NEWS = [
+    {
+        "text": "Запущен новый спутник",
+        "channel_username": "@ch",
+        "message_id": 1,
+        "rating": 9,
+    }
+]
+TRUNCATED = [
+    _chunk("Подводка дня.\n\n\n"),
+    _chunk("🚀 Космос\nЗапущен новый спут"),
+    _chunk("", finish_reason="length"),
+]
+
+
+def test_truncated_stream_raises():
+    sections = []
+    with pytest.raises(ValueError):
+        asyncio.run(
+            stream_digest_async(
+                NEWS, FakeStreamClient(TRUNCATED), on_section=sections.append
+            )
+        )
+    # Оборванный последний блок на модерацию не отправляется
+    assert sections == ["Подводка дня."]
+
+
+class RecordingCheckpoints:
+    """Контрольные точки в памяти: запоминает всё, что сохранено"""
+
+    def __init__(self):
+        self.saved = {}
+
+    def get(self, snapshot, name):
+        return self.saved.get((snapshot, name))
+
+    def put(self, snapshot, name, value):
+        self.saved[(snapshot, name)] = value
+
+
+def _publish_text(monkeypatch, summary):
+    """Текст дайджеста через этап "formatted", как в publish_summary_async"""
+
+    async def reviewed_summary(best_news, client_ai):
+        return summary
+
+    async def format_and_moderate(summary, client_ai, checkpoints, snapshot):
+        return f"<b>{summary['text']}</b>"
+
+    async def review_section(section, client_ai, round_number):
+        return {"approved": True}
+
+    monkeypatch.setattr(logic, "FUSED_DIGEST", True)
+    monkeypatch.setattr(logic, "_reviewed_summary", reviewed_summary)
+    monkeypatch.setattr(logic, "_format_and_moderate", format_and_moderate)
+    monkeypatch.setattr(logic, "_review_section", review_section)
+    checkpoints = RecordingCheckpoints()
+    client = FakeStreamClient(TRUNCATED)
+    text = asyncio.run(
+        logic._checkpointed(
+            checkpoints,
+            "s",
+            "formatted",
+            lambda: logic._digest_text(NEWS, client, checkpoints, "s"),
+        )
+    )
+    return text, checkpoints.saved
+
+
+def test_truncated_digest_falls_back_to_staged_path(monkeypatch):
+    summary = {"text": "сводка", "cache_key": "k"}
+    text, saved = _publish_text(monkeypatch, summary)
+    assert text == "<b>сводка</b>"
+    # Обрезанный потоковый дайджест не сохраняется, только результаты
+    # раздельных этапов
+    assert saved == {("s", "summary"): summary, ("s", "formatted"): text}
+
+
+def test_failed_digest_is_not_checkpointed(monkeypatch):
+    text, saved = _publish_text(monkeypatch, None)
+    assert text is None
+    assert saved == {}
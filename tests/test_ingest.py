@@ -0,0 +1,80 @@
+from types import SimpleNamespace
+
+import pytest
+
+import logic
+from ingest import EventIngestor
+from storage import ProcessedStore
+
+
+@pytest.fixture
+def ingestor(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(logic, "_cached_keys", None)
+    ingestor = EventIngestor(client=None, channels=["@ch"])
+    ingestor._usernames[1] = "@ch"
+    logic.save_channel_cursors({"@ch": 100})
+    yield ingestor
+    ingestor._processed.close()
+
+
+def _message(message_id, text):
+    return SimpleNamespace(
+        id=message_id, text=text, peer_id=SimpleNamespace(channel_id=1)
+    )
+
+
+def test_edit_of_post_below_cursor_is_ignored(ingestor):
+    # Пост старше окна первого сбора или уже удалённый из хранилища
+    # обработанных по сроку хранения
+    assert not ingestor.ingest(_message(42, "старый пост, правка"), edited=True)
+    assert logic.load_news_cache() == []
+
+
+def test_edit_of_unseen_post_above_cursor_is_taken(ingestor):
+    assert ingestor.ingest(_message(105, "пропущенный пост"), edited=True)
+    assert [item["message_id"] for item in logic.load_news_cache()] == [105]
+
+
+def test_edit_of_pending_post_replaces_it(ingestor):
+    assert ingestor.ingest(_message(101, "пост"))
+    assert ingestor.ingest(_message(101, "пост, правка"), edited=True)
+    assert [item["text"] for item in logic.load_news_cache()] == ["пост, правка"]
+
+
+def test_edit_between_snapshot_and_clear_is_not_republished(ingestor):
+    assert ingestor.ingest(_message(101, "пост"))
+    assert ingestor.ingest(_message(102, "другой пост"))
+    news, offset = logic.snapshot_news_cache()
+    assert len(news) == 2
+
+    # Правка пришла, пока дайджест готовился к публикации
+    assert ingestor.ingest(_message(101, "пост, правка"), edited=True)
+    assert ingestor.ingest(_message(103, "новый пост"))
+    logic.clear_news_cache(offset)
+
+    assert [item["message_id"] for item in logic.load_news_cache()] == [103]
+    assert not ingestor.ingest(_message(101, "ещё правка"), edited=True)
+    store = ProcessedStore()
+    assert ("@ch", 101) in store
+    store.close()
+
+
+def test_new_post_moves_cursor_forward_only(ingestor):
+    assert ingestor.ingest(_message(105, "пост после пропуска"))
+    assert logic.load_channel_cursors() == {"@ch": 105}
+    assert ingestor.ingest(_message(103, "запоздавший пост"))
+    assert logic.load_channel_cursors() == {"@ch": 105}
+
+
+def test_edits_do_not_reread_journal(ingestor, monkeypatch):
+    assert ingestor.ingest(_message(101, "пост"))
+    assert ingestor.ingest(_message(101, "пост, правка"), edited=True)
+
+    def fail():
+        raise AssertionError("журнал перечитан")
+
+    monkeypatch.setattr(logic, "iter_news_cache", fail)
+    assert ingestor.ingest(_message(102, "другой пост"))
+    assert ingestor.ingest(_message(101, "ещё правка"), edited=True)
+    assert ingestor.ingest(_message(102, "другой пост, правка"), edited=True)
@@ -0,0 +1,31 @@
+import asyncio
+from types import SimpleNamespace
+
+import logic
+from rate import RatingResult, content_hash, prompt_version
+from storage import RatingStore
+
+NEWS = [
+    {"text": f"Новость номер {i}", "channel_username": "@ch", "message_id": i}
+    for i in range(2)
+]
+
+
+def test_ratings_are_stored_under_the_answering_model(tmp_path, monkeypatch):
+    async def rate_batch(texts, client_ai):
+        return [RatingResult(0.9, "оценка", model="backup") for _ in texts]
+
+    db = str(tmp_path / "state.db")
+    monkeypatch.setattr(logic, "rate_batch_async", rate_batch)
+    monkeypatch.setattr(logic, "RatingStore", lambda: RatingStore(db))
+    monkeypatch.setattr(logic, "get_context", lambda: SimpleNamespace(ai=None))
+
+    top_news, complete = asyncio.run(logic._rate_top_news(NEWS))
+    assert complete
+    assert [item["rating_score"] for item in top_news] == [0.9, 0.9]
+
+    hashes = [content_hash(item["text"]) for item in NEWS]
+    store = RatingStore(db)
+    assert store.get_many(hashes, prompt_version()) == {}
+    assert len(store.get_many(hashes, prompt_version("backup"))) == len(NEWS)
+    store.close()
@@ -0,0 +1,61 @@
+import asyncio
+from types import SimpleNamespace
+
+import openai
+import pytest
+
+import governor
+import routing
+from llm import BoundedAsyncOpenAI, http_transport
+
+
+class FakeCompletions:
+    """Модели из timeouts не успевают ответить, остальные отвечают сразу"""
+
+    def __init__(self, timeouts):
+        self.timeouts = timeouts
+        self.attempts = []
+
+    async def create(self, **kwargs):
+        self.attempts.append(kwargs["model"])
+        if kwargs["model"] in self.timeouts:
+            request = http_transport().Request("POST", "https://test.invalid")
+            raise openai.APITimeoutError(request=request)
+        return SimpleNamespace(usage=None, model=kwargs["model"])
+
+
+@pytest.fixture(autouse=True)
+def fresh_routing(monkeypatch):
+    monkeypatch.setattr(routing, "_failed_at", {})
+    monkeypatch.setattr(governor, "LLM_RETRY_BASE", 0.0)
+    monkeypatch.setenv("ROUTE_TIMEOUT_SUMMARIZE", "90")
+
+
+def _route(completions):
+    client = BoundedAsyncOpenAI(
+        SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    )
+    return asyncio.run(
+        routing.route_async("summarize", lambda model: {"model": model}, client)
+    )
+
+
+def test_timeout_fails_over_after_one_attempt(monkeypatch):
+    monkeypatch.setenv("MODEL_SUMMARIZE", "model-a,model-b")
+    completions = FakeCompletions({"model-a"})
+
+    request, response = _route(completions)
+
+    assert completions.attempts == ["model-a", "model-b"]
+    assert response.model == "model-b"
+    assert routing._ordered("summarize") == ["model-b", "model-a"]
+    assert routing._ordered("rate") == routing.models_for("rate")
+
+
+def test_last_model_in_chain_is_retried(monkeypatch):
+    monkeypatch.setenv("MODEL_SUMMARIZE", "model-a")
+    completions = FakeCompletions({"model-a"})
+
+    with pytest.raises(openai.APITimeoutError):
+        _route(completions)
+    assert completions.attempts == ["model-a"] * (governor.LLM_RETRIES + 1)
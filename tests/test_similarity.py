@@ -0,0 +1,40 @@
+import random
+
+from similarity import candidate_pairs, jaccard, minhash, shingles, similar_pairs
+
+_ALPHABET = "абвгдежзиклмнопрстуфхцчшщэюя"
+
+
+def _vocabulary(rng, size=5000):
+    return ["".join(rng.choices(_ALPHABET, k=rng.randint(4, 10))) for _ in range(size)]
+
+
+def _text(rng, vocabulary, weights):
+    return " ".join(rng.choices(vocabulary, weights, k=rng.randint(30, 120)))
+
+
+def test_unrelated_texts_are_rarely_candidates():
+    rng = random.Random(0)
+    vocabulary = _vocabulary(rng)
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    texts = [_text(rng, vocabulary, weights) for _ in range(300)]
+
+    signatures = [minhash(shingles(text)) for text in texts]
+    total = len(texts) * (len(texts) - 1) // 2
+    assert len(candidate_pairs(signatures)) < 0.05 * total
+    assert all(score < 0.25 for _, _, score in similar_pairs(texts))
+
+
+def test_reposts_are_found_with_exact_similarity():
+    rng = random.Random(1)
+    vocabulary = _vocabulary(rng)
+    original = " ".join(rng.choices(vocabulary, k=80))
+    words = original.split()
+    for idx in range(0, len(words), 10):
+        words[idx] = rng.choice(vocabulary)
+    repost = " ".join(words)
+
+    pairs = similar_pairs([original, repost, " ".join(rng.choices(vocabulary, k=80))])
+    expected = jaccard(shingles(original), shingles(repost))
+    assert (0, 1, expected) in pairs
+    assert expected > 0.7
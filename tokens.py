@@ -0,0 +1,161 @@
+"""
+Модуль подсчёта токенов и планирования бюджета запросов к модели
+"""
+import logging
+import math
+import os
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import tiktoken
+except ImportError:  # без tiktoken считаем токены по длине текста
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# === Настройки бюджета ===
+# Явный размер контекстного окна (иначе - по таблице MODEL_CONTEXT_TOKENS)
+LLM_CONTEXT_TOKENS = int(os.getenv("LLM_CONTEXT_TOKENS", "0"))
+# Потолок max_tokens: многие модели не отдают больше за один ответ
+LLM_MAX_OUTPUT_TOKENS = int(os.getenv("LLM_MAX_OUTPUT_TOKENS", "4096"))
+# Длинные посты обрезаются до этого числа токенов перед отправкой в модель
+ITEM_MAX_TOKENS = int(os.getenv("ITEM_MAX_TOKENS", "700"))
+# Оценка без tiktoken: для русского текста 2.5 символа на токен - с запасом
+CHARS_PER_TOKEN = 2.5
+DEFAULT_CONTEXT_TOKENS = 16000
+# Запас на служебные токены разметки сообщений и погрешность подсчёта
+SAFETY_MARGIN_TOKENS = 256
+MESSAGE_OVERHEAD_TOKENS = 4
+MIN_OUTPUT_TOKENS = 64
+
+# Контекстные окна по подстроке имени модели (выбирается самое длинное совпадение)
+MODEL_CONTEXT_TOKENS: Dict[str, int] = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4.1": 1047576,
+    "o1": 200000,
+    "o3": 200000,
+    "claude": 200000,
+    "gemini": 1000000,
+    "llama-3": 8192,
+    "llama-3.1": 131072,
+    "llama-3.3": 131072,
+    "mistral": 32768,
+    "mixtral": 32768,
+    "deepseek": 65536,
+    "qwen": 32768,
+}
+
+ELLIPSIS = "…"
+
+
+def context_limit(model: Optional[str] = None) -> int:
+    """Возвращает размер контекстного окна модели в токенах"""
+    if LLM_CONTEXT_TOKENS > 0:
+        return LLM_CONTEXT_TOKENS
+    name = (model or os.getenv("MODEL") or "").lower()
+    matches = [key for key in MODEL_CONTEXT_TOKENS if key in name]
+    if not matches:
+        return DEFAULT_CONTEXT_TOKENS
+    return MODEL_CONTEXT_TOKENS[max(matches, key=len)]
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: Optional[str]) -> Any:
+    """Возвращает токенизатор tiktoken для модели или None"""
+    if tiktoken is None:
+        return None
+    name = (model or "").split("/")[-1]
+    try:
+        return tiktoken.encoding_for_model(name)
+    except KeyError:
+        pass
+    except Exception as e:
+        logger.warning(f"tiktoken недоступен ({e}), считаю токены по длине текста")
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"tiktoken недоступен ({e}), считаю токены по длине текста")
+        return None
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """Считает (или оценивает) число токенов в тексте"""
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def count_messages(messages: List[Dict[str, Any]], model: Optional[str] = None) -> int:
+    """Оценивает размер списка сообщений chat.completions в токенах"""
+    return sum(
+        count_tokens(str(message.get("content") or ""), model)
+        + MESSAGE_OVERHEAD_TOKENS
+        for message in messages
+    )
+
+
+def trim_to_tokens(text: str, max_tokens: int, model: Optional[str] = None) -> str:
+    """Обрезает текст до max_tokens токенов (по границе слова, с многоточием)"""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    encoding = _encoding(model)
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        head = encoding.decode(tokens[: max(0, max_tokens - 1)])
+    else:
+        head = text[: int(max(0, max_tokens - 1) * CHARS_PER_TOKEN)]
+    if " " in head:
+        head = head.rsplit(" ", 1)[0]
+    return head.rstrip() + ELLIPSIS
+
+
+def input_budget(
+    model: Optional[str], reserved_output: int, overhead: int = 0
+) -> int:
+    """Сколько токенов остаётся на содержимое запроса после промпта и ответа"""
+    return (
+        context_limit(model)
+        - min(reserved_output, LLM_MAX_OUTPUT_TOKENS)
+        - overhead
+        - SAFETY_MARGIN_TOKENS
+    )
+
+
+def output_budget(model: Optional[str], prompt_tokens: int, expected: int) -> int:
+    """
+    Подбирает max_tokens под ожидаемый размер ответа: не больше, чем нужно,
+    и не больше, чем помещается в контекст после промпта.
+    """
+    room = context_limit(model) - prompt_tokens - SAFETY_MARGIN_TOKENS
+    return max(MIN_OUTPUT_TOKENS, min(expected, LLM_MAX_OUTPUT_TOKENS, room))
+
+
+def pack(
+    costs: List[int], budget: int, max_items: Optional[int] = None
+) -> List[Tuple[int, int]]:
+    """
+    Раскладывает элементы по пакетам так, чтобы сумма их стоимостей
+    не превышала budget, а число элементов - max_items.
+
+    Returns:
+        Список диапазонов (start, end) в исходном порядке
+    """
+    ranges: List[Tuple[int, int]] = []
+    start, used = 0, 0
+    for idx, cost in enumerate(costs):
+        full = max_items is not None and idx - start >= max_items
+        if idx > start and (used + cost > budget or full):
+            ranges.append((start, idx))
+            start, used = idx, 0
+        used += cost
+    if start < len(costs):
+        ranges.append((start, len(costs)))
+    return ranges